@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Model comparison behind MAE_Results_comp.npz: the mean absolute error of the time to pass predicted by each model
+after 1-5 observations, over the whole cohort.
+
+Every model predicts the time to pass at each observation of every patient from the observations before it (and,
+for the siamese GP, the embedding of the current image). Models are registered with `register_model` and predict the
+whole cohort at once, vectorized over patients, while the models themselves run concurrently on a process pool of
+n_workers. The predictions of each model are cached against a hash of the cohort and the model options, so a
+new or changed model is the only one that is re-run.
+
+    python axr/compare.py cohort.csv --lstm lstm_predictions.npz --embeddings /data/embeddings/epoch_40
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import csv
+import json
+import hashlib
+import logging
+import argparse
+import numpy as np
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from gpm import BatchedGP, sequential_predictions, fit_prior
+from embeddings import EmbeddingStore
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+MAX_OBSERVATIONS = 5
+# time to pass is clipped to this many days before taking logs for the exponential fit
+MIN_DAYS = 0.5
+MODELS = {}
+
+
+def register_model(name):
+    """
+    register fn(cohort, **options) -> (P, N) predictions
+    """
+    def register(fn):
+        MODELS[name] = fn
+        return fn
+    return register
+
+
+def load_cohort(csv_file):
+    """
+    padded (P, N) arrays from a csv with patient, x (elapsed days) and time_to_pass columns, one row per observation,
+    and an optional case column naming the embedding of each observation
+    """
+    rows = defaultdict(list)
+    with open(csv_file, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            rows[row['patient']].append(row)
+    patients = sorted(rows)
+    counts = np.array([len(rows[p]) for p in patients], dtype=int)
+    N = int(counts.max()) if len(counts) else 0
+    x = np.zeros((len(patients), N))
+    y = np.zeros((len(patients), N))
+    cases = np.full((len(patients), N), '', dtype=object)
+    for i, p in enumerate(patients):
+        observations = sorted(rows[p], key=lambda r: float(r['x']))
+        x[i, :counts[i]] = [float(r['x']) for r in observations]
+        y[i, :counts[i]] = [float(r['time_to_pass']) for r in observations]
+        cases[i, :counts[i]] = [r.get('case', '') for r in observations]
+    return {'patients': patients, 'x': x, 'y': y, 'counts': counts, 'cases': cases}
+
+
+def cohort_hash(cohort):
+    digest = hashlib.sha1()
+    for key in ('x', 'y', 'counts'):
+        digest.update(np.ascontiguousarray(cohort[key]).tobytes())
+    digest.update(json.dumps(cohort['patients']).encode())
+    digest.update(json.dumps(cohort['cases'].tolist()).encode())
+    return digest.hexdigest()
+
+
+def observed(cohort):
+    return np.arange(cohort['x'].shape[1])[None, :] < cohort['counts'][:, None]
+
+
+@register_model('exp')
+def exp_fit(cohort):
+    """
+    y = a exp(b x) fit by least squares on log y to the earlier observations of each patient, for all patients
+    and observation counts at once from prefix sums. With fewer than two earlier observations the rate of the
+    pooled cohort fit is used, and with none the pooled fit itself.
+    """
+    x, counts = cohort['x'], cohort['counts']
+    mask = observed(cohort)
+    logy = np.log(np.maximum(cohort['y'], MIN_DAYS)) * mask
+    xm = x * mask
+    b0, log_a0 = np.polyfit(x[mask], logy[mask], 1)
+
+    def before(v):
+        # sums over the observations before each one
+        return np.cumsum(v, axis=1) - v
+
+    n = before(mask.astype(float))
+    sx, sl, sxx, sxl = before(xm), before(logy), before(xm * xm), before(xm * logy)
+    denominator = n * sxx - sx ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = np.where((n >= 2) & (np.abs(denominator) > 1e-9), (n * sxl - sx * sl) / denominator, b0)
+        log_a = np.where(n >= 1, (sl - b * sx) / np.maximum(n, 1), log_a0)
+    return np.exp(log_a + b * x) * mask
+
+
+@register_model('gp')
+def gp_fit(cohort, length_scale=5.0, variance=25.0, noise=0.1):
+    """
+    the batched GP of gpm.py on elapsed time with the pooled linear fit as its prior mean
+    """
+    x, y, counts = cohort['x'][..., None], cohort['y'], cohort['counts']
+    offset, slope = fit_prior(x, y, counts)
+    gp = BatchedGP(len(counts), 1, length_scale, variance, noise, offset, slope)
+    predicted, _ = sequential_predictions(gp, x, y, counts)
+    return predicted
+
+
+@register_model('siamese')
+def siamese_gp(cohort, embeddings=None, variance=25.0, noise=0.1):
+    """
+    the batched GP on the siamese embedding of each observation, with the median distance between embeddings as
+    the length scale
+    """
+    if not embeddings:
+        raise ValueError("the siamese model needs an embedding store")
+    store = EmbeddingStore.open(embeddings)
+    mask = observed(cohort)
+    X = np.zeros(cohort['x'].shape + (store.dim,))
+    X[mask] = store.get(list(cohort['cases'][mask]))
+    sample = X[mask][:1000]
+    distances = np.sqrt(np.sum((sample[:, None] - sample[None]) ** 2, axis=-1))
+    length_scale = float(np.median(distances[distances > 0])) if np.any(distances > 0) else 1.0
+    offset = float(cohort['y'][mask].mean())
+    gp = BatchedGP(len(cohort['counts']), store.dim, length_scale, variance, noise, offset, 0.0)
+    predicted, _ = sequential_predictions(gp, X, cohort['y'], cohort['counts'])
+    return predicted
+
+
+@register_model('lstm')
+def lstm_predictions(cohort, predictions=None):
+    """
+    predictions of the LSTM, which is trained and run with the networks, read from an npz of patients and
+    (P, N) predicted
+    """
+    if not predictions:
+        raise ValueError("the lstm model needs a predictions file")
+    saved = np.load(predictions, allow_pickle=False)
+    rows = {str(p): i for i, p in enumerate(saved['patients'])}
+    N = cohort['x'].shape[1]
+    predicted = np.zeros(cohort['x'].shape)
+    for i, patient in enumerate(cohort['patients']):
+        values = saved['predicted'][rows[patient]][:N]
+        predicted[i, :len(values)] = values
+    return predicted
+
+
+def cache_key(name, cohort_digest, options):
+    """
+    the cohort, the model options and the modification time of any file they name
+    """
+    stamps = {k: os.stat(v).st_mtime for k, v in options.items() if isinstance(v, str) and os.path.exists(v)}
+    return hashlib.sha1(json.dumps([name, cohort_digest, options, stamps], sort_keys=True,
+                                   default=str).encode()).hexdigest()
+
+
+def cached_predictions(name, cohort, options, cache_dir):
+    """
+    the predictions of a model, from cache_dir when the cohort and options are unchanged
+    """
+    cache_file = Path(cache_dir) / f"{name}.npz"
+    key = cache_key(name, cohort_hash(cohort), options)
+    if cache_file.is_file():
+        cached = np.load(cache_file)
+        if str(cached['key']) == key:
+            log.info(f"using cached {name} predictions from {cache_file}")
+            return cached['predicted']
+    log.info(f"running {name}")
+    predicted = MODELS[name](cohort, **options)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(cache_file, key=key, predicted=predicted)
+    return predicted
+
+
+def mae_curve(predicted, cohort, max_observations=MAX_OBSERVATIONS):
+    """
+    mean absolute error over all patients after 1..max_observations observations. A patient with fewer
+    observations keeps the error of its last prediction.
+    """
+    counts = cohort['counts']
+    k = np.arange(1, max_observations + 1)
+    j = np.minimum(k[None, :], counts[:, None]) - 1
+    errors = np.abs(np.take_along_axis(predicted, j, axis=1) - np.take_along_axis(cohort['y'], j, axis=1))
+    return errors.mean(axis=0)
+
+
+def compare(cohort, model_options, cache_dir, n_workers=None, max_observations=MAX_OBSERVATIONS):
+    """
+    run every model concurrently, one process each up to n_workers, and return {model: mae curve}, NaN for a model
+    that could not be run
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=min(len(model_options), n_workers or os.cpu_count())) as executor:
+        futures = {name: executor.submit(cached_predictions, name, cohort, options, cache_dir)
+                   for name, options in model_options.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = mae_curve(future.result(), cohort, max_observations)
+            except Exception as e:
+                log.warning(f"skipping {name} : {e}")
+                results[name] = np.full(max_observations, np.nan)
+            log.info(f"{name} : {np.round(results[name], 2)}")
+    return results
+
+
+def main(csv_file, out_file, cache_dir, lstm=None, embeddings=None, n_workers=None):
+    cohort = load_cohort(csv_file)
+    log.info(f"{len(cohort['patients'])} patients, {cohort['counts'].sum()} observations")
+    model_options = {'exp': {}, 'gp': {}, 'lstm': {'predictions': lstm}, 'siamese': {'embeddings': embeddings}}
+    results = compare(cohort, model_options, cache_dir, n_workers)
+    np.savez(out_file, **{f"mae_{name}": mae for name, mae in results.items()})
+    log.info(f"saved {out_file}")
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='mean absolute error of each model against the number of observations')
+    parser.add_argument('csv_file', help='csv with patient, x, time_to_pass and optionally case columns')
+    parser.add_argument('--out', help='output npz', default='./data/MAE_Results_comp.npz')
+    parser.add_argument('--cache', help='directory of cached model predictions', default='./data/predictions')
+    parser.add_argument('--lstm', help='npz of LSTM predictions', default=None)
+    parser.add_argument('--embeddings', help='embedding store for the siamese GP', default=None)
+    parser.add_argument('--n_workers', help='number of processes', default=None, type=int)
+    args = parser.parse_args()
+    main(args.csv_file, args.out, args.cache, args.lstm, args.embeddings, args.n_workers)
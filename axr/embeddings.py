@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Append-only, memory-mapped store of siamese embeddings keyed by case, with an incremental PCA that is updated batch by
+batch so the PCA figure never needs every embedding in memory.
+
+The store is a directory holding
+    embeddings.raw   float32 rows of dim values, back to back
+    store.json       dim, dtype and the number of committed rows
+    keys.jsonl       the case key of each row
+A key that is appended again is superseded by its newest row.
+
+    python axr/embeddings.py /data/embeddings/epoch_40 pairs.csv --out ./data/pca_features.npz
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import csv
+import json
+import fcntl
+import logging
+import argparse
+import numpy as np
+from pathlib import Path
+from contextlib import contextmanager
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+EMBEDDINGS_FILE = "embeddings.raw"
+STORE_FILE = "store.json"
+KEYS_FILE = "keys.jsonl"
+LOCK_FILE = ".lock"
+BATCH_SIZE = 4096
+OVERSAMPLE = 10
+
+
+@contextmanager
+def locked(path):
+    with open(Path(path) / LOCK_FILE, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_header(path, header):
+    tmp_file = Path(path) / f"{STORE_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_file, Path(path) / STORE_FILE)
+
+
+def read_keys(file, count, start=0, offset=0):
+    """
+    keys start to count of the keys file, reading from the byte offset of key start
+    :return: the keys and the byte offset after the last of them
+    """
+    keys = []
+    with open(file, 'rb') as f:
+        f.seek(offset)
+        for _ in range(start, count):
+            keys.append(json.loads(f.readline()))
+        return keys, f.tell()
+
+
+class EmbeddingStore(object):
+    """
+    `embeddings` is an np.memmap of shape (count, dim). `rows[key]` is the newest row of a case.
+    """
+    def __init__(self, path, dim, dtype, count, keys, keys_bytes=0):
+        self.path = Path(path)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self.keys = keys
+        self.keys_bytes = keys_bytes
+        self.rows = {key: i for i, key in enumerate(keys)}
+        self._embeddings = None
+
+    @classmethod
+    def open(cls, path, dim=None, dtype='float32'):
+        """
+        open the store at path, creating it for embeddings of size dim if it does not exist
+        """
+        path = Path(path)
+        if not (path / STORE_FILE).is_file():
+            if dim is None:
+                raise FileNotFoundError(f"no embedding store in {path}")
+            path.mkdir(parents=True, exist_ok=True)
+            with locked(path):
+                write_header(path, {'dim': int(dim), 'dtype': np.dtype(dtype).str, 'count': 0})
+                (path / EMBEDDINGS_FILE).touch()
+                (path / KEYS_FILE).touch()
+            log.info(f"created embedding store {path} of dim {dim}")
+        with locked(path):
+            with open(path / STORE_FILE, 'r') as f:
+                header = json.load(f)
+            keys, keys_bytes = read_keys(path / KEYS_FILE, header['count'])
+        return cls(path, header['dim'], header['dtype'], header['count'], keys, keys_bytes)
+
+    @property
+    def embeddings(self):
+        if self.count == 0:
+            return np.empty((0, self.dim), dtype=self.dtype)
+        if self._embeddings is None or len(self._embeddings) != self.count:
+            self._embeddings = np.memmap(self.path / EMBEDDINGS_FILE, dtype=self.dtype, mode='r',
+                                         shape=(self.count, self.dim))
+        return self._embeddings
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, key):
+        return self.embeddings[self.rows[key]]
+
+    def get(self, keys):
+        """
+        (len(keys), dim) embeddings of the given cases
+        """
+        return self.embeddings[[self.rows[key] for key in keys]]
+
+    def latest(self):
+        """
+        sorted row numbers of the newest embedding of every case
+        """
+        return np.array(sorted(self.rows.values()), dtype=np.int64)
+
+    def append(self, keys, vectors):
+        """
+        append a batch of embeddings. The header count is only advanced once the rows and keys are written,
+        so an interrupted append is dropped by the next one.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype).reshape(len(keys), self.dim)
+        keys = [str(key) for key in keys]
+        with locked(self.path):
+            with open(self.path / STORE_FILE, 'r') as f:
+                header = json.load(f)
+            count = header['count']
+            with open(self.path / EMBEDDINGS_FILE, 'r+b') as f:
+                f.truncate(count * self.dim * self.dtype.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(vectors.tobytes())
+            # keys appended by other writers since this store was read
+            added, self.keys_bytes = read_keys(self.path / KEYS_FILE, count, len(self.keys), self.keys_bytes)
+            self.keys.extend(added)
+            lines = "".join(json.dumps(key) + "\n" for key in keys).encode()
+            with open(self.path / KEYS_FILE, 'r+b') as f:
+                f.truncate(self.keys_bytes)
+                f.seek(0, os.SEEK_END)
+                f.write(lines)
+            header['count'] = count + len(keys)
+            write_header(self.path, header)
+            self.keys.extend(keys)
+            self.keys_bytes += len(lines)
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+        self.count = count + len(keys)
+        return self
+
+    def batches(self, rows=None, batch_size=BATCH_SIZE):
+        """
+        the embeddings in batches of at most batch_size rows, reading only those rows from disk
+        """
+        rows = self.latest() if rows is None else rows
+        for start in range(0, len(rows), batch_size):
+            yield np.asarray(self.embeddings[rows[start:start + batch_size]], dtype=np.float64)
+
+
+class IncrementalPCA(object):
+    """
+    PCA updated one batch at a time (Ross et al. 2008, as in sklearn's IncrementalPCA). The state after each batch
+    is the mean, sample count and the top components with their singular values, so memory is independent of the
+    number of samples seen. `oversample` further components are kept in the state, as the leading components are
+    only accurate when the truncation discards little of the scatter. `fitted_rows` is the number of rows the
+    embedding store had at the last fit, see fit_pairs.
+    """
+    def __init__(self, n_components=2, oversample=OVERSAMPLE):
+        self.n_components = n_components
+        self.oversample = oversample
+        self.n_samples = 0
+        self.mean = None
+        self.state_components = None
+        self.state_singular_values = None
+        self.fitted_rows = 0
+
+    @property
+    def components(self):
+        return None if self.state_components is None else self.state_components[:self.n_components]
+
+    @property
+    def singular_values(self):
+        return None if self.state_singular_values is None else self.state_singular_values[:self.n_components]
+
+    def partial_fit(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        n = len(X)
+        if n == 0:
+            return self
+        batch_mean = X.mean(axis=0)
+        if self.n_samples == 0:
+            stacked = X - batch_mean
+            mean = batch_mean
+        else:
+            total = self.n_samples + n
+            mean = (self.n_samples * self.mean + n * batch_mean) / total
+            # the shift between the old and batch means keeps the combined scatter exact
+            correction = np.sqrt(self.n_samples * n / total) * (self.mean - batch_mean)
+            stacked = np.vstack([self.state_singular_values[:, None] * self.state_components, X - batch_mean,
+                                 correction])
+        _, S, Vt = np.linalg.svd(stacked, full_matrices=False)
+        # fix the sign of each component so projections do not flip between batches
+        signs = np.sign(Vt[np.arange(len(Vt)), np.argmax(np.abs(Vt), axis=1)])
+        Vt *= signs[:, None]
+        k = min(self.n_components + self.oversample, len(S))
+        self.state_components = Vt[:k]
+        self.state_singular_values = S[:k]
+        self.mean = mean
+        self.n_samples += n
+        return self
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=np.float64) - self.mean) @ self.components.T
+
+    @property
+    def explained_variance(self):
+        return self.singular_values ** 2 / max(self.n_samples - 1, 1)
+
+    def save(self, file):
+        np.savez(file, n_components=self.n_components, oversample=self.oversample, n_samples=self.n_samples,
+                 mean=self.mean, components=self.state_components, singular_values=self.state_singular_values,
+                 fitted_rows=self.fitted_rows)
+
+    @classmethod
+    def load(cls, file):
+        state = np.load(file)
+        pca = cls(int(state['n_components']), int(state['oversample']) if 'oversample' in state else 0)
+        pca.n_samples = int(state['n_samples'])
+        pca.mean = state['mean']
+        pca.state_components = state['components']
+        pca.state_singular_values = state['singular_values']
+        pca.fitted_rows = int(state['fitted_rows']) if 'fitted_rows' in state else 0
+        return pca
+
+
+def pair_features(store, pairs):
+    """
+    the absolute difference of the embeddings of each (case, case) pair, as compared by the siamese head
+    """
+    pairs = list(pairs)
+    return np.abs(store.get([a for a, _ in pairs]) - store.get([b for _, b in pairs]))
+
+
+def fit_pairs(store, pairs, pca=None, batch_size=BATCH_SIZE):
+    """
+    update pca with the pair features batch by batch. Only pairs with a row appended to the store since the last fit
+    are added, so a pair is fit again once a newer checkpoint replaces either of its embeddings, and the pairs
+    between rows that were already in the store are taken as fitted.
+    """
+    pca = pca or IncrementalPCA()
+    rows = [pair for pair in dict.fromkeys((store.rows[a], store.rows[b]) for a, b in pairs)
+            if max(pair) >= pca.fitted_rows]
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        pca.partial_fit(np.abs(np.asarray(store.embeddings[batch[:, 0]], dtype=np.float64) -
+                               store.embeddings[batch[:, 1]]))
+    pca.fitted_rows = store.count
+    if len(rows):
+        log.debug(f"fit pca on {len(rows)} new pairs")
+    return pca
+
+
+def outcome_masks(labels, predicted):
+    """
+    true/false positive/negative masks as float 0/1 arrays, as in pca_features.npz
+    """
+    labels = np.asarray(labels, dtype=bool)
+    predicted = np.asarray(predicted, dtype=bool)
+    return {'true_positives': (labels & predicted).astype(float),
+            'true_negatives': (~labels & ~predicted).astype(float),
+            'false_positives': (~labels & predicted).astype(float),
+            'false_negatives': (labels & ~predicted).astype(float)}
+
+
+def write_pca_features(file, store, pca, pairs, labels, predicted, batch_size=BATCH_SIZE):
+    """
+    write the projected pair features, pair case indexes and outcome masks read by plot_pca in Figures.ipynb
+    """
+    pairs = list(pairs)
+    features = np.vstack([pca.transform(pair_features(store, pairs[start:start + batch_size]))
+                          for start in range(0, len(pairs), batch_size)] or [np.empty((0, pca.n_components))])
+    indexes = np.array([[store.rows[a], store.rows[b]] for a, b in pairs], dtype=np.int64).reshape(-1, 2)
+    np.savez(file, features=features, indexes=indexes, **outcome_masks(labels, predicted))
+    log.info(f"saved {len(pairs)} projected pairs to {file}")
+
+
+def load_pairs(csv_file):
+    """
+    (case_a, case_b) pairs with their label and prediction from a csv with a, b, label and predicted columns
+    """
+    pairs, labels, predicted = [], [], []
+    with open(csv_file, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            pairs.append((row['a'], row['b']))
+            labels.append(int(row['label']))
+            predicted.append(int(row['predicted']))
+    return pairs, labels, predicted
+
+
+def main(store_dir, pairs_file, out_file, pca_file=None):
+    store = EmbeddingStore.open(store_dir)
+    pairs, labels, predicted = load_pairs(pairs_file)
+    pca = IncrementalPCA.load(pca_file) if pca_file and Path(pca_file).is_file() else None
+    pca = fit_pairs(store, pairs, pca)
+    if pca_file:
+        pca.save(pca_file)
+    log.info(f"pca of {pca.n_samples} pairs, explained variance {pca.explained_variance}")
+    write_pca_features(out_file, store, pca, pairs, labels, predicted)
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='project siamese pair embeddings for the PCA figure')
+    parser.add_argument('store_dir', help='embedding store directory')
+    parser.add_argument('pairs_file', help='csv with a, b, label and predicted columns')
+    parser.add_argument('--out', help='output npz', default='./data/pca_features.npz')
+    parser.add_argument('--pca', help='npz holding the pca state, updated with these pairs', default=None)
+    args = parser.parse_args()
+    main(args.store_dir, args.pairs_file, args.out, args.pca)
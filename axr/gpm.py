@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batched Gaussian process for time-to-pass prediction as observations accumulate.
+
+Every patient has its own GP with shared hyperparameters. Observations are added one at a time by appending a row to
+each patient's Cholesky factor (a bordered rank-1 update, O(n^2) instead of refactoring in O(n^3)), and all patients
+are updated and evaluated together with vectorized numpy. The predictions are written as the gpm_plot_*.npz files
+(x, time_to_pass, predicted, sigma) that Figures.ipynb plots.
+
+    python axr/gpm.py cohort.csv --patient 17 --out ./data
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import csv
+import logging
+import argparse
+import numpy as np
+from pathlib import Path
+from collections import defaultdict
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 8
+
+
+def rbf(a, b, length_scale, variance):
+    """
+    squared exponential kernel between (P, n, D) and (P, m, D) batches of inputs
+    :return: (P, n, m)
+    """
+    d2 = np.sum((a[:, :, None, :] - b[:, None, :, :]) ** 2, axis=-1)
+    return variance * np.exp(-0.5 * d2 / length_scale ** 2)
+
+
+def forward_solve(L, b, n):
+    """
+    solve L w = b for the first n rows of a batch of lower triangular factors
+    :param L: (P, N, N) with N >= n
+    :param b: (P, n, m)
+    :return: (P, n, m)
+    """
+    w = np.empty_like(b)
+    for i in range(n):
+        w[:, i] = (b[:, i] - np.einsum('pj,pjm->pm', L[:, i, :i], w[:, :i])) / L[:, i, i, None]
+    return w
+
+
+class BatchedGP(object):
+    """
+    GPs of P patients with an RBF kernel plus observation noise around a linear prior mean
+    offset + slope * x[..., 0]. The factors are kept in (P, capacity, capacity) arrays that double when full.
+    A patient without a new observation in an update gets a padding row that has no effect on its predictions.
+    """
+    def __init__(self, n_patients, n_features=1, length_scale=5.0, variance=25.0, noise=0.1, offset=0.0, slope=0.0,
+                 capacity=DEFAULT_CAPACITY):
+        self.length_scale = float(length_scale)
+        self.variance = float(variance)
+        self.noise = float(noise)
+        self.offset = float(offset)
+        self.slope = float(slope)
+        self.n = 0
+        self.X = np.zeros((n_patients, capacity, n_features))
+        self.observed = np.zeros((n_patients, capacity), dtype=bool)
+        self.L = np.zeros((n_patients, capacity, capacity))
+        # v = L^-1 (y - prior mean), so the posterior mean never needs a full solve
+        self.v = np.zeros((n_patients, capacity))
+
+    @property
+    def n_patients(self):
+        return len(self.X)
+
+    def prior_mean(self, X):
+        return self.offset + self.slope * X[..., 0]
+
+    def _grow(self):
+        capacity = 2 * self.X.shape[1]
+        P, N, D = self.X.shape
+        X = np.zeros((P, capacity, D))
+        X[:, :N] = self.X
+        observed = np.zeros((P, capacity), dtype=bool)
+        observed[:, :N] = self.observed
+        L = np.zeros((P, capacity, capacity))
+        L[:, :N, :N] = self.L
+        v = np.zeros((P, capacity))
+        v[:, :N] = self.v
+        self.X, self.observed, self.L, self.v = X, observed, L, v
+
+    def _cross(self, Xs):
+        """
+        kernel between the observations and Xs, zero for padding rows
+        """
+        Ks = rbf(self.X[:, :self.n], Xs, self.length_scale, self.variance)
+        return Ks * self.observed[:, :self.n, None]
+
+    def append(self, x, y, active=None):
+        """
+        add one observation per patient
+        :param x: (P, D) or (P,) inputs
+        :param y: (P,) time to pass
+        :param active: (P,) mask of the patients that have an observation, all of them if None
+        """
+        x = np.asarray(x, dtype=float).reshape(self.n_patients, -1)
+        y = np.asarray(y, dtype=float)
+        active = np.ones(self.n_patients, dtype=bool) if active is None else np.asarray(active, dtype=bool)
+        if self.n == self.X.shape[1]:
+            self._grow()
+        n = self.n
+
+        # border the factor: [[L, 0], [c^T, d]] with c = L^-1 k and d^2 = k(x, x) + noise - c.c
+        c = forward_solve(self.L, self._cross(x[:, None, :]), n)[:, :, 0] if n else np.zeros((self.n_patients, 0))
+        d = np.sqrt(np.maximum(self.variance + self.noise - np.sum(c ** 2, axis=1), 1e-12))
+        c[~active] = 0.0
+        d[~active] = 1.0
+        residual = np.where(active, y - self.prior_mean(x), 0.0)
+
+        self.X[:, n] = x
+        self.observed[:, n] = active
+        self.L[:, n, :n] = c
+        self.L[:, n, n] = d
+        self.v[:, n] = (residual - np.sum(c * self.v[:, :n], axis=1)) / d
+        self.n = n + 1
+        return self
+
+    def predict(self, Xs):
+        """
+        posterior mean and standard deviation of the observed value at Xs
+        :param Xs: (P, m, D) or (P, m) inputs
+        :return: (P, m) mean, (P, m) sigma
+        """
+        Xs = np.asarray(Xs, dtype=float)
+        if Xs.ndim == 2:
+            Xs = Xs[:, :, None]
+        mean = self.prior_mean(Xs)
+        var = np.full(mean.shape, self.variance + self.noise)
+        if self.n:
+            W = forward_solve(self.L, self._cross(Xs), self.n)
+            mean = mean + np.einsum('pnm,pn->pm', W, self.v[:, :self.n])
+            var = var - np.sum(W ** 2, axis=1)
+        return mean, np.sqrt(np.maximum(var, 0.0))
+
+
+def pad_cohort(cohort):
+    """
+    :param cohort: {patient: (x, time_to_pass)} with one row of x per observation
+    :return: patients, (P, N, D) x, (P, N) time_to_pass, (P,) observation counts
+    """
+    patients = list(cohort)
+    counts = np.array([len(cohort[p][1]) for p in patients])
+    N = int(counts.max()) if len(counts) else 0
+    D = max((np.asarray(cohort[p][0]).reshape(len(cohort[p][1]), -1).shape[1] for p in patients), default=1)
+    X = np.zeros((len(patients), N, D))
+    y = np.zeros((len(patients), N))
+    for i, p in enumerate(patients):
+        x, t2p = cohort[p]
+        X[i, :counts[i]] = np.asarray(x, dtype=float).reshape(counts[i], -1)
+        y[i, :counts[i]] = t2p
+    return patients, X, y, counts
+
+
+def sequential_predictions(gp, X, y, counts):
+    """
+    predict each observation from the ones before it, adding it to the GPs once predicted
+    :param gp: an empty BatchedGP with one patient per row of X
+    :return: (P, N) predicted, (P, N) sigma
+    """
+    P, N, _ = X.shape
+    predicted = np.zeros((P, N))
+    sigma = np.zeros((P, N))
+    for j in range(N):
+        active = counts > j
+        mean, std = gp.predict(X[:, j:j + 1])
+        predicted[:, j] = mean[:, 0]
+        sigma[:, j] = std[:, 0]
+        gp.append(X[:, j], y[:, j], active)
+    return predicted, sigma
+
+
+def fit_prior(X, y, counts):
+    """
+    least squares line of time to pass against elapsed time over the whole cohort, used as the prior mean
+    """
+    mask = np.arange(X.shape[1])[None, :] < counts[:, None]
+    A = np.column_stack([np.ones(mask.sum()), X[..., 0][mask]])
+    (offset, slope), *_ = np.linalg.lstsq(A, y[mask], rcond=None)
+    return float(offset), float(slope)
+
+
+def save_plots(out_dir, x, time_to_pass, predicted, sigma, prefix="gpm_plot"):
+    """
+    one npz per observation count, the k-th holding the first k + 1 observations, as read by Figures.ipynb
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for k in range(len(time_to_pass)):
+        file = out_dir / f"{prefix}_{k}.npz"
+        np.savez(file, x=x[:k + 1], time_to_pass=time_to_pass[:k + 1], predicted=predicted[:k + 1],
+                 sigma=sigma[:k + 1])
+        log.info(f"saved {file}")
+
+
+def load_cohort(csv_file, features=None):
+    """
+    {patient: (x, time_to_pass)} from a csv with patient, x and time_to_pass columns, one row per observation.
+    :param features: columns used as the GP input, x when None
+    """
+    features = features or ['x']
+    rows = defaultdict(list)
+    with open(csv_file, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            rows[row['patient']].append(row)
+    cohort = {}
+    for patient, observations in rows.items():
+        observations.sort(key=lambda r: float(r['x']))
+        cohort[patient] = (np.array([[float(r[c]) for c in features] for r in observations]),
+                           np.array([float(r['time_to_pass']) for r in observations]))
+    return cohort
+
+
+def main(csv_file, out_dir, patient=None, length_scale=5.0, variance=25.0, noise=0.1):
+    cohort = load_cohort(csv_file)
+    patients, X, y, counts = pad_cohort(cohort)
+    offset, slope = fit_prior(X, y, counts)
+    log.info(f"{len(patients)} patients, {counts.sum()} observations, prior mean {offset:.2f} + {slope:.2f} x")
+    gp = BatchedGP(len(patients), X.shape[2], length_scale, variance, noise, offset, slope)
+    predicted, sigma = sequential_predictions(gp, X, y, counts)
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    np.savez(out_dir / "gpm_predictions.npz", patients=np.array(patients), x=X[..., 0], time_to_pass=y,
+             predicted=predicted, sigma=sigma, counts=counts)
+    mask = np.arange(X.shape[1])[None, :] < counts[:, None]
+    log.info(f"mean absolute error {np.abs(predicted - y)[mask].mean():.2f} days")
+    if patient is not None:
+        i = patients.index(patient)
+        save_plots(out_dir, X[i, :counts[i], 0], y[i, :counts[i]], predicted[i, :counts[i]], sigma[i, :counts[i]])
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='sequential GP time to pass predictions for a cohort')
+    parser.add_argument('csv_file', help='csv with patient, x (elapsed days) and time_to_pass columns')
+    parser.add_argument('--out', help='output directory', default='./data')
+    parser.add_argument('--patient', help='write the gpm_plot_*.npz files of this patient', default=None)
+    parser.add_argument('--length_scale', default=5.0, type=float)
+    parser.add_argument('--variance', default=25.0, type=float)
+    parser.add_argument('--noise', default=0.1, type=float)
+    args = parser.parse_args()
+    main(args.csv_file, args.out, args.patient, args.length_scale, args.variance, args.noise)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Nearest-neighbour search over the siamese embeddings in an embedding store, to find the prior cases most similar to a
+new study. Exact search scores the queries against the store one block of rows at a time with a single matrix
+multiply per block, keeping a running top k. For large cohorts an inverted file (IVF) index clusters the embeddings
+with k-means and only scores the rows in the nprobe clusters nearest each query.
+
+The index lives beside the store, in its index directory
+    index.json       metric, number of clusters and the number of store rows assigned
+    centroids.npy    the cluster centres
+    lists.raw        int32 cluster of each store row, back to back
+New embeddings are assigned to their nearest cluster by update, without retraining. Rows appended to the store since
+the last update are always scored exactly, so a search never misses them.
+
+    python axr/similarity.py /data/embeddings/epoch_40 --train 256
+    python axr/similarity.py /data/embeddings/epoch_40 --query case_0012 case_0107 --k 10
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import json
+import logging
+import argparse
+import numpy as np
+from pathlib import Path
+from embeddings import EmbeddingStore, locked, BATCH_SIZE
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+INDEX_DIR = "index"
+INDEX_FILE = "index.json"
+CENTROIDS_FILE = "centroids.npy"
+LISTS_FILE = "lists.raw"
+METRICS = ('cosine', 'euclidean')
+BLOCK_SIZE = 8192
+TRAIN_SAMPLE = 65536
+NPROBE = 8
+
+
+def normalise(X):
+    X = np.asarray(X, dtype=np.float32)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    return X / np.where(norms > 0, norms, 1)
+
+
+def similarity(Q, X, metric='cosine'):
+    """
+    (len(Q), len(X)) scores, higher is more similar: the cosine similarity, or the negative squared euclidean distance
+    """
+    Q = np.asarray(Q, dtype=np.float32)
+    X = np.asarray(X, dtype=np.float32)
+    if metric == 'cosine':
+        return normalise(Q) @ normalise(X).T
+    if metric == 'euclidean':
+        return 2 * Q @ X.T - np.sum(Q ** 2, axis=1)[:, None] - np.sum(X ** 2, axis=1)[None, :]
+    raise ValueError(f"unknown metric {metric}, use one of {METRICS}")
+
+
+def block_knn(queries, vectors, k=10, metric='cosine', rows=None, block_size=BLOCK_SIZE):
+    """
+    exact k nearest neighbours of each query, reading vectors one block of rows at a time
+    :param queries: (n, dim) query vectors
+    :param vectors: (count, dim) array or np.memmap to search
+    :param rows: row numbers of vectors to search, all of them by default
+    :return: (n, k) row numbers and scores, best first. Rows are -1 and scores -inf when there are fewer than k rows
+    """
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    rows = np.arange(len(vectors)) if rows is None else np.asarray(rows, dtype=np.int64)
+    best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        best_rows, best_scores = merge_top(best_rows, best_scores, block, similarity(queries, vectors[block], metric))
+    return sort_top(best_rows, best_scores)
+
+
+def merge_top(best_rows, best_scores, block, scores):
+    """
+    the running top k of each query updated with the scores of a block of rows
+    """
+    k = best_rows.shape[1]
+    scores = np.hstack([best_scores, scores])
+    candidates = np.hstack([best_rows, np.broadcast_to(block, (len(best_rows), len(block)))])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(candidates, top, axis=1), np.take_along_axis(scores, top, axis=1)
+
+
+def sort_top(best_rows, best_scores):
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+def kmeans(X, n_clusters, metric='cosine', n_iter=20, seed=0):
+    """
+    Lloyd's k-means of the rows of X, spherical for the cosine metric
+    :return: (n_clusters, dim) centroids
+    """
+    X = normalise(X) if metric == 'cosine' else np.asarray(X, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(X))
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = block_knn(X, centroids, 1, metric)[0][:, 0]
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, X)
+        # an empty cluster restarts at a random row
+        empty = counts == 0
+        sums[empty] = X[rng.choice(len(X), int(empty.sum()))]
+        counts[empty] = 1
+        updated = sums / counts[:, None]
+        if metric == 'cosine':
+            updated = normalise(updated)
+        if np.allclose(updated, centroids, atol=1e-6):
+            break
+        centroids = updated
+    return centroids
+
+
+def write_index_header(path, header):
+    tmp_file = Path(path) / f"{INDEX_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_file, Path(path) / INDEX_FILE)
+
+
+class SimilarityIndex(object):
+    """
+    IVF index over an EmbeddingStore. `lists` is an np.memmap of the cluster of each of the first `count` store
+    rows. Only the newest embedding of each case is returned by a search.
+    """
+    def __init__(self, store, path, metric, centroids, count):
+        self.store = store
+        self.path = Path(path)
+        self.metric = metric
+        self.centroids = centroids
+        self.count = count
+        self._lists = None
+
+    @classmethod
+    def open(cls, store, path=None, metric='cosine'):
+        """
+        open the index of a store, creating an untrained one for the given metric if it does not exist
+        :param store: EmbeddingStore or its directory
+        """
+        store = store if isinstance(store, EmbeddingStore) else EmbeddingStore.open(store)
+        path = Path(path or store.path / INDEX_DIR)
+        if not (path / INDEX_FILE).is_file():
+            if metric not in METRICS:
+                raise ValueError(f"unknown metric {metric}, use one of {METRICS}")
+            path.mkdir(parents=True, exist_ok=True)
+            with locked(path):
+                write_index_header(path, {'metric': metric, 'n_lists': 0, 'count': 0})
+                (path / LISTS_FILE).touch()
+            log.info(f"created {metric} similarity index {path}")
+        with locked(path):
+            with open(path / INDEX_FILE, 'r') as f:
+                header = json.load(f)
+            centroids = np.load(path / CENTROIDS_FILE) if header['n_lists'] else None
+        return cls(store, path, header['metric'], centroids, header['count'])
+
+    @property
+    def n_lists(self):
+        return 0 if self.centroids is None else len(self.centroids)
+
+    @property
+    def lists(self):
+        if self.count == 0:
+            return np.empty(0, dtype=np.int32)
+        if self._lists is None or len(self._lists) != self.count:
+            self._lists = np.memmap(self.path / LISTS_FILE, dtype=np.int32, mode='r', shape=(self.count,))
+        return self._lists
+
+    def train(self, n_lists=None, sample=TRAIN_SAMPLE, n_iter=20, seed=0):
+        """
+        cluster a sample of the embeddings into n_lists clusters, about the square root of the cohort by default,
+        and assign every row again
+        """
+        self.store = EmbeddingStore.open(self.store.path)
+        rows = self.store.latest()
+        if len(rows) == 0:
+            raise ValueError(f"no embeddings in {self.store.path} to train the index on")
+        n_lists = n_lists or max(1, int(np.sqrt(len(rows))))
+        rng = np.random.default_rng(seed)
+        if len(rows) > sample:
+            rows = np.sort(rng.choice(rows, sample, replace=False))
+        centroids = kmeans(self.store.embeddings[rows], n_lists, self.metric, n_iter, seed)
+        with locked(self.path):
+            np.save(self.path / CENTROIDS_FILE, centroids)
+            write_index_header(self.path, {'metric': self.metric, 'n_lists': len(centroids), 'count': 0})
+        self.centroids = centroids
+        self.count = 0
+        log.info(f"trained {len(centroids)} clusters on {len(rows)} embeddings of {self.store.path}")
+        return self.update()
+
+    def update(self, batch_size=BATCH_SIZE):
+        """
+        assign the rows appended to the store since the last update to their nearest cluster
+        """
+        self.store = EmbeddingStore.open(self.store.path)
+        if self.centroids is None:
+            return self
+        with locked(self.path):
+            with open(self.path / INDEX_FILE, 'r') as f:
+                header = json.load(f)
+            count = header['count']
+            with open(self.path / LISTS_FILE, 'r+b') as f:
+                f.truncate(count * np.dtype(np.int32).itemsize)
+                f.seek(0, os.SEEK_END)
+                for start in range(count, self.store.count, batch_size):
+                    vectors = self.store.embeddings[start:start + batch_size]
+                    f.write(block_knn(vectors, self.centroids, 1, self.metric)[0][:, 0].astype(np.int32).tobytes())
+            header['count'] = self.store.count
+            write_index_header(self.path, header)
+        if self.store.count > count:
+            log.debug(f"assigned {self.store.count - count} embeddings to the index {self.path}")
+        self.count = self.store.count
+        return self
+
+    def add(self, keys, vectors):
+        """
+        append new embeddings to the store and assign them to the index
+        """
+        self.store.append(keys, vectors)
+        return self.update()
+
+    def inverted_lists(self, rows):
+        """
+        rows grouped by cluster, and the offset of each cluster in them
+        """
+        clusters = self.lists[rows]
+        order = np.argsort(clusters, kind='stable')
+        offsets = np.searchsorted(clusters[order], np.arange(self.n_lists + 1))
+        return rows[order], offsets
+
+    def probe(self, queries, rows, k, nprobe):
+        """
+        top k of the queries among the rows in their nprobe nearest clusters and the rows not yet assigned.
+        Each cluster is scored against all the queries probing it with one matrix multiply.
+        """
+        embeddings = self.store.embeddings
+        indexed, offsets = self.inverted_lists(rows[rows < self.count])
+        best_rows, best_scores = block_knn(queries, embeddings, k, self.metric, rows[rows >= self.count])
+        probes = block_knn(queries, self.centroids, nprobe, self.metric)[0]
+        order = np.argsort(probes.ravel(), kind='stable')
+        probing, clusters = order // nprobe, probes.ravel()[order]
+        bounds = np.searchsorted(clusters, np.arange(self.n_lists + 1))
+        for c in range(self.n_lists):
+            members = indexed[offsets[c]:offsets[c + 1]]
+            selected = probing[bounds[c]:bounds[c + 1]]
+            if len(members) == 0 or len(selected) == 0:
+                continue
+            best_rows[selected], best_scores[selected] = merge_top(
+                best_rows[selected], best_scores[selected], members,
+                similarity(queries[selected], embeddings[members], self.metric))
+        return sort_top(best_rows, best_scores)
+
+    def search(self, queries, k=10, nprobe=NPROBE, exact=False, batch_size=BATCH_SIZE):
+        """
+        the k cases most similar to each query
+        :param queries: (n, dim) embeddings
+        :param nprobe: number of clusters searched for each query
+        :param exact: score every case, as when the index is untrained
+        :return: list of the keys of each query, best first, and (n, k) scores, -inf past the cases found
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        rows = self.store.latest()
+        embeddings = self.store.embeddings
+        if exact or self.centroids is None or nprobe >= self.n_lists:
+            results = [block_knn(queries[start:start + batch_size], embeddings, k, self.metric, rows)
+                       for start in range(0, len(queries), batch_size)]
+        else:
+            results = [self.probe(queries[start:start + batch_size], rows, k, nprobe)
+                       for start in range(0, len(queries), batch_size)]
+        found = np.vstack([r for r, _ in results]) if results else np.empty((0, k), dtype=np.int64)
+        scores = np.vstack([s for _, s in results]) if results else np.empty((0, k), dtype=np.float32)
+        keys = [[self.store.keys[row] for row in query_rows if row >= 0] for query_rows in found]
+        return keys, scores
+
+
+def main(store_dir, queries=None, k=10, nprobe=NPROBE, n_lists=None, train=False, exact=False, metric='cosine'):
+    index = SimilarityIndex.open(store_dir, metric=metric)
+    if train:
+        index.train(n_lists)
+    else:
+        index.update()
+    if queries:
+        # one more neighbour is asked for as each case finds itself
+        keys, scores = index.search(index.store.get(queries), k + 1, nprobe, exact)
+        for query, neighbours, query_scores in zip(queries, keys, scores):
+            similar = [(key, float(score)) for key, score in zip(neighbours, query_scores) if key != query][:k]
+            log.info(f"{query} : " + ", ".join(f"{key} {score:.4f}" for key, score in similar))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='nearest-neighbour search over the siamese embeddings')
+    parser.add_argument('store_dir', help='embedding store directory')
+    parser.add_argument('--query', help='cases to find the most similar cases to', nargs='*', default=None)
+    parser.add_argument('--k', help='number of similar cases', default=10, type=int)
+    parser.add_argument('--nprobe', help='number of clusters searched', default=NPROBE, type=int)
+    parser.add_argument('--train', help='(re)train the index with this many clusters, 0 for sqrt of the cohort',
+                        default=None, type=int)
+    parser.add_argument('--exact', help='score every case instead of using the index', action='store_true')
+    parser.add_argument('--metric', help='metric of a new index', default='cosine', choices=METRICS)
+    args = parser.parse_args()
+    main(args.store_dir, args.query, args.k, args.nprobe, args.train or None, args.train is not None, args.exact,
+         args.metric)
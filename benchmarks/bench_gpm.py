@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the batched incremental GP in axr/gpm.py against refitting a GP per patient at every observation count.
+
+    python benchmarks/bench_gpm.py
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "axr"))
+from gpm import BatchedGP, sequential_predictions  # noqa: E402
+
+LENGTH_SCALE, VARIANCE, NOISE, OFFSET, SLOPE = 5.0, 25.0, 0.1, 12.0, -1.0
+
+
+def refit_predictions(X, y, counts):
+    """ One Cholesky factorisation per patient per observation count, as the GP was fit before. """
+    P, N, _ = X.shape
+    predicted = np.zeros((P, N))
+    sigma = np.zeros((P, N))
+    for p in range(P):
+        for j in range(counts[p]):
+            xo, xs = X[p, :j, 0], X[p, j:j + 1, 0]
+            mean = OFFSET + SLOPE * xs
+            var = VARIANCE + NOISE
+            if j:
+                K = VARIANCE * np.exp(-0.5 * (xo[:, None] - xo[None]) ** 2 / LENGTH_SCALE ** 2) + NOISE * np.eye(j)
+                ks = VARIANCE * np.exp(-0.5 * (xo[:, None] - xs[None]) ** 2 / LENGTH_SCALE ** 2)
+                L = np.linalg.cholesky(K)
+                alpha = np.linalg.solve(L.T, np.linalg.solve(L, y[p, :j] - (OFFSET + SLOPE * xo)))
+                w = np.linalg.solve(L, ks)
+                mean = mean + ks.T @ alpha
+                var = var - np.sum(w ** 2)
+            predicted[p, j] = mean[0]
+            sigma[p, j] = np.sqrt(var)
+    return predicted, sigma
+
+
+def main():
+    rng = np.random.default_rng(0)
+    for P, N in ((250, 5), (2000, 5), (2000, 20)):
+        counts = rng.integers(1, N + 1, P)
+        X = np.sort(rng.uniform(0, 15, (P, N, 1)), axis=1)
+        y = OFFSET + SLOPE * X[..., 0] + rng.normal(0, 0.5, (P, N))
+
+        start = time.perf_counter()
+        expected, _ = refit_predictions(X, y, counts)
+        refit = time.perf_counter() - start
+
+        start = time.perf_counter()
+        gp = BatchedGP(P, 1, LENGTH_SCALE, VARIANCE, NOISE, OFFSET, SLOPE)
+        predicted, _ = sequential_predictions(gp, X, y, counts)
+        batched = time.perf_counter() - start
+
+        mask = np.arange(N)[None, :] < counts[:, None]
+        assert np.allclose(predicted[mask], expected[mask])
+        print(f"{P} patients x {N} observations : refit {refit:.3f}s batched {batched:.3f}s "
+              f"({refit / batched:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
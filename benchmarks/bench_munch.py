@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of Munch attribute access against the previous exception-driven implementation,
+and of FrozenMunch as a cache key.
+
+    python benchmarks/bench_munch.py
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from munch import Munch, FrozenMunch  # noqa: E402
+
+
+class LegacyMunch(dict):
+    """ The attribute path of Munch before the fast path, for comparison. """
+    def __getattr__(self, k):
+        try:
+            return object.__getattribute__(self, k)
+        except AttributeError:
+            try:
+                return self[k]
+            except KeyError:
+                raise AttributeError(k)
+
+    def __setattr__(self, k, v):
+        try:
+            object.__getattribute__(self, k)
+        except AttributeError:
+            try:
+                self[k] = v
+            except:
+                raise AttributeError(k)
+        else:
+            object.__setattr__(self, k, v)
+
+
+CONFIG = dict(SOURCE_DIR="/data/", BET_FLAGS="-R -f 0.4 -g 0 -m", FLAIR_BET_FLAGS="-R -f 0.62 -g 0 -m",
+              FLIRT_FLAGS="-bins 256 -cost corratio -dof 12 -interp spline")
+NUMBER = 200000
+
+
+def bench(label, stmt, namespace):
+    seconds = min(timeit.repeat(stmt, globals=namespace, number=NUMBER, repeat=5))
+    print(f"{label:<40} {seconds / NUMBER * 1e9:8.1f} ns")
+    return seconds
+
+
+def main():
+    print(f"python {sys.version.split()[0]}, best of 5 x {NUMBER}")
+    legacy = None
+    for cls in (LegacyMunch, Munch, FrozenMunch):
+        namespace = {'m': cls(CONFIG)}
+        name = cls.__name__
+        seconds = bench(f"{name} get", "m.BET_FLAGS", namespace)
+        if legacy is None:
+            legacy = seconds
+        else:
+            print(f"{'':<40} {legacy / seconds:8.2f}x vs LegacyMunch")
+        if cls is not FrozenMunch:
+            bench(f"{name} set existing key", "m.BET_FLAGS = 'x'", namespace)
+            bench(f"{name} set new key", "m.NEW = 'x'", namespace)
+
+    frozen = FrozenMunch(CONFIG)
+    cache = {frozen: True}
+    bench("FrozenMunch cached hash lookup", "cache[frozen]", {'cache': cache, 'frozen': frozen})
+    bench("frozenset(items) key lookup", "cache[frozenset(d.items())]",
+          {'cache': {frozenset(CONFIG.items()): True}, 'd': CONFIG})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of munchify/unmunchify on a wide, header-dump-like document and a deeply nested one,
+against the previous recursive implementation.
+
+    python benchmarks/bench_munchify.py
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import time
+from collections.abc import Mapping
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from munch import Munch, munchify, unmunchify  # noqa: E402
+
+
+def legacy_munchify(x, factory=Munch):
+    """ The recursive munchify before the explicit-stack rewrite, for comparison. """
+    seen = dict()
+
+    def munchify_cycles(obj):
+        try:
+            return seen[id(obj)]
+        except KeyError:
+            pass
+        seen[id(obj)] = partial = pre_munchify(obj)
+        return post_munchify(partial, obj)
+
+    def pre_munchify(obj):
+        if isinstance(obj, Mapping):
+            return factory({})
+        elif isinstance(obj, list):
+            return type(obj)()
+        elif isinstance(obj, tuple):
+            type_factory = getattr(obj, "_make", type(obj))
+            return type_factory(munchify_cycles(item) for item in obj)
+        else:
+            return obj
+
+    def post_munchify(partial, obj):
+        if isinstance(obj, Mapping):
+            partial.update((k, munchify_cycles(obj[k])) for k in obj)
+        elif isinstance(obj, list):
+            partial.extend(munchify_cycles(item) for item in obj)
+        elif isinstance(obj, tuple):
+            for (item_partial, item) in zip(partial, obj):
+                post_munchify(item_partial, item)
+        return partial
+
+    return munchify_cycles(x)
+
+
+def header_dump(n_series=200, n_instances=50):
+    """ a manifest-like document with a few hundred thousand nodes """
+    return {'series': [{'SeriesInstanceUID': f"1.2.{s}",
+                        'instances': [{'SOPInstanceUID': f"1.2.{s}.{i}", 'ImagePositionPatient': [0.0, 0.0, i * 1.5],
+                                       'PixelSpacing': [0.5, 0.5], 'WindowCenter': 40, 'WindowWidth': 400}
+                                      for i in range(n_instances)]}
+                       for s in range(n_series)]}
+
+
+def nested(depth):
+    doc = cur = {}
+    for _ in range(depth):
+        cur['child'] = {'value': 1}
+        cur = cur['child']
+    return doc
+
+
+def bench(label, fn, doc, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            fn(doc)
+        except RecursionError:
+            print(f"{label:<40} RecursionError")
+            return None
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<40} {best * 1e3:9.1f} ms")
+    return best
+
+
+def main():
+    print(f"python {sys.version.split()[0]}, recursion limit {sys.getrecursionlimit()}")
+    for name, doc in (('header dump', header_dump()), ('depth 200', nested(200)), ('depth 50000', nested(50000))):
+        legacy = bench(f"legacy munchify {name}", legacy_munchify, doc)
+        current = bench(f"munchify {name}", munchify, doc)
+        if legacy and current:
+            print(f"{'':<40} {legacy / current:9.2f}x")
+        bench(f"unmunchify {name}", unmunchify, munchify(doc))
+
+
+if __name__ == '__main__':
+    main()
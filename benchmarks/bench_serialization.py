@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parse and dump throughput of the Munch JSON/YAML helpers on a manifest-like document,
+against the pure-Python PyYAML path and parse-then-munchify.
+
+    python benchmarks/bench_serialization.py
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import json
+import time
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from munch import Munch, munchify  # noqa: E402
+
+
+def manifest(n_series=100, n_instances=20):
+    return {'series': [{'SeriesInstanceUID': f"1.2.{s}", 'source': f"/data/p{s}/Head Demyelination/{s}",
+                        'aliases': [f"/data/resend/p{s}/{a}" for a in range(3)],
+                        'instances': [{'SOPInstanceUID': f"1.2.{s}.{i}", 'position': [0.0, 0.0, i * 1.5],
+                                       'window': {'center': 40, 'width': 400}}
+                                      for i in range(n_instances)]}
+                       for s in range(n_series)]}
+
+
+def bench(label, fn, size, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<45} {best * 1e3:9.1f} ms {size / best / 2 ** 20:8.2f} MB/s")
+    return best
+
+
+def main():
+    print(f"python {sys.version.split()[0]}, libyaml {'yes' if yaml.__with_libyaml__ else 'no'}")
+    doc = munchify(manifest())
+    text_json = doc.toJSON()
+    text_yaml = doc.toYAML()
+
+    bench("json.loads + munchify", lambda: munchify(json.loads(text_json)), len(text_json))
+    bench("Munch.fromJSON (object_hook)", lambda: Munch.fromJSON(text_json), len(text_json))
+    bench("Munch.toJSON", doc.toJSON, len(text_json))
+
+    bench("yaml FullLoader + munchify", lambda: munchify(yaml.load(text_yaml, Loader=yaml.FullLoader)),
+          len(text_yaml), repeat=1)
+    bench("yaml SafeLoader + munchify", lambda: munchify(yaml.load(text_yaml, Loader=yaml.SafeLoader)),
+          len(text_yaml), repeat=1)
+    bench("Munch.fromYAML", lambda: Munch.fromYAML(text_yaml), len(text_yaml))
+    bench("yaml.safe_dump", lambda: yaml.safe_dump(doc, indent=4, default_flow_style=False), len(text_yaml),
+          repeat=1)
+    bench("Munch.toYAML", doc.toYAML, len(text_yaml))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the nearest-neighbour search in axr/similarity.py: a loop over the cohort per query against the blocked
+matrix multiply search and the IVF index, with the recall of the IVF index against the exact neighbours.
+
+    python benchmarks/bench_similarity.py
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "axr"))
+from embeddings import EmbeddingStore  # noqa: E402
+from similarity import SimilarityIndex  # noqa: E402
+
+DIM, K, N_QUERIES = 128, 10, 200
+
+
+def loop_search(queries, vectors, k):
+    """ cosine similarity of each query to each case in turn, as the cohort was searched before. """
+    results = []
+    for q in queries:
+        scores = [float(q @ v / (np.linalg.norm(q) * np.linalg.norm(v))) for v in vectors]
+        results.append(np.argsort(scores)[::-1][:k])
+    return np.array(results)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    for n in (5000, 50000):
+        centres = rng.normal(size=(64, DIM))
+        X = (centres[rng.integers(0, len(centres), n)] + rng.normal(size=(n, DIM))).astype(np.float32)
+        queries = X[rng.choice(n, N_QUERIES, replace=False)] + 0.1 * rng.normal(size=(N_QUERIES, DIM))
+        with tempfile.TemporaryDirectory() as store_dir:
+            store = EmbeddingStore.open(store_dir, dim=DIM)
+            store.append([str(i) for i in range(n)], X)
+            index = SimilarityIndex.open(store).train()
+
+            start = time.perf_counter()
+            expected = loop_search(queries[:10], store.embeddings, K)
+            loop = (time.perf_counter() - start) * N_QUERIES / 10
+
+            start = time.perf_counter()
+            exact, _ = index.search(queries, K, exact=True)
+            blocked = time.perf_counter() - start
+            assert all(set(map(int, a)) == set(b) for a, b in zip(exact, expected))
+
+            start = time.perf_counter()
+            approximate, _ = index.search(queries, K)
+            ivf = time.perf_counter() - start
+            recall = np.mean([len(set(a) & set(b)) / K for a, b in zip(approximate, exact)])
+        print(f"{n} cases x {N_QUERIES} queries : loop {loop:.3f}s (estimated) blocked {blocked:.3f}s "
+              f"({loop / blocked:.1f}x) ivf {ivf:.3f}s ({loop / ivf:.1f}x, recall {recall:.3f} "
+              f"with {index.n_lists} clusters)")
+
+
+if __name__ == '__main__':
+    main()
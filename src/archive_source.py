@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Converts the series inside zip and tar study exports without extracting them. The series directories are picked from
+the member listing with the DIR_STRUCTURE glob and the SOURCE discovery rules, as if the archive had been extracted
+where it is, and the members of each series are read straight from the archive into dcmread. A series is converted
+as soon as its last member has been read, so only the series being read are held in memory. Nothing is written to
+disk except the rescaled copy of a series that still needs dcm2niix. Several archives are converted at once. With
+DEDUPLICATE a series already found in another archive, or under SOURCE_DIR when run from prepare.py, is skipped.
+
+    python src/archive_source.py /data/exports/site_a.zip /data/exports/site_b.tar.gz
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import io
+import logging
+import tarfile
+import zipfile
+import argparse
+from pathlib import Path, PurePosixPath
+from collections import defaultdict
+from multiprocessing import Manager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils import get_config, set_config, convert_dir, mirror_dir
+from dedup import fingerprint, write_manifest
+from discovery import discover, compile_pattern, rules_from_config
+from dicom_to_nifti import read_datasets
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+DEFAULT_ARCHIVES = {
+    'PATTERNS': [],
+    'WORKERS': 4,
+}
+
+
+def get_archives(config):
+    archives = dict(DEFAULT_ARCHIVES)
+    archives.update(config.get('ARCHIVES') or {})
+    return archives
+
+
+def is_archive(path):
+    return str(path).lower().endswith(ARCHIVE_SUFFIXES)
+
+
+class MemberEntry(object):
+    """
+    a directory inside an archive, standing in for the os.DirEntry the discovery rules are tested on.
+    Its size is the total size of the files in it.
+    """
+    def __init__(self, name, size):
+        self.name = name
+        self.st_size = size
+
+    def stat(self):
+        return self
+
+
+def find_archives(source_dir, config=None):
+    """
+    the archives under source_dir matching the ARCHIVES PATTERNS globs
+    """
+    config = config or get_config()
+    archives = set()
+    for pattern in get_archives(config)['PATTERNS']:
+        archives.update(file for file in discover(source_dir, pattern, n_workers=config.DISCOVERY_WORKERS)
+                        if is_archive(file))
+    return sorted(archives)
+
+
+def list_members(archive):
+    """
+    (name, size) of the files in an archive, in archive order
+    """
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            return [(info.filename, info.file_size) for info in zf.infolist() if not info.is_dir()]
+    with tarfile.open(archive, 'r:*') as tar:
+        return [(member.name, member.size) for member in tar if member.isfile()]
+
+
+def read_members(archive, wanted):
+    """
+    yield (name, bytes) of the wanted members in archive order
+    """
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.filename in wanted:
+                    yield info.filename, zf.read(info)
+        return
+    # the stream mode never seeks back, so a compressed tar is decompressed once more after its listing
+    with tarfile.open(archive, 'r|*') as tar:
+        for member in tar:
+            if member.isfile() and member.name in wanted:
+                yield member.name, tar.extractfile(member).read()
+
+
+def unsafe_member(name):
+    """
+    whether a member name is absolute or climbs out of the archive, so its series would be written outside NII_DIR
+    """
+    path = PurePosixPath(name)
+    return path.is_absolute() or '..' in path.parts
+
+
+def select_series(archive, members, config=None):
+    """
+    the series directories in an archive that DIR_STRUCTURE and the SOURCE rules pick. Members with absolute names or
+    .. in them are skipped
+    :return: {member directory: [member names]}
+    """
+    config = config or get_config()
+    rel_root = PurePosixPath(Path(archive).parent.relative_to(Path(config.SOURCE_DIR)).as_posix())
+    match = compile_pattern(config.DIR_STRUCTURE)
+    keep = rules_from_config(config, 'SOURCE')
+    groups = defaultdict(list)
+    sizes = defaultdict(int)
+    for name, size in members:
+        if unsafe_member(name):
+            log.warning(f"[{archive}] skipping member {name} outside the archive")
+            continue
+        member_dir = PurePosixPath(name).parent
+        groups[member_dir].append(name)
+        sizes[member_dir] += size
+
+    selected = {}
+    for member_dir, names in groups.items():
+        rel = (rel_root / member_dir).as_posix()
+        if match(rel) and keep(rel, MemberEntry(member_dir.name, sizes[member_dir])):
+            selected[member_dir] = names
+    return selected
+
+
+def iter_series(archive, selected):
+    """
+    yield (member directory, [members as file objects]) for each selected series once all of its members are read
+    """
+    wanted = {name: member_dir for member_dir, names in selected.items() for name in names}
+    remaining = {member_dir: len(names) for member_dir, names in selected.items()}
+    buffered = defaultdict(list)
+    for name, data in read_members(archive, wanted):
+        member_dir = wanted[name]
+        member = io.BytesIO(data)
+        member.name = name
+        buffered[member_dir].append(member)
+        remaining[member_dir] -= 1
+        if remaining[member_dir] == 0:
+            yield member_dir, sorted(buffered.pop(member_dir), key=lambda f: f.name)
+    for member_dir in buffered:
+        log.warning(f"[{archive}] ended before all of {member_dir} was read")
+
+
+def convert_archive(archive, config=None, seen=None):
+    """
+    convert the selected series of an archive, each one to the nii directory it would have had if extracted
+    :param seen: {fingerprint: canonical dir} shared between the archives being converted, a series whose fingerprint
+                 is already in it is skipped as a duplicate. None to convert every series
+    :return: (the nii directories written, {canonical dir: [alias dirs]})
+    """
+    config = config or get_config()
+    archive = Path(archive)
+    selected = select_series(archive, list_members(archive), config)
+    log.info(f"converting {len(selected)} series from [{archive}]")
+    t_dirs = []
+    aliases = {}
+    for member_dir, members in iter_series(archive, selected):
+        s_dir = archive.parent / member_dir
+        key = fingerprint(members) if seen is not None else None
+        if key is not None:
+            canonical = seen.setdefault(key, s_dir)
+            if canonical != s_dir:
+                log.info(f"duplicate series [{s_dir}] => [{canonical}]")
+                aliases.setdefault(canonical, []).append(s_dir)
+                continue
+        datasets = read_datasets(members)
+        t_dirs.append(convert_dir(s_dir, config, datasets))
+    return t_dirs, aliases
+
+
+def convert_archives(archives, config=None, n_workers=None, seen=None):
+    """
+    convert several archives at once on a process pool. With DEDUPLICATE a series is only converted if no other
+    series in the archives, or in seen, holds the same instances, and the copies are added to the duplicate manifest
+    :param seen: {fingerprint: canonical dir} of the series already kept, as filled in by find_duplicates
+    :return: {archive: nii directories}, leaving out archives that failed
+    """
+    config = config or get_config()
+    archives = list(archives)
+    n_workers = n_workers or get_archives(config)['WORKERS']
+    results = {}
+    if not archives:
+        return results
+    # the fingerprints are claimed through a manager, so two archives converted at once cannot both keep a series
+    manager = Manager() if config.DEDUPLICATE else None
+    shared = manager.dict(seen or {}) if manager is not None else None
+    aliases = {}
+    try:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(archives)), initializer=set_config,
+                                 initargs=(config,)) as executor:
+            futures = {executor.submit(convert_archive, archive, config, shared): archive for archive in archives}
+            for future in as_completed(futures):
+                archive = futures[future]
+                try:
+                    results[archive], found = future.result()
+                except Exception as e:
+                    log.error(f"failed to convert [{archive}] : {e}")
+                    continue
+                for s_dir, alias_dirs in found.items():
+                    aliases.setdefault(s_dir, []).extend(alias_dirs)
+    finally:
+        if manager is not None:
+            manager.shutdown()
+    if aliases:
+        write_manifest(config.DUPLICATES_MANIFEST, aliases,
+                       lambda x: mirror_dir(x, Path(config.SOURCE_DIR), Path(config.NII_DIR)))
+    log.info(f"converted {sum(map(len, results.values()))} series from {len(results)}/{len(archives)} archives, "
+             f"skipped {sum(map(len, aliases.values()))} duplicates")
+    return results
+
+
+def main(archives=None, n_workers=None):
+    config = get_config()
+    archives = archives or find_archives(Path(config.SOURCE_DIR), config)
+    convert_archives(archives, config, n_workers)
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert the series in zip and tar archives without extracting them')
+    parser.add_argument('archives', help='archives under SOURCE_DIR, by default those matching ARCHIVES PATTERNS',
+                        nargs='*', type=Path)
+    parser.add_argument('--n_workers', help='number of archives converted at once', default=None, type=int)
+    args = parser.parse_args()
+    main(args.archives, args.n_workers)
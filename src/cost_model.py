@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Historical runtime model used to submit the longest process_mri tasks first
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import re
+import json
+import heapq
+import logging
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from datetime import datetime
+from collections import defaultdict, deque
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+SEQUENCE_PATTERNS = [
+    ('FLAIR', re.compile(r'flair', re.IGNORECASE)),
+    ('DWI', re.compile(r'dwi|diff|adc|trace', re.IGNORECASE)),
+    ('SWI', re.compile(r'swi|swan', re.IGNORECASE)),
+    ('T1', re.compile(r't1|mprage|spgr', re.IGNORECASE)),
+    ('T2', re.compile(r't2', re.IGNORECASE)),
+]
+# fewer samples than this and a group falls back to a runtime per voxel
+MIN_FIT_SAMPLES = 5
+MAX_HISTORY = 5000
+
+
+def sequence_type(source_file):
+    name = Path(source_file).name
+    for sequence, pattern in SEQUENCE_PATTERNS:
+        if pattern.search(name):
+            return sequence
+    return 'OTHER'
+
+
+def input_features(source_file):
+    """
+    cheap features of a nii file: voxel count from the header, file size and sequence type
+    """
+    source_file = Path(source_file)
+    try:
+        voxels = int(np.prod(nib.load(source_file).header.get_data_shape()))
+    except Exception as e:
+        log.warning(f"cannot read header of {source_file} : {e}")
+        voxels = 0
+    return {'voxels': voxels, 'size': source_file.stat().st_size, 'sequence': sequence_type(source_file)}
+
+
+class CostModel(object):
+    """
+    Per stage least squares fit of runtime against voxel count and file size,
+    grouped by sequence type when there is enough history for it.
+    """
+    def __init__(self, records=()):
+        self.records = defaultdict(lambda: deque(maxlen=MAX_HISTORY))
+        for record in records:
+            self.records[(record['stage'], record['sequence'])].append(record)
+        self.fits = {}
+        self.fit()
+
+    @classmethod
+    def load(cls, history_file):
+        records = []
+        history_file = Path(history_file)
+        if history_file.is_file():
+            with open(history_file, 'r') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        log.warning(f"skipping bad line in {history_file}")
+        log.info(f"loaded {len(records)} runtime records from {history_file}")
+        return cls(records)
+
+    def fit(self):
+        by_stage = defaultdict(list)
+        for (stage, sequence), records in self.records.items():
+            by_stage[stage].extend(records)
+            self.fits[(stage, sequence)] = self._fit(records)
+        for stage, records in by_stage.items():
+            self.fits[(stage, None)] = self._fit(records)
+        return self
+
+    @staticmethod
+    def _fit(records):
+        if not records:
+            return None
+        voxels = np.array([r['voxels'] for r in records], dtype=float)
+        seconds = np.array([r['seconds'] for r in records], dtype=float)
+        if len(records) < MIN_FIT_SAMPLES:
+            rate = seconds.sum() / max(voxels.sum(), 1.0)
+            return np.array([0.0, rate, 0.0])
+        X = np.column_stack([np.ones_like(voxels), voxels, [r['size'] for r in records]])
+        coef, *_ = np.linalg.lstsq(X, seconds, rcond=None)
+        return coef
+
+    def predict(self, features, stages):
+        """
+        predicted runtime in seconds of running stages on a file with the given features
+        """
+        x = np.array([1.0, features['voxels'], features['size']])
+        total = 0.0
+        for stage in stages:
+            coef = self.fits.get((stage, features['sequence']))
+            if coef is None:
+                coef = self.fits.get((stage, None))
+            if coef is not None:
+                total += max(float(x @ coef), 0.0)
+        return total
+
+    def append(self, history_file, source_file, features, timings):
+        """
+        record the runtime of every stage that ran on source_file
+        """
+        stamp = datetime.now().isoformat()
+        with open(history_file, 'a') as f:
+            for stage, seconds in timings.items():
+                record = dict(features, file=Path(source_file).as_posix(), stage=stage, seconds=seconds, time=stamp)
+                self.records[(stage, features['sequence'])].append(record)
+                f.write(json.dumps(record) + "\n")
+
+
+def longest_first(files, predictions):
+    """
+    order files by decreasing predicted runtime
+    """
+    return [file for _, file in sorted(zip(predictions, files), key=lambda x: -x[0])]
+
+
+def bin_pack(files, predictions, n_bins):
+    """
+    longest processing time first packing of files into n_bins lists with balanced predicted runtime
+    """
+    bins = [[] for _ in range(n_bins)]
+    # ties on load go to the bin with fewest files, so files with no prediction are spread round robin
+    loads = [(0.0, 0, i) for i in range(n_bins)]
+    for prediction, file in sorted(zip(predictions, files), key=lambda x: -x[0]):
+        load, _, i = heapq.heappop(loads)
+        bins[i].append(file)
+        heapq.heappush(loads, (load + prediction, len(bins[i]), i))
+    log.info(f"predicted bin loads : {sorted(round(load) for load, _, _ in loads)}")
+    return [b for b in bins if b]
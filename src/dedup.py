@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Detects DICOM series that have been sent more than once so that each one is only converted once
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import hashlib
+import logging
+import yaml
+from pathlib import Path
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+from concurrent.futures import ThreadPoolExecutor
+from pydicom import dcmread
+from pydicom.errors import InvalidDicomError
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+FINGERPRINT_TAGS = ['SeriesInstanceUID', 'SOPInstanceUID', 'PixelData']
+
+
+def fingerprint(files):
+    """
+    fingerprint one series from its Series/SOP Instance UIDs and a hash of the pixel data
+    :param files: paths or binary file objects of the files of the series, file objects are rewound after reading
+    :return: (series uids, digest) or None if none of the files is DICOM
+    """
+    series_uids = set()
+    instances = []
+    for file in files:
+        try:
+            dcm = dcmread(file, specific_tags=FINGERPRINT_TAGS)
+        except InvalidDicomError:
+            log.debug(f"not a DICOM file : [{getattr(file, 'name', file)}]")
+            continue
+        finally:
+            if hasattr(file, 'seek'):
+                file.seek(0)
+        series_uids.add(str(dcm.get('SeriesInstanceUID', '')))
+        pixel_hash = hashlib.sha1(dcm.PixelData).hexdigest() if 'PixelData' in dcm else ''
+        instances.append((str(dcm.get('SOPInstanceUID', '')), pixel_hash))
+
+    if not instances:
+        return None
+    digest = hashlib.sha1()
+    for sop_uid, pixel_hash in sorted(instances):
+        digest.update(f"{sop_uid}:{pixel_hash}\n".encode())
+    return "|".join(sorted(series_uids)), digest.hexdigest()
+
+
+def series_fingerprint(s_dir):
+    """
+    fingerprint a series directory
+    :param s_dir: directory holding the DICOM files of one series
+    :return: (series uids, digest) or None if the directory holds no DICOM files
+    """
+    return fingerprint(file for file in sorted(Path(s_dir).iterdir()) if file.is_file())
+
+
+def find_duplicates(dirs, n_workers=None, seen=None):
+    """
+    group series directories that hold the same instances
+    :param dirs: series directories, the first of each group is kept as the canonical copy
+    :param n_workers: number of threads used to fingerprint the directories
+    :param seen: {fingerprint: canonical dir} of series kept already, the canonical dirs found here are added to it
+    :return: (canonical dirs in their original order, {canonical dir: [alias dirs]})
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        keys = list(executor.map(series_fingerprint, dirs))
+
+    canonical = {} if seen is None else seen
+    aliases = {}
+    unique = []
+    for s_dir, key in zip(dirs, keys):
+        if key is None:
+            unique.append(s_dir)
+        elif key in canonical:
+            log.info(f"duplicate series [{s_dir}] => [{canonical[key]}]")
+            aliases.setdefault(canonical[key], []).append(s_dir)
+        else:
+            canonical[key] = s_dir
+            unique.append(s_dir)
+    log.info(f"found {sum(map(len, aliases.values()))} duplicate series in {len(dirs)} directories")
+    return unique, aliases
+
+
+def write_manifest(manifest_file, aliases, target_dir):
+    """
+    record the aliases of each canonical series, merging with any manifest from an earlier run
+    :param manifest_file: yaml file holding the manifest
+    :param aliases: {canonical dir: [alias dirs]} as returned by find_duplicates
+    :param target_dir: maps a source series directory to its converted output directory
+    :return: the merged manifest
+    """
+    manifest_file = Path(manifest_file)
+    manifest = {}
+    if manifest_file.is_file():
+        with open(manifest_file, 'r') as f:
+            manifest = yaml.load(f, Loader=SafeLoader) or {}
+
+    for s_dir, alias_dirs in aliases.items():
+        entry = manifest.setdefault(target_dir(s_dir).as_posix(), {'source': s_dir.as_posix(), 'aliases': []})
+        for a_dir in alias_dirs:
+            if a_dir.as_posix() not in entry['aliases']:
+                entry['aliases'].append(a_dir.as_posix())
+
+    with open(manifest_file, 'w') as f:
+        log.info(f"writing duplicate manifest to {f.name}")
+        yaml.dump(manifest, f, Dumper=SafeDumper, default_flow_style=False)
+    return manifest
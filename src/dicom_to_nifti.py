@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In-process DICOM to NIfTI conversion of simple series: single-frame slices of one orientation with uniform spacing
+and a single echo. The rescaled pixel arrays are stacked in memory and written with an affine built from
+ImagePositionPatient/ImageOrientationPatient, skipping the rescaled copy that dcm2niix would otherwise re-read.
+Anything else is left to dcm2niix.
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import re
+import json
+import shlex
+import string
+import logging
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from pydicom import dcmread
+from pydicom.errors import InvalidDicomError
+from pydicom.multival import MultiValue
+from rescale_dicom import rescale_dataset
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+# relative tolerance on the slice spacing and absolute tolerance on the direction cosines
+SPACING_TOLERANCE = 0.01
+ORIENTATION_TOLERANCE = 1e-4
+DEFAULT_FILENAME = "%f_%p_%t_%s"
+# LPS (DICOM) to RAS (NIfTI)
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+# (DICOM keyword, BIDS name, scale) of the header fields written to the json sidecar, times in seconds as dcm2niix
+SIDECAR_FIELDS = (
+    ('Modality', 'Modality', None),
+    ('MagneticFieldStrength', 'MagneticFieldStrength', None),
+    ('Manufacturer', 'Manufacturer', None),
+    ('ManufacturerModelName', 'ManufacturersModelName', None),
+    ('InstitutionName', 'InstitutionName', None),
+    ('PatientPosition', 'PatientPosition', None),
+    ('SeriesDescription', 'SeriesDescription', None),
+    ('ProtocolName', 'ProtocolName', None),
+    ('ImageType', 'ImageType', None),
+    ('SeriesNumber', 'SeriesNumber', None),
+    ('AcquisitionNumber', 'AcquisitionNumber', None),
+    ('SliceThickness', 'SliceThickness', None),
+    ('SpacingBetweenSlices', 'SpacingBetweenSlices', None),
+    ('EchoTime', 'EchoTime', 0.001),
+    ('RepetitionTime', 'RepetitionTime', 0.001),
+    ('InversionTime', 'InversionTime', 0.001),
+    ('FlipAngle', 'FlipAngle', None),
+    ('ImageOrientationPatient', 'ImageOrientationPatientDICOM', None),
+)
+
+
+def read_series(s_dir):
+    """
+    the datasets of a series directory with their rescaled pixel arrays, in directory order
+    """
+    return read_datasets(file for file in sorted(Path(s_dir).iterdir()) if file.is_file())
+
+
+def read_datasets(files):
+    """
+    the datasets with their rescaled pixel arrays, from paths or file-like objects. Datasets without pixel data
+    (presentation states, structured reports) are skipped, as dcm2niix skips them. A dataset whose pixels cannot be
+    decoded is kept as read, with None for its pixels, so the series goes to dcm2niix.
+    """
+    datasets = []
+    for file in files:
+        name = getattr(file, 'name', file)
+        try:
+            dcm = dcmread(file)
+        except InvalidDicomError:
+            log.debug(f"not a DICOM file : [{name}]")
+            continue
+        if 'PixelData' not in dcm:
+            log.debug(f"no pixel data : [{name}]")
+            continue
+        try:
+            pixels = rescale_dataset(dcm, name)
+            pixels = dcm.pixel_array if pixels is None else pixels
+        except Exception as e:
+            log.warning(f"cannot decode the pixel data of [{name}] : {e}")
+            # rescale_dataset may have changed the dataset before failing
+            if hasattr(file, 'seek'):
+                file.seek(0)
+            dcm, pixels = dcmread(file), None
+        datasets.append((dcm, pixels))
+    return datasets
+
+
+def unsupported(datasets):
+    """
+    :return: why the series needs dcm2niix, or None if it can be converted here
+    """
+    if len(datasets) < 2:
+        return "fewer than two slices"
+    if any(pixels is None for _, pixels in datasets):
+        return "undecodable pixel data"
+    first = datasets[0][0]
+    for key in ('ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing'):
+        if any(key not in dcm for dcm, _ in datasets):
+            return f"missing {key}"
+    if any(int(dcm.get('NumberOfFrames', 1) or 1) > 1 for dcm, _ in datasets):
+        return "multi-frame"
+    if any(int(dcm.get('SamplesPerPixel', 1)) != 1 for dcm, _ in datasets):
+        return "colour"
+    if len({str(dcm.get('SeriesInstanceUID', '')) for dcm, _ in datasets}) > 1:
+        return "more than one series"
+    if len({str(dcm.get('EchoNumbers', '')) for dcm, _ in datasets}) > 1:
+        return "multi-echo"
+    if any(pixels.shape != datasets[0][1].shape or pixels.ndim != 2 for _, pixels in datasets):
+        return "slice sizes differ"
+    orientations = np.array([[float(v) for v in dcm.ImageOrientationPatient] for dcm, _ in datasets])
+    if np.abs(orientations - orientations[0]).max() > ORIENTATION_TOLERANCE:
+        return "more than one orientation"
+    spacings = np.array([[float(v) for v in dcm.PixelSpacing] for dcm, _ in datasets])
+    if np.abs(spacings - spacings[0]).max() > SPACING_TOLERANCE * spacings[0].min():
+        return "pixel spacing differs"
+    positions = slice_positions(datasets, orientations[0])
+    gaps = np.diff(np.sort(positions))
+    if gaps.min() <= 0:
+        return "repeated slice positions"
+    if np.abs(gaps - gaps.mean()).max() > SPACING_TOLERANCE * gaps.mean():
+        return "non-uniform slice spacing"
+    ends = [datasets[i][0].ImagePositionPatient for i in (np.argmin(positions), np.argmax(positions))]
+    step = np.subtract(*[[float(v) for v in end] for end in ends[::-1]])
+    if np.linalg.norm(np.cross(step, np.cross(orientations[0][:3], orientations[0][3:]))) > \
+            SPACING_TOLERANCE * np.linalg.norm(step):
+        return "gantry tilt"
+    if first.get('PixelRepresentation', 0) not in (0, 1):
+        return "pixel representation"
+    return None
+
+
+def slice_positions(datasets, orientation):
+    normal = np.cross(orientation[:3], orientation[3:])
+    return np.array([np.dot([float(v) for v in dcm.ImagePositionPatient], normal) for dcm, _ in datasets])
+
+
+def stack_series(datasets):
+    """
+    stack the slices along the slice normal
+    :return: (columns, rows, slices) data and its RAS affine
+    """
+    first = datasets[0][0]
+    orientation = np.array([float(v) for v in first.ImageOrientationPatient])
+    # the first cosine runs along a row (increasing column), the second down a column (increasing row)
+    row_cosine, column_cosine = orientation[:3], orientation[3:]
+    order = np.argsort(slice_positions(datasets, orientation))
+    row_spacing, column_spacing = (float(v) for v in first.PixelSpacing)
+
+    data = np.stack([datasets[i][1] for i in order], axis=-1).transpose(1, 0, 2)
+    first_position = np.array([float(v) for v in datasets[order[0]][0].ImagePositionPatient])
+    last_position = np.array([float(v) for v in datasets[order[-1]][0].ImagePositionPatient])
+
+    affine = np.eye(4)
+    affine[:3, 0] = row_cosine * column_spacing
+    affine[:3, 1] = column_cosine * row_spacing
+    affine[:3, 2] = (last_position - first_position) / (len(order) - 1)
+    affine[:3, 3] = first_position
+    return np.ascontiguousarray(data), LPS_TO_RAS @ affine
+
+
+def parse_flags(dcm2niix_flags):
+    """
+    the output filename pattern, compression, json sidecar (-b) and name conflict behaviour (-w) of the dcm2niix flags
+    """
+    args = shlex.split(dcm2niix_flags or "")
+    options = {args[i]: args[i + 1] for i in range(len(args) - 1) if args[i].startswith('-')}
+    return options.get('-f', DEFAULT_FILENAME), options.get('-z', 'n') != 'n', options.get('-b', 'y'), \
+        options.get('-w', '2')
+
+
+def output_file(t_dir, name, extension, write_behaviour):
+    """
+    where to write a conversion when the name is taken, as dcm2niix -w does: 0 skips it, 1 overwrites the existing
+    file and 2 adds a letter to the name
+    :return: (file, whether to write it), file is None when every letter is taken
+    """
+    nii_file = Path(t_dir) / f"{name}{extension}"
+    if not nii_file.exists() or write_behaviour == '1':
+        return nii_file, True
+    if write_behaviour == '0':
+        return nii_file, False
+    for letter in string.ascii_lowercase:
+        nii_file = Path(t_dir) / f"{name}{letter}{extension}"
+        if not nii_file.exists():
+            return nii_file, True
+    return None, False
+
+
+def sidecar_value(value, scale=None):
+    if isinstance(value, (list, tuple, MultiValue)):
+        return [sidecar_value(v, scale) for v in value]
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    if scale is not None:
+        return round(number * scale, 6)
+    return int(number) if number.is_integer() else number
+
+
+def write_sidecar(dcm, nii_file):
+    """
+    a minimal BIDS json sidecar from the header of the first slice, named like the one dcm2niix writes
+    """
+    sidecar = {name: sidecar_value(dcm.get(keyword), scale) for keyword, name, scale in SIDECAR_FIELDS
+               if dcm.get(keyword) not in (None, '')}
+    sidecar['ConversionSoftware'] = 'dicom_to_nifti'
+    json_file = nii_file.parents[0] / re.sub(r'\.nii(\.gz)?$', '.json', nii_file.name)
+    with open(json_file, 'w') as f:
+        json.dump(sidecar, f, indent=2)
+    return json_file
+
+
+def output_name(dcm, s_dir, pattern):
+    """
+    the dcm2niix file name for the pattern, or None if it uses anything other than %f %p %t %s %d
+    """
+    values = {
+        'f': Path(s_dir).name,
+        'p': str(dcm.get('ProtocolName', '')),
+        't': f"{dcm.get('StudyDate', '')}{str(dcm.get('StudyTime', '')).split('.')[0]}",
+        's': str(dcm.get('SeriesNumber', '')),
+        'd': str(dcm.get('SeriesDescription', '')),
+    }
+    if any(token not in values for token in re.findall(r'%(.)', pattern)):
+        return None
+    name = re.sub(r'%(.)', lambda m: values[m.group(1)], pattern)
+    # dcm2niix keeps letters, digits, '-' and '.' and replaces anything else
+    return re.sub(r'[^A-Za-z0-9.\-]', '_', name)
+
+
+def convert_series(s_dir, t_dir, dcm2niix_flags="", datasets=None):
+    """
+    convert a simple series in memory
+    :param datasets: the series already read with read_datasets, otherwise it is read from s_dir
+    :return: the nii file written, or None if the series should go to dcm2niix
+    """
+    datasets = read_series(s_dir) if datasets is None else datasets
+    reason = unsupported(datasets)
+    pattern, compress, sidecar, write_behaviour = parse_flags(dcm2niix_flags)
+    name = output_name(datasets[0][0], s_dir, pattern) if datasets else None
+    if reason is None and name is None:
+        reason = f"filename pattern {pattern}"
+    if reason is None and sidecar not in ('y', 'n'):
+        reason = f"sidecar option -b {sidecar}"
+    nii_file, write = output_file(t_dir, name, '.nii.gz' if compress else '.nii', write_behaviour) \
+        if reason is None else (None, False)
+    if reason is None and nii_file is None:
+        reason = f"every suffix of {name} is taken"
+    if reason is not None:
+        log.info(f"using dcm2niix for [{s_dir}] : {reason}")
+        return None
+    if not write:
+        log.info(f"skipping [{s_dir}], {nii_file} already exists")
+        return nii_file
+
+    data, affine = stack_series(datasets)
+    img = nib.Nifti1Image(data, affine)
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    nib.save(img, nii_file)
+    if sidecar == 'y':
+        write_sidecar(datasets[0][0], nii_file)
+    log.info(f"converted [{s_dir}] => [{nii_file}] in memory")
+    return nii_file
+
+
+def compare_outputs(nii_file, reference_dir, atol=1e-3):
+    """
+    diff an in-memory conversion against the dcm2niix output in reference_dir after reorienting both to RAS
+    :return: the differences found, empty if they agree
+    """
+    references = sorted(Path(reference_dir).glob("*.nii*"))
+    if len(references) != 1:
+        return [f"dcm2niix wrote {len(references)} files"]
+    native = nib.as_closest_canonical(nib.load(nii_file))
+    reference = nib.as_closest_canonical(nib.load(references[0]))
+    differences = []
+    if native.shape != reference.shape:
+        return [f"shape {native.shape} != {reference.shape}"]
+    if not np.allclose(native.affine, reference.affine, atol=atol):
+        differences.append(f"affine differs by {np.abs(native.affine - reference.affine).max():.4f}")
+    delta = np.abs(np.asanyarray(native.dataobj, dtype=np.float64) - reference.get_fdata())
+    if delta.max() > atol:
+        differences.append(f"{np.count_nonzero(delta > atol)} voxels differ by up to {delta.max():.1f}")
+    return differences
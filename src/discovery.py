@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Finds the series directories and nii files to process by walking the tree with concurrent os.scandir calls.
+Matches are streamed back as they are found and filtered by declarative include/exclude rules
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import re
+import queue
+import logging
+import threading
+from fnmatch import fnmatchcase
+from pathlib import Path, PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+DISCOVERY_WORKERS = 16
+RULE_KEYS = ('name', 'path', 'regex', 'min_size', 'max_size')
+_DONE = object()
+
+
+def compile_rule(rule):
+    """
+    turn a rule from the config into a predicate on (relative path, os.DirEntry).
+    every key given in the rule has to match:
+        name: glob on the file name
+        path: glob on the path below the root
+        regex: regular expression searched for in the path below the root
+        min_size/max_size: bounds on the file size in bytes
+    """
+    unknown = set(rule) - set(RULE_KEYS)
+    if unknown:
+        raise ValueError(f"unknown discovery rule keys {sorted(unknown)} in {rule}")
+    tests = []
+    if 'name' in rule:
+        tests.append(lambda rel, entry, p=rule['name']: fnmatchcase(entry.name, p))
+    if 'path' in rule:
+        tests.append(lambda rel, entry, p=rule['path']: fnmatchcase(rel, p))
+    if 'regex' in rule:
+        tests.append(lambda rel, entry, r=re.compile(rule['regex']): r.search(rel) is not None)
+    if 'min_size' in rule:
+        tests.append(lambda rel, entry, n=int(rule['min_size']): entry.stat().st_size >= n)
+    if 'max_size' in rule:
+        tests.append(lambda rel, entry, n=int(rule['max_size']): entry.stat().st_size <= n)
+    return lambda rel, entry: all(test(rel, entry) for test in tests)
+
+
+def compile_rules(include=None, exclude=None):
+    """
+    build a single predicate from lists of include and exclude rules.
+    an entry is kept if it matches any include rule (or there are none) and no exclude rule
+    """
+    include = [compile_rule(r) for r in include or []]
+    exclude = [compile_rule(r) for r in exclude or []]
+
+    def keep(rel, entry):
+        if include and not any(rule(rel, entry) for rule in include):
+            return False
+        return not any(rule(rel, entry) for rule in exclude)
+    return keep
+
+
+def rules_from_config(config, section):
+    """
+    the include/exclude predicate for a section (SOURCE or NII) of the DISCOVERY config
+    """
+    rules = (config.get('DISCOVERY') or {}).get(section) or {}
+    return compile_rules(rules.get('INCLUDE'), rules.get('EXCLUDE'))
+
+
+def _closure(parts, states):
+    # a '**' component may also match no directories at all
+    states = set(states)
+    pending = list(states)
+    while pending:
+        i = pending.pop()
+        if i < len(parts) and parts[i] == '**' and i + 1 not in states:
+            states.add(i + 1)
+            pending.append(i + 1)
+    return frozenset(states)
+
+
+def _advance(parts, states, name):
+    # the pattern positions still reachable once name has been matched
+    new = set()
+    for i in states:
+        if i == len(parts):
+            continue
+        if parts[i] == '**':
+            new.add(i)
+        elif fnmatchcase(name, parts[i]):
+            new.add(i + 1)
+    return _closure(parts, new)
+
+
+def compile_pattern(pattern, prefix=False):
+    """
+    the glob pattern of discover as a predicate on a relative path, for paths that are not on disk
+    :param prefix: also accept a directory that a match could be below, as discover would scan it
+    """
+    parts = PurePosixPath(pattern).parts
+
+    def match(rel):
+        states = _closure(parts, {0})
+        for name in PurePosixPath(rel).parts:
+            states = _advance(parts, states, name)
+            if not states:
+                return False
+        return len(parts) in states or (prefix and any(i < len(parts) for i in states))
+    return match
+
+
+def discover(root, pattern, keep=None, want_dirs=False, n_workers=DISCOVERY_WORKERS):
+    """
+    walk root with a thread pool of os.scandir calls and yield every path matching the glob pattern.
+    directories that cannot lead to a match are never scanned, and paths are yielded as soon as they
+    are found so the caller can start working before the walk finishes.
+    :param root: directory to walk
+    :param pattern: glob relative to root, eg. "*/Head Demyelination/*/*.nii.gz"
+    :param keep: predicate from compile_rules applied to every match
+    :param want_dirs: yield matching directories instead of files
+    :param n_workers: number of scanning threads
+    :return: generator of Path
+    """
+    root = Path(root)
+    parts = PurePosixPath(pattern).parts
+    results = queue.Queue()
+    lock = threading.Lock()
+    pending = [0]
+
+    def scan(directory, rel_dir, states):
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    next_states = _advance(parts, states, entry.name)
+                    if not next_states:
+                        continue
+                    rel = f"{rel_dir}{entry.name}"
+                    is_dir = entry.is_dir()
+                    if len(parts) in next_states and is_dir == want_dirs and (keep is None or keep(rel, entry)):
+                        results.put(Path(entry.path))
+                    if is_dir and any(i < len(parts) for i in next_states):
+                        submit(entry.path, f"{rel}/", next_states)
+        except OSError as e:
+            log.warning(f"cannot scan [{directory}] : {e}")
+        finally:
+            with lock:
+                pending[0] -= 1
+                finished = pending[0] == 0
+            if finished:
+                results.put(_DONE)
+
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+
+    def submit(directory, rel_dir, states):
+        with lock:
+            pending[0] += 1
+        executor.submit(scan, directory, rel_dir, states)
+
+    try:
+        submit(root, "", _closure(parts, {0}))
+        while True:
+            path = results.get()
+            if path is _DONE:
+                break
+            yield path
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
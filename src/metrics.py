@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Live progress of a process_mri run: the workers send task and stage events to the parent over a queue, and the parent
+keeps per stage counts, rolling throughput, ETA and worker utilisation. They are served in the Prometheus text format
+on a local HTTP endpoint and logged as a periodic summary.
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+DEFAULT_METRICS = {
+    'HOST': '127.0.0.1',
+    'PORT': 0,
+    'INTERVAL': 60,
+    'WINDOW': 300,
+}
+PREFIX = "insightmri"
+# set in each worker by init_events
+_EVENTS = None
+
+
+def get_metrics_config(config):
+    settings = dict(DEFAULT_METRICS)
+    settings.update(config.get('METRICS') or {})
+    return settings
+
+
+def init_events(events):
+    global _EVENTS
+    _EVENTS = events
+
+
+def emit(kind, file, *args):
+    """
+    send an event to the parent, a no-op outside a worker pool
+    """
+    if _EVENTS is not None:
+        _EVENTS.put((kind, os.getpid(), time.time(), str(file)) + args)
+
+
+class Metrics(object):
+    """
+    Counts of tasks and stages in each state. A task is queued from the time it is discovered, whether or not it has
+    been handed to the pool yet, until a worker starts it. A stage is queued from then until the task starts it, or
+    finishes without reaching it.
+    """
+    def __init__(self, n_workers, window=DEFAULT_METRICS['WINDOW']):
+        self.lock = threading.Lock()
+        self.n_workers = n_workers
+        self.window = float(window)
+        self.started_at = time.time()
+        self.tasks = defaultdict(int)
+        self.expected = defaultdict(int)
+        self.stages = defaultdict(lambda: defaultdict(int))
+        self.stage_seconds = defaultdict(float)
+        self.running = {}
+        self.busy_seconds = 0.0
+        self.finished = deque()
+        self.ended = set()
+
+    def discovered(self, stages, n=1):
+        with self.lock:
+            self.tasks['discovered'] += n
+            for stage in stages:
+                self.expected[stage] += n
+
+    def handle(self, event):
+        kind, pid, stamp, file, *args = event
+        with self.lock:
+            if kind == 'task_start':
+                self.tasks['started'] += 1
+                self.running[(pid, file)] = (stamp, list(args[0]), set())
+            elif kind == 'stage_start':
+                self.stages[args[0]]['started'] += 1
+                if (pid, file) in self.running:
+                    self.running[(pid, file)][2].add(args[0])
+            elif kind == 'stage_end':
+                stage, ok, seconds = args
+                # ok is None for a stage that had nothing to do, such as registration of a file without _bet
+                self.stages[stage]['completed' if ok else 'skipped' if ok is None else 'failed'] += 1
+                self.stage_seconds[stage] += seconds
+            elif kind == 'task_end':
+                self._task_end(pid, file, args[0], stamp)
+
+    def task_lost(self, file):
+        """
+        a task whose worker died before it reported the end of the task
+        """
+        with self.lock:
+            if str(file) in self.ended:
+                return
+            for pid, running_file in list(self.running):
+                if running_file == str(file):
+                    self._task_end(pid, running_file, False, time.time())
+                    return
+            # never reported a start either
+            self.tasks['started'] += 1
+            self.tasks['failed'] += 1
+
+    def _task_end(self, pid, file, ok, stamp):
+        start, planned, started = self.running.pop((pid, file), (stamp, [], set()))
+        for stage in planned:
+            if stage not in started:
+                self.expected[stage] -= 1
+        self.tasks['completed' if ok else 'failed'] += 1
+        self.ended.add(file)
+        self.busy_seconds += stamp - start
+        self.finished.append(stamp)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            while self.finished and self.finished[0] < now - self.window:
+                self.finished.popleft()
+            elapsed = max(now - self.started_at, 1e-9)
+            running = len(self.running)
+            queued = self.tasks['discovered'] - self.tasks['started']
+            throughput = len(self.finished) / min(self.window, elapsed) * 60.0
+            busy = self.busy_seconds + sum(now - start for start, _, _ in self.running.values())
+            stages = {}
+            for stage in set(self.expected) | set(self.stages):
+                counts = self.stages[stage]
+                finished = counts['completed'] + counts['failed'] + counts['skipped']
+                stages[stage] = {'queued': max(self.expected[stage] - counts['started'], 0),
+                                 'running': counts['started'] - finished,
+                                 'completed': counts['completed'], 'failed': counts['failed'],
+                                 'seconds': self.stage_seconds[stage]}
+            return {
+                'elapsed': elapsed,
+                'tasks': {'queued': queued, 'running': running, 'completed': self.tasks['completed'],
+                          'failed': self.tasks['failed']},
+                'stages': stages,
+                'throughput': throughput,
+                'eta': (queued + running) / throughput * 60.0 if throughput else None,
+                'utilisation': busy / (self.n_workers * elapsed),
+                'busy_workers': running,
+                'workers': self.n_workers,
+            }
+
+    def prometheus(self):
+        """
+        the snapshot in the Prometheus text exposition format
+        """
+        s = self.snapshot()
+        lines = [f"# HELP {PREFIX}_tasks pipeline tasks by state",
+                 f"# TYPE {PREFIX}_tasks gauge"]
+        lines += [f'{PREFIX}_tasks{{state="{state}"}} {value}' for state, value in s['tasks'].items()]
+        lines += [f"# HELP {PREFIX}_stage_tasks stage runs by state",
+                  f"# TYPE {PREFIX}_stage_tasks gauge"]
+        for stage, counts in sorted(s['stages'].items()):
+            lines += [f'{PREFIX}_stage_tasks{{stage="{stage}",state="{state}"}} {counts[state]}'
+                      for state in ('queued', 'running', 'completed', 'failed')]
+        lines += [f"# HELP {PREFIX}_stage_seconds_total time spent in finished stage runs",
+                  f"# TYPE {PREFIX}_stage_seconds_total counter"]
+        lines += [f'{PREFIX}_stage_seconds_total{{stage="{stage}"}} {counts["seconds"]:.3f}'
+                  for stage, counts in sorted(s['stages'].items())]
+        for name, value, help_text in (
+                ('throughput_per_minute', s['throughput'], 'tasks finished per minute over the rolling window'),
+                ('eta_seconds', s['eta'] if s['eta'] is not None else float('nan'), 'estimated time to drain'),
+                ('worker_utilisation', s['utilisation'], 'share of worker time spent on tasks since the start'),
+                ('busy_workers', s['busy_workers'], 'workers running a task'),
+                ('workers', s['workers'], 'size of the worker pool'),
+                ('elapsed_seconds', s['elapsed'], 'time since the run started')):
+            lines += [f"# HELP {PREFIX}_{name} {help_text}", f"# TYPE {PREFIX}_{name} gauge",
+                      f"{PREFIX}_{name} {value:.6g}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        s = self.snapshot()
+        tasks = s['tasks']
+        eta = "?" if s['eta'] is None else f"{s['eta']:.0f}s" if s['eta'] < 120 else f"{s['eta'] / 60:.0f}m"
+        stages = " ".join(f"{stage}[{c['queued']}q {c['running']}r {c['completed']}c {c['failed']}f]"
+                          for stage, c in sorted(s['stages'].items()))
+        return (f"{tasks['completed']} done {tasks['failed']} failed {tasks['running']} running {tasks['queued']} queued"
+                f" | {s['throughput']:.1f}/min eta {eta} | workers {s['busy_workers']}/{s['workers']}"
+                f" utilisation {s['utilisation']:.0%} | {stages}")
+
+
+def metrics_handler(metrics):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(f"metrics request from {self.client_address[0]} : {format % args}")
+    return Handler
+
+
+class MetricsMonitor(object):
+    """
+    Runs the event listener, the HTTP endpoint (when PORT is set) and the periodic summary in daemon threads
+    for the duration of a with block.
+    """
+    def __init__(self, metrics, events, settings):
+        self.metrics = metrics
+        self.events = events
+        self.settings = settings
+        self.stopped = threading.Event()
+        self.threads = []
+        self.server = None
+
+    def __enter__(self):
+        if int(self.settings['PORT']):
+            try:
+                self.server = ThreadingHTTPServer((self.settings['HOST'], int(self.settings['PORT'])),
+                                                  metrics_handler(self.metrics))
+            except OSError as e:
+                # another run on this node may hold the port, the summary is still logged
+                log.warning(f"not serving metrics on {self.settings['HOST']}:{self.settings['PORT']} : {e}")
+        if self.server is not None:
+            self.server.daemon_threads = True
+            self.threads.append(threading.Thread(target=self.server.serve_forever, daemon=True))
+            log.info(f"serving metrics on http://{self.settings['HOST']}:{self.server.server_address[1]}/metrics")
+        self.threads.append(threading.Thread(target=self.listen, daemon=True))
+        self.threads.append(threading.Thread(target=self.report, daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.events.put(None)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join(timeout=5)
+        log.info(self.metrics.summary())
+        return False
+
+    def listen(self):
+        while True:
+            try:
+                event = self.events.get(timeout=1)
+            except queue.Empty:
+                continue
+            if event is None:
+                return
+            self.metrics.handle(event)
+
+    def report(self):
+        while not self.stopped.wait(float(self.settings['INTERVAL'])):
+            log.info(self.metrics.summary())
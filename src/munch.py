@@ -48,6 +48,19 @@ except importlib_metadata.PackageNotFoundError:
 
 
 
+# attribute names defined on each Munch class, so that attribute assignment can tell a method or property
+# from a key without probing with object.__getattribute__ and catching the AttributeError
+_CLASS_ATTRIBUTES = {}
+
+
+def class_attributes(cls):
+    try:
+        return _CLASS_ATTRIBUTES[cls]
+    except KeyError:
+        attributes = _CLASS_ATTRIBUTES[cls] = frozenset(dir(cls))
+        return attributes
+
+
 class Munch(dict):
     """ A dictionary that provides attribute-style access.
 
@@ -114,14 +127,11 @@ class Munch(dict):
             >>> b.lol is getattr(b, 'lol')
             True
         """
+        # normal lookup has already failed, so go straight to the keys
         try:
-            # Throws exception if not in prototype chain
-            return object.__getattribute__(self, k)
-        except AttributeError:
-            try:
-                return self[k]
-            except KeyError:
-                raise AttributeError(k)
+            return self[k]
+        except KeyError:
+            raise AttributeError(k)
 
     def __setattr__(self, k, v):
         """ Sets attribute k if it exists, otherwise sets key k. A KeyError
@@ -139,16 +149,13 @@ class Munch(dict):
                 ...
             KeyError: 'values'
         """
-        try:
-            # Throws exception if not in prototype chain
-            object.__getattribute__(self, k)
-        except AttributeError:
+        if k in class_attributes(type(self)):
+            object.__setattr__(self, k, v)
+        else:
             try:
                 self[k] = v
             except:
                 raise AttributeError(k)
-        else:
-            object.__setattr__(self, k, v)
 
     def __delattr__(self, k):
         """ Deletes attribute k if it exists, otherwise deletes key k. A KeyError
@@ -162,16 +169,13 @@ class Munch(dict):
                 ...
             AttributeError: lol
         """
-        try:
-            # Throws exception if not in prototype chain
-            object.__getattribute__(self, k)
-        except AttributeError:
+        if k in class_attributes(type(self)):
+            object.__delattr__(self, k)
+        else:
             try:
                 del self[k]
             except KeyError:
                 raise AttributeError(k)
-        else:
-            object.__delattr__(self, k)
 
     def toDict(self):
         """ Recursively converts a munch back into a dictionary.
@@ -267,6 +271,80 @@ class Munch(dict):
         return self[k]
 
 
+def freeze(x):
+    """ Converts mappings to FrozenMunch, lists and tuples to tuples and sets to frozensets, recursively.
+
+        >>> freeze({'a': [1, {'b': 2}]})
+        FrozenMunch({'a': (1, FrozenMunch({'b': 2}))})
+    """
+    if isinstance(x, FrozenMunch):
+        return x
+    elif isinstance(x, Mapping):
+        return FrozenMunch(x)
+    elif isinstance(x, tuple) and hasattr(x, '_make'):
+        return x._make(freeze(item) for item in x)
+    elif isinstance(x, (list, tuple)):
+        return tuple(freeze(item) for item in x)
+    elif isinstance(x, (set, frozenset)):
+        return frozenset(freeze(item) for item in x)
+    return x
+
+
+class FrozenMunch(Munch):
+    """ An immutable and hashable Munch. Nested mappings, lists and sets are frozen on
+        construction, so a FrozenMunch can be used as a dict key or cache key. The hash
+        is computed once, on first use.
+
+        >>> f = FrozenMunch({'bet': {'flags': ['-R', '-m']}}, n=1)
+        >>> f.bet.flags
+        ('-R', '-m')
+        >>> f.n = 2
+        Traceback (most recent call last):
+            ...
+        AttributeError: FrozenMunch is read-only, cannot set n
+        >>> f['n'] = 2
+        Traceback (most recent call last):
+            ...
+        TypeError: FrozenMunch is read-only
+        >>> hash(f) == hash(FrozenMunch(n=1, bet=FrozenMunch(flags=('-R', '-m'))))
+        True
+        >>> {f: 'cached'}[FrozenMunch.fromDict({'n': 1, 'bet': {'flags': ['-R', '-m']}})]
+        'cached'
+    """
+    __slots__ = ('__hash',)
+
+    def __init__(self, *args, **kwargs):  # pylint: disable=super-init-not-called
+        dict.update(self, ((k, freeze(v)) for k, v in iteritems(dict(*args, **kwargs))))
+        object.__setattr__(self, '_FrozenMunch__hash', None)
+
+    def __hash__(self):
+        if self.__hash is None:
+            object.__setattr__(self, '_FrozenMunch__hash', hash(frozenset(self.items())))
+        return self.__hash
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('{0} is read-only'.format(type(self).__name__))
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __setattr__(self, k, v):
+        raise AttributeError('{0} is read-only, cannot set {1}'.format(type(self).__name__, k))
+
+    def __delattr__(self, k):
+        raise AttributeError('{0} is read-only, cannot delete {1}'.format(type(self).__name__, k))
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+    @classmethod
+    def fromDict(cls, d):
+        return cls(d)
+
+    def copy(self):
+        return self
+
+
 class AutoMunch(Munch):
     def __setattr__(self, k, v):
         """ Works the same as Munch.__setattr__ but if you supply
@@ -424,6 +502,118 @@ class RecursiveMunch(DefaultFactoryMunch):
 # Should you disagree, it is not difficult to duplicate this function with
 # more aggressive coercion to suit your own purposes.
 
+_SCALAR_TYPES = frozenset((str, bytes, int, float, complex, bool, type(None)))
+_MAPPING, _LIST, _TUPLE = 0, 1, 2
+_IN_PROGRESS = object()
+
+
+def _convert(x, mapping_factory):
+    """ Copies x, replacing every mapping with mapping_factory(...) filled with the converted
+        values. Lists and tuples (and their subclasses) are copied too; anything else is kept.
+
+        Works with an explicit stack rather than recursion, so deep documents cannot hit the
+        recursion limit. Exact dict/list/tuple types and common scalars skip the isinstance checks
+        against the abstract Mapping. `seen` maps id(original) to its copy so that shared objects
+        are copied once and cycles through mappings and lists are preserved. A tuple cannot be
+        created before its items, so a cycle through a tuple raises ValueError.
+    """
+    seen = {}
+    scalar_types = _SCALAR_TYPES
+
+    def enter(obj):
+        # returns (copy, None) when obj is already finished, or (None, frame) when its items still need work
+        t = type(obj)
+        if t in scalar_types:
+            return obj, None
+        try:
+            done = seen[id(obj)]
+        except KeyError:
+            pass
+        else:
+            if done is _IN_PROGRESS:
+                raise ValueError("cannot convert a cycle through a tuple")
+            return done, None
+
+        if t is dict:
+            kind, items = _MAPPING, iter(obj.items())
+        elif (t is list or t is tuple) and all(type(item) in scalar_types for item in obj):
+            # flat sequences of scalars, eg. ImagePositionPatient, are copied in one go
+            result = seen[id(obj)] = t(obj)
+            return result, None
+        elif t is list:
+            kind, items = _LIST, iter(obj)
+        elif t is tuple:
+            kind, items = _TUPLE, iter(obj)
+        elif isinstance(obj, Mapping):
+            kind, items = _MAPPING, ((k, obj[k]) for k in iterkeys(obj))
+        elif isinstance(obj, list):
+            kind, items = _LIST, iter(obj)
+        elif isinstance(obj, tuple):
+            kind, items = _TUPLE, iter(obj)
+        else:
+            seen[id(obj)] = obj
+            return obj, None
+
+        if kind == _MAPPING:
+            result = mapping_factory({})
+        elif kind == _LIST:
+            result = t()
+        else:
+            result = []
+        seen[id(obj)] = result if kind != _TUPLE else _IN_PROGRESS
+        # frame: kind, original, copy (the collected items for a tuple), item iterator, key awaiting a value
+        return None, [kind, obj, result, items, None]
+
+    value, frame = enter(x)
+    if frame is None:
+        return value
+    stack = [frame]
+    while True:
+        frame = stack[-1]
+        kind, result, items = frame[0], frame[2], frame[3]
+        descended = False
+        if kind == _MAPPING:
+            for key, item in items:
+                if type(item) in scalar_types:
+                    result[key] = item
+                    continue
+                value, child = enter(item)
+                if child is not None:
+                    frame[4] = key
+                    stack.append(child)
+                    descended = True
+                    break
+                result[key] = value
+        else:
+            append = result.append
+            for item in items:
+                if type(item) in scalar_types:
+                    append(item)
+                    continue
+                value, child = enter(item)
+                if child is not None:
+                    stack.append(child)
+                    descended = True
+                    break
+                append(value)
+        if descended:
+            continue
+
+        # every item of this frame is converted, hand the copy to the frame below
+        stack.pop()
+        if kind == _TUPLE:
+            obj = frame[1]
+            result = getattr(obj, "_make", type(obj))(result)
+            seen[id(obj)] = result
+        if not stack:
+            return result
+        parent = stack[-1]
+        if parent[0] == _MAPPING:
+            parent[2][parent[4]] = result
+        else:
+            parent[2].append(result)
+
+
 def munchify(x, factory=Munch):
     """ Recursively transforms a dictionary into a Munch via copy.
 
@@ -443,48 +633,7 @@ def munchify(x, factory=Munch):
 
         nb. As dicts are not hashable, they cannot be nested in sets/frozensets.
     """
-    # Munchify x, using `seen` to track object cycles
-    seen = dict()
-
-    def munchify_cycles(obj):
-        # If we've already begun munchifying obj, just return the already-created munchified obj
-        try:
-            return seen[id(obj)]
-        except KeyError:
-            pass
-
-        # Otherwise, first partly munchify obj (but without descending into any lists or dicts) and save that
-        seen[id(obj)] = partial = pre_munchify(obj)
-        # Then finish munchifying lists and dicts inside obj (reusing munchified obj if cycles are encountered)
-        return post_munchify(partial, obj)
-
-    def pre_munchify(obj):
-        # Here we return a skeleton of munchified obj, which is enough to save for later (in case
-        # we need to break cycles) but it needs to filled out in post_munchify
-        if isinstance(obj, Mapping):
-            return factory({})
-        elif isinstance(obj, list):
-            return type(obj)()
-        elif isinstance(obj, tuple):
-            type_factory = getattr(obj, "_make", type(obj))
-            return type_factory(munchify_cycles(item) for item in obj)
-        else:
-            return obj
-
-    def post_munchify(partial, obj):
-        # Here we finish munchifying the parts of obj that were deferred by pre_munchify because they
-        # might be involved in a cycle
-        if isinstance(obj, Mapping):
-            partial.update((k, munchify_cycles(obj[k])) for k in iterkeys(obj))
-        elif isinstance(obj, list):
-            partial.extend(munchify_cycles(item) for item in obj)
-        elif isinstance(obj, tuple):
-            for (item_partial, item) in zip(partial, obj):
-                post_munchify(item_partial, item)
-
-        return partial
-
-    return munchify_cycles(x)
+    return _convert(x, factory)
 
 
 def unmunchify(x):
@@ -504,49 +653,7 @@ def unmunchify(x):
 
         nb. As dicts are not hashable, they cannot be nested in sets/frozensets.
     """
-
-    # Munchify x, using `seen` to track object cycles
-    seen = dict()
-
-    def unmunchify_cycles(obj):
-        # If we've already begun unmunchifying obj, just return the already-created unmunchified obj
-        try:
-            return seen[id(obj)]
-        except KeyError:
-            pass
-
-        # Otherwise, first partly unmunchify obj (but without descending into any lists or dicts) and save that
-        seen[id(obj)] = partial = pre_unmunchify(obj)
-        # Then finish unmunchifying lists and dicts inside obj (reusing unmunchified obj if cycles are encountered)
-        return post_unmunchify(partial, obj)
-
-    def pre_unmunchify(obj):
-        # Here we return a skeleton of unmunchified obj, which is enough to save for later (in case
-        # we need to break cycles) but it needs to filled out in post_unmunchify
-        if isinstance(obj, Mapping):
-            return dict()
-        elif isinstance(obj, list):
-            return type(obj)()
-        elif isinstance(obj, tuple):
-            type_factory = getattr(obj, "_make", type(obj))
-            return type_factory(unmunchify_cycles(item) for item in obj)
-        else:
-            return obj
-
-    def post_unmunchify(partial, obj):
-        # Here we finish unmunchifying the parts of obj that were deferred by pre_unmunchify because they
-        # might be involved in a cycle
-        if isinstance(obj, Mapping):
-            partial.update((k, unmunchify_cycles(obj[k])) for k in iterkeys(obj))
-        elif isinstance(obj, list):
-            partial.extend(unmunchify_cycles(v) for v in obj)
-        elif isinstance(obj, tuple):
-            for (value_partial, value) in zip(partial, obj):
-                post_unmunchify(value_partial, value)
-
-        return partial
-
-    return unmunchify_cycles(x)
+    return _convert(x, lambda d: dict())
 
 
 # Serialization
@@ -567,10 +674,14 @@ try:
         return json.dumps(self, **options)
 
     def fromJSON(cls, stream, *args, **kwargs):
-        """ Deserializes JSON to Munch or any of its subclasses.
+        """ Deserializes JSON to Munch or any of its subclasses. Every object is built as
+            a Munch by the parser's object_hook, so there is no second pass over the result.
+
+            >>> Munch.fromJSON('{"foo": [1, {"lol": true}], "hello": 42}').foo[1].lol
+            True
         """
         factory = lambda d: cls(*(args + (d,)), **kwargs)
-        return munchify(json.loads(stream), factory=factory)
+        return json.loads(stream, object_hook=factory)
 
     Munch.toJSON = toJSON
     Munch.fromJSON = classmethod(fromJSON)
@@ -584,6 +695,12 @@ try:
     import yaml
     from yaml.representer import Representer, SafeRepresenter
 
+    # the libyaml-backed loader and dumper when PyYAML was built with them
+    try:
+        from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+    except ImportError:
+        from yaml import SafeLoader, SafeDumper
+
     def from_yaml(loader, node):
         """ PyYAML support for Munches using the tag `!munch` and `!munch.Munch`.
 
@@ -628,7 +745,9 @@ try:
         """
         return dumper.represent_mapping(u('!munch.Munch'), data)
 
-    for loader_name in ("BaseLoader", "FullLoader", "SafeLoader", "Loader", "UnsafeLoader", "DangerLoader"):
+    # the libyaml loaders keep their own constructor tables, so the tags are added to them as well
+    for loader_name in ("BaseLoader", "FullLoader", "SafeLoader", "Loader", "UnsafeLoader", "DangerLoader",
+                        "CBaseLoader", "CFullLoader", "CSafeLoader", "CLoader", "CUnsafeLoader"):
         LoaderCls = getattr(yaml, loader_name, None)
         if LoaderCls is None:
             # This code supports both PyYAML 4.x and 5.x versions
@@ -662,14 +781,41 @@ try:
         opts = dict(indent=4, default_flow_style=False)
         opts.update(options)
         if 'Dumper' not in opts:
-            return yaml.safe_dump(self, **opts)
+            return yaml.dump(self, Dumper=SafeDumper, **opts)
         else:
             return yaml.dump(self, **opts)
 
+    def munch_loader(loader_class, factory, frozen=False):
+        """ A subclass of loader_class that builds factory(...) for every mapping while parsing.
+
+            Mutable Munches are yielded empty and filled afterwards, like PyYAML's own dict
+            constructor, so recursive anchors work. A frozen class cannot be filled later and is
+            built from its fully constructed mapping.
+        """
+        def construct_munch(loader, node):
+            data = factory({})
+            yield data
+            data.update(loader.construct_mapping(node))
+
+        def construct_frozen_munch(loader, node):
+            return factory(loader.construct_mapping(node, deep=True))
+
+        MunchLoader = type('MunchLoader', (loader_class,), {})
+        MunchLoader.add_constructor(u('tag:yaml.org,2002:map'), construct_frozen_munch if frozen else construct_munch)
+        return MunchLoader
+
     def fromYAML(cls, stream, *args, **kwargs):
+        """ Deserializes YAML to Munch or any of its subclasses, using the libyaml safe loader
+            when available unless a `Loader` is given. Mappings are built as Munches during
+            parsing rather than munchified afterwards.
+
+            >>> Munch.fromYAML('foo: [bar, {lol: true}]\\nhello: 42').foo[1].lol
+            True
+        """
+        loader_class = kwargs.pop('Loader', SafeLoader)
         factory = lambda d: cls(*(args + (d,)), **kwargs)
-        loader_class = kwargs.pop('Loader', yaml.FullLoader)
-        return munchify(yaml.load(stream, Loader=loader_class), factory=factory)
+        loader_class = munch_loader(loader_class, factory, frozen=issubclass(cls, FrozenMunch))
+        return yaml.load(stream, Loader=loader_class)
 
     Munch.toYAML = toYAML
     Munch.fromYAML = classmethod(fromYAML)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Packs the registered volumes into a single memory-mappable array store for model training.
+
+The store is a directory holding
+    volumes.raw   every volume back to back in C order, (count, *shape) of dtype
+    store.json    shape, dtype and the number of committed volumes
+    index.jsonl   one line of metadata (file, patient, session, sequence, labels) per volume
+Volumes are appended as series finish, and store.json is only updated once the data and index line are written,
+so a crashed append is discarded the next time the store is opened.
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import csv
+import json
+import fcntl
+import logging
+import argparse
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from contextlib import contextmanager
+from utils import get_config, ConfigError
+from discovery import discover
+from cost_model import sequence_type
+from resample import output_grid
+from registration import get_registration
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+VOLUMES_FILE = "volumes.raw"
+STORE_FILE = "store.json"
+INDEX_FILE = "index.jsonl"
+LOCK_FILE = ".lock"
+# RESOLUTION is the isotropic voxel size in mm of volumes resampled from a matrix-only registration, None for the grid
+# of REFERENCE_TEMPLATE, and INTERPOLATION the interpolation they are resampled with. _registered.nii.gz volumes are
+# always on the REFERENCE_TEMPLATE grid, so get_pack drops RESOLUTION unless REGISTRATION OUTPUT is matrix
+DEFAULT_PACK = {
+    'DTYPE': 'float32',
+    'LABELS': None,
+    'RESOLUTION': None,
+    'INTERPOLATION': 'trilinear',
+}
+
+
+def registered_file(source_file):
+    """
+    the output of process_registration for a file that went through the pipeline
+    """
+    source_file = Path(source_file)
+    return source_file.parents[0] / source_file.name.replace(".nii.gz", "_registered.nii.gz")
+
+
+def load_labels(labels_file):
+    """
+    {patient: {column: value}} from a csv with a 'patient' column
+    """
+    if not labels_file:
+        return {}
+    with open(labels_file, 'r', newline='') as f:
+        return {row.pop('patient'): row for row in csv.DictReader(f)}
+
+
+def volume_metadata(file, nii_dir, labels=None):
+    """
+    patient, session and sequence of a registered volume from its place under nii_dir
+    """
+    parts = Path(file).relative_to(nii_dir).parts
+    patient = parts[0] if len(parts) > 1 else ''
+    session = parts[-2] if len(parts) > 1 else ''
+    return {'file': Path(file).as_posix(), 'patient': patient, 'session': session,
+            'sequence': sequence_type(file), 'labels': (labels or {}).get(patient, {})}
+
+
+class PackedStore(object):
+    """
+    Append-only store of fixed-shape volumes. `volumes` is an np.memmap of shape (count, *shape), so
+    store[i] or store.volumes[indices] slice volumes without copying or decompressing anything.
+
+        >>> store = PackedStore.open("/tmp/data_packed")
+        >>> flair = store.select(sequence='FLAIR')
+        >>> batch = store.volumes[flair[:8]]
+    """
+    def __init__(self, path, shape, dtype, count, index, index_bytes=0):
+        self.path = Path(path)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self.index = index
+        self.index_bytes = index_bytes
+        self.files = {entry['file'] for entry in index}
+        self._volumes = None
+
+    @classmethod
+    def create(cls, path, shape, dtype='float32'):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        if (path / STORE_FILE).is_file():
+            return cls.open(path)
+        with cls.locked(path):
+            write_header(path, {'shape': list(shape), 'dtype': np.dtype(dtype).str, 'count': 0})
+            (path / VOLUMES_FILE).touch()
+            (path / INDEX_FILE).touch()
+        log.info(f"created packed store {path} for volumes of shape {tuple(shape)}")
+        return cls(path, shape, dtype, 0, [])
+
+    @classmethod
+    def open(cls, path):
+        path = Path(path)
+        with cls.locked(path):
+            with open(path / STORE_FILE, 'r') as f:
+                header = json.load(f)
+            count = header['count']
+            index, index_bytes = read_index(path / INDEX_FILE, count)
+        return cls(path, header['shape'], header['dtype'], count, index, index_bytes)
+
+    @staticmethod
+    @contextmanager
+    def locked(path):
+        with open(Path(path) / LOCK_FILE, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @property
+    def volume_bytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def volumes(self):
+        if self._volumes is None or len(self._volumes) != self.count:
+            if self.count == 0:
+                return np.empty((0,) + self.shape, dtype=self.dtype)
+            self._volumes = np.memmap(self.path / VOLUMES_FILE, dtype=self.dtype, mode='r',
+                                      shape=(self.count,) + self.shape)
+        return self._volumes
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.volumes[i]
+
+    def select(self, **criteria):
+        """
+        indices of the volumes whose metadata (or labels) match every criterion
+        """
+        def matches(entry):
+            return all(entry.get(k, entry['labels'].get(k)) == v for k, v in criteria.items())
+        return [i for i, entry in enumerate(self.index) if matches(entry)]
+
+    def append(self, file, metadata, img=None):
+        """
+        add a volume from a nii file, skipping files that are already packed or have the wrong shape
+        :param img: the volume when it was resampled in memory, file then only names it
+        :return: the index of the volume or None if it was skipped
+        """
+        file = Path(file)
+        if file.as_posix() in self.files:
+            return None
+        img = nib.load(file) if img is None else img
+        if tuple(img.shape) != self.shape:
+            log.warning(f"not packing {file} : shape {img.shape} != {self.shape}")
+            return None
+        data = np.ascontiguousarray(np.asanyarray(img.dataobj), dtype=self.dtype)
+
+        with self.locked(self.path):
+            with open(self.path / STORE_FILE, 'r') as f:
+                header = json.load(f)
+            # another writer may have appended since this store was opened
+            count = header['count']
+            entries, self.index_bytes = read_index(self.path / INDEX_FILE, count, len(self.index), self.index_bytes)
+            self.index.extend(entries)
+            self.files.update(entry['file'] for entry in entries)
+            self.count = count
+            if file.as_posix() in self.files:
+                return None
+
+            # drop anything left behind by an append that never committed
+            with open(self.path / VOLUMES_FILE, 'r+b') as f:
+                f.truncate(count * self.volume_bytes)
+                f.seek(0, os.SEEK_END)
+                f.write(data.tobytes())
+            line = (json.dumps(metadata) + "\n").encode()
+            with open(self.path / INDEX_FILE, 'r+b') as f:
+                f.truncate(self.index_bytes)
+                f.seek(0, os.SEEK_END)
+                f.write(line)
+            header['count'] = count + 1
+            write_header(self.path, header)
+
+        self.index.append(metadata)
+        self.index_bytes += len(line)
+        self.files.add(file.as_posix())
+        self.count = count + 1
+        log.info(f"packed {file} as volume {count}")
+        return count
+
+
+def read_index(file, count, start=0, offset=0):
+    """
+    entries start to count of a jsonl index, reading from the byte offset of entry start
+    :return: the entries and the byte offset after the last of them
+    """
+    entries = []
+    with open(file, 'rb') as f:
+        f.seek(offset)
+        for _ in range(start, count):
+            entries.append(json.loads(f.readline()))
+        return entries, f.tell()
+
+
+def write_header(path, header):
+    tmp_file = Path(path) / f"{STORE_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_file, Path(path) / STORE_FILE)
+
+
+def get_pack(config):
+    pack = dict(DEFAULT_PACK)
+    pack.update(config.get('PACK') or {})
+    if pack['RESOLUTION'] is not None and get_registration(config)['OUTPUT'] != 'matrix':
+        log.warning(f"ignoring PACK RESOLUTION {pack['RESOLUTION']}, registered volumes are on the template grid")
+        pack['RESOLUTION'] = None
+    return pack
+
+
+def open_store(config=None):
+    """
+    the packed store of the config, created with the shape of REFERENCE_TEMPLATE at the PACK RESOLUTION if it does
+    not exist yet. An existing store has to have that shape.
+    """
+    config = config or get_config()
+    pack = get_pack(config)
+    template = nib.load(config.REFERENCE_TEMPLATE)
+    shape, _ = output_grid(template.shape, template.affine, pack['RESOLUTION'])
+    store = PackedStore.create(config.PACK_DIR, shape, pack['DTYPE'])
+    if store.shape != shape:
+        raise ConfigError(f"packed store {store.path} holds volumes of shape {store.shape}, but PACK RESOLUTION "
+                          f"{pack['RESOLUTION']} gives {shape}")
+    return store
+
+
+def main():
+    config = get_config()
+    store = open_store(config)
+    labels = load_labels(get_pack(config)['LABELS'])
+    pattern = config.DIR_STRUCTURE.replace(' ', '_') + '/*_registered.nii.gz'
+    added = 0
+    for file in sorted(discover(config.NII_DIR, pattern, n_workers=config.DISCOVERY_WORKERS)):
+        if store.append(file, volume_metadata(file, config.NII_DIR, labels)) is not None:
+            added += 1
+    log.info(f"packed {added} new volumes, {len(store)} in {store.path}")
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pack the registered volumes into a memory-mappable store')
+    args = parser.parse_args()
+    main()
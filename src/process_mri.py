@@ -13,15 +13,32 @@ __maintainer__ = "Aonghus Lawlor"
 __email__ = "aonghus.lawlor@ucd.ie"
 __status__ = "Development"
 
+import os
 import sys
+import json
+import shlex
+import signal
+import resource
 import subprocess
 import logging
 import argparse
 import multiprocessing as mp
 import fcntl
-from utils import get_config, get_nii_dir, get_dir_structure
+import time
+import queue
+import threading
+from utils import get_config, set_config
+from discovery import discover, rules_from_config
+from cost_model import CostModel, input_features, longest_first, bin_pack
+from pack import open_store, get_pack, load_labels, registered_file, volume_metadata
+from resample import RegisteredVolumes
+from qc import QCError, check_strip, reject, retry_flags
+from metrics import Metrics, MetricsMonitor, get_metrics_config, init_events, emit
+from registration import get_registration, coarse_templates, coarse_to_fine_commands, flirt_matrix_command, \
+    write_provenance
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from resources import get_resources, worker_count, thread_env, cpu_sets, init_worker, AdmissionController
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from nipype.interfaces import fsl
 from datetime import datetime
 
@@ -31,6 +48,16 @@ logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:
 log = logging.getLogger(__name__)
 
 SKIP_CMD = False
+STAGES = ('bet', 'qc', 'reorient', 'registration')
+RETRY_SECONDS = 0.0
+
+
+class ToolError(RuntimeError):
+    def __init__(self, stage, error, attempts):
+        super(ToolError, self).__init__(f"{stage} failed after {attempts} attempts : {error}")
+        self.stage = stage
+        self.error = error
+        self.attempts = attempts
 
 
 def write_cmd(file, cmd):
@@ -40,17 +67,64 @@ def write_cmd(file, cmd):
         fcntl.flock(f, fcntl.LOCK_UN)
 
 
-def process_bet(source_file=None, source_suffix=".nii.gz", target_suffix="_bet.nii.gz", write_to_file=False):
-    BET_FLAGS = get_config().BET_FLAGS
+def limit_memory(memory_mb):
+    if memory_mb:
+        limit = int(memory_mb) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def retry_seconds():
+    """
+    seconds spent by run_command in this process on failed attempts and backoff since the last call, so the
+    cost history only records the attempts that succeeded
+    """
+    global RETRY_SECONDS
+    seconds, RETRY_SECONDS = RETRY_SECONDS, 0.0
+    return seconds
+
+
+def run_command(cmdline, stage, config=None):
+    """
+    run an external tool under the wall-clock and address space limits of its stage, retrying with
+    exponential backoff. The tool runs in its own process group so a timeout kills anything it started.
+    :return: number of attempts taken
+    """
+    global RETRY_SECONDS
+    limits = (config or get_config()).STAGE_LIMITS[stage]
+    env = dict(os.environ, FSLOUTPUTTYPE='NIFTI_GZ')
+    attempts = int(limits['RETRIES']) + 1
+    error = None
+    for attempt in range(attempts):
+        if attempt:
+            delay = limits['BACKOFF'] * 2 ** (attempt - 1)
+            log.warning(f"retrying {stage} in {delay}s ({attempt + 1}/{attempts})")
+            time.sleep(delay)
+            RETRY_SECONDS += delay
+        start = time.perf_counter()
+        proc = subprocess.Popen(shlex.split(cmdline), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+                                start_new_session=True, preexec_fn=lambda: limit_memory(limits['MEMORY']))
+        try:
+            _, err = proc.communicate(timeout=limits['TIMEOUT'] or None)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.communicate()
+            error = f"timed out after {limits['TIMEOUT']}s"
+        else:
+            if proc.returncode == 0:
+                return attempt + 1
+            error = f"exit code {proc.returncode} : {err.decode(errors='replace').strip()[-500:]}"
+        RETRY_SECONDS += time.perf_counter() - start
+        log.warning(f"{stage} attempt {attempt + 1}/{attempts} failed : {error}")
+    raise ToolError(stage, error, attempts)
+
+
+def process_bet(source_file=None, source_suffix=".nii.gz", target_suffix="_bet.nii.gz", write_to_file=False,
+                config=None, flags=None):
+    config = config or get_config()
 
     target_file = Path(source_file.parents[0] / source_file.name.replace(source_suffix, target_suffix))
     #log.info(f"BET - {source_file} -> {target_file}")
-    flair_names = ['FLAIR', 'flair', 'Flair']
-
-    if any(x in source_file.as_posix() for x in flair_names):
-        FLAGS = get_config().FLAIR_BET_FLAGS
-    else:
-        FLAGS = BET_FLAGS
+    FLAGS = flags or config.bet_flags(source_file)
     bet_converter = fsl.BET()
     bet_converter.inputs.in_file = source_file.resolve()
     bet_converter.inputs.out_file = target_file
@@ -61,12 +135,38 @@ def process_bet(source_file=None, source_suffix=".nii.gz", target_suffix="_bet.n
             return bet_converter.cmdline
         else:
             log.info(f"{bet_converter.cmdline}")
-            bet_converter.run()
+            run_command(bet_converter.cmdline, 'bet', config)
     return target_file
 
 
-def process_reorient(source_file=None, source_suffix=".nii.gz", target_suffix="_reorient.nii.gz", write_to_file=False):
-    FSLREORIENT2DSTD_FLAGS = get_config().FSLREORIENT2DSTD_FLAGS
+def process_qc(source_file=None, source_suffix="_bet.nii.gz", config=None):
+    """
+    check the skull-strip in source_file against the cohort norms. A flagged strip is re-run once with
+    BET_RETRY_FLAGS, or FLAIR_BET_RETRY_FLAGS for FLAIR, and rejected if it is still flagged, so it never reaches registration.
+    :return: source_file, or None if it is not a bet output
+    """
+    if not source_file.as_posix().endswith(source_suffix):
+        return None
+    config = config or get_config()
+    attempts = 1
+    reasons = check_strip(source_file, config)
+    flags = retry_flags(source_file, config)
+    if reasons and flags:
+        attempts = 2
+        bet_input = Path(source_file.parents[0] / source_file.name.replace(source_suffix, ".nii.gz"))
+        log.info(f"re-running bet on {bet_input} with {flags}")
+        process_bet(bet_input, target_suffix=source_suffix, config=config, flags=flags)
+        reasons = check_strip(source_file, config, attempt=attempts)
+    if reasons:
+        reject(source_file, reasons, config)
+        raise QCError(source_file, reasons, attempts)
+    return source_file
+
+
+def process_reorient(source_file=None, source_suffix=".nii.gz", target_suffix="_reorient.nii.gz", write_to_file=False,
+                     config=None):
+    config = config or get_config()
+    FSLREORIENT2DSTD_FLAGS = config.FSLREORIENT2DSTD_FLAGS
     target_file = Path(source_file.parents[0] / source_file.name.replace(source_suffix, target_suffix))
 
     reorient_converter = fsl.Reorient2Std()
@@ -80,97 +180,264 @@ def process_reorient(source_file=None, source_suffix=".nii.gz", target_suffix="_
             return reorient_converter.cmdline
         else:
             log.info(f"{reorient_converter.cmdline}")
-            reorient_converter.run()
+            run_command(reorient_converter.cmdline, 'reorient', config)
     return target_file
 
 
 def process_registration(source_file=None, source_suffix=".nii.gz", target_suffix="_registered.nii.gz",
-                         write_to_file=False):
+                         write_to_file=False, config=None):
     if source_file.as_posix().endswith(source_suffix):
-        FLIRT_FLAGS = get_config().FLIRT_FLAGS
-        REFERENCE_TEMPLATE = get_config().REFERENCE_TEMPLATE
+        config = config or get_config()
+        FLIRT_FLAGS = config.FLIRT_FLAGS
+        REFERENCE_TEMPLATE = config.REFERENCE_TEMPLATE
         target_file = Path(source_file.parents[0] / source_file.name.replace(source_suffix, target_suffix))
         mat_file = Path(source_file.parents[0] / source_file.name.replace(source_suffix, ".mat"))
+        registration = get_registration(config)
+        # with OUTPUT matrix the volume is resampled on first use by resample.RegisteredVolumes
+        matrix_only = registration['OUTPUT'] == 'matrix'
 
-        flirt_converter = fsl.FLIRT()
-        flirt_converter.inputs.in_file = source_file
-        flirt_converter.inputs.args = FLIRT_FLAGS
-        flirt_converter.inputs.out_file = target_file
-        flirt_converter.inputs.reference = REFERENCE_TEMPLATE
-        flirt_converter.inputs.out_matrix_file = mat_file
-        flirt_converter.inputs.output_type = 'NIFTI_GZ'
+        intermediates = []
+        if registration['MODE'] == 'coarse_to_fine':
+            commands, intermediates = coarse_to_fine_commands(source_file, None if matrix_only else target_file,
+                                                              mat_file, config)
+        elif matrix_only:
+            commands = [flirt_matrix_command(source_file, REFERENCE_TEMPLATE, mat_file, FLIRT_FLAGS)]
+        else:
+            flirt_converter = fsl.FLIRT()
+            flirt_converter.inputs.in_file = source_file
+            flirt_converter.inputs.args = FLIRT_FLAGS
+            flirt_converter.inputs.out_file = target_file
+            flirt_converter.inputs.reference = REFERENCE_TEMPLATE
+            flirt_converter.inputs.out_matrix_file = mat_file
+            flirt_converter.inputs.output_type = 'NIFTI_GZ'
+            commands = [flirt_converter.cmdline]
         if not SKIP_CMD:
             if write_to_file:
-                return flirt_converter.cmdline
+                if matrix_only:
+                    write_provenance(source_file, mat_file, config)
+                if intermediates:
+                    commands = commands + [f"rm -f {' '.join(map(str, intermediates))}"]
+                return "\n".join(commands)
             else:
-                log.info(f"{flirt_converter.cmdline}")
-                flirt_converter.run()
+                for cmdline in commands:
+                    log.info(f"{cmdline}")
+                    run_command(cmdline, 'registration', config)
+                for file in intermediates:
+                    if file.is_file():
+                        file.unlink()
+        if matrix_only:
+            write_provenance(source_file, mat_file, config)
+            return mat_file
         return target_file
     else:
         return None
 
 
-def process_pipeline(source_file, do_bet=False, do_reorient=False, do_registration=False, script_name=None):
+def stage_output(stage, source_file, config=None):
+    """
+    the file run_stage leaves for source_file, or None if the stage does nothing with it
+    """
+    name = source_file.name
+    if stage == 'bet':
+        return source_file.with_name(name.replace(".nii.gz", "_bet.nii.gz"))
+    if stage == 'qc':
+        return source_file if name.endswith("_bet.nii.gz") else None
+    if stage == 'reorient':
+        return source_file.with_name(name.replace(".nii.gz", "_reorient.nii.gz"))
+    if not name.endswith("_bet.nii.gz"):
+        return None
+    if get_registration(config or get_config())['OUTPUT'] == 'matrix':
+        return source_file.with_name(name.replace("_bet.nii.gz", ".mat"))
+    return source_file.with_name(name.replace("_bet.nii.gz", "_registered.nii.gz"))
+
+
+def final_output(source_file, selected, config=None):
+    """
+    the last file process_pipeline writes for source_file with the selected stages
+    """
+    for stage in STAGES:
+        if selected[stage]:
+            source_file = stage_output(stage, source_file, config) or source_file
+    return source_file
+
+
+def run_stage(stage, source_file, write_to_file=False, config=None):
+    if stage == 'bet':
+        return process_bet(source_file, target_suffix="_bet.nii.gz", write_to_file=write_to_file, config=config)
+    if stage == 'qc':
+        return process_qc(source_file, config=config)
+    if stage == 'reorient':
+        return process_reorient(source_file, target_suffix="_reorient.nii.gz", write_to_file=write_to_file,
+                                config=config)
+    return process_registration(source_file, source_suffix="_bet.nii.gz", target_suffix="_registered.nii.gz",
+                                write_to_file=write_to_file, config=config)
+
+
+def process_pipeline(source_file, do_bet=False, do_reorient=False, do_registration=False, script_name=None,
+                     start_stage=None, original_file=None, do_qc=False, do_pack=False):
+    """
+    run the selected stages on source_file
+    :param start_stage: skip the stages before this one, source_file is then the input to start_stage
+    :param original_file: the nii file the pipeline started from, when resuming at start_stage
+    :param do_pack: resample a matrix-only registration into the cache, for the parent to pack
+    :return: (original_file, {stage: runtime in seconds}, failure) where failure is None or the ledger entry
+    """
+    timings = {}
+    config = get_config()
+    original_file = original_file or source_file
     write_to_file = False
     if script_name is not None:
         write_to_file = True
 
-    if not do_bet:
-        log.info("no BET")
-        # return
-    else:
-        ret = process_bet(source_file, target_suffix="_bet.nii.gz", write_to_file=write_to_file)
-        if isinstance(ret, Path) and ret.is_file():
-            source_file = ret
-            log.info(f"created: {source_file}")
-        elif isinstance(ret, str):
-            write_cmd(script_name, ret+"\n")
-            log.info(f"writing command to file")
-        else:
-            log.info(f"failed to create {ret}. Skip to next task")
-            return
+    selected = {'bet': do_bet, 'qc': do_qc and not write_to_file, 'reorient': do_reorient,
+                'registration': do_registration}
+    stages = STAGES[STAGES.index(start_stage):] if start_stage else STAGES
+    log.info(f"working on {source_file}")
+    emit('task_start', original_file, planned_stages(selected, start_stage))
+    for stage in stages:
+        if not selected[stage]:
+            log.info(f"no {stage}")
+            continue
 
-    if not do_reorient:
-        log.info("no Reorient")
-        # return
-    else:
-        ret = process_reorient(source_file, target_suffix="_reorient.nii.gz", write_to_file=write_to_file)
-        if isinstance(ret, Path) and ret.is_file():
-            source_file = ret
-            log.info(f"created: {source_file}")
-        elif isinstance(ret, str):
-            write_cmd(script_name, ret+"\n")
-            log.info(f"writing command to file")
-        else:
-            log.info(f"failed to create {source_file}. Skip to next task")
-            return
+        start = time.perf_counter()
+        retry_seconds()
+        emit('stage_start', original_file, stage)
+        try:
+            ret = run_stage(stage, source_file, write_to_file=write_to_file, config=config)
+        except Exception as e:
+            log.error(f"{stage} failed on {source_file} : {e}")
+            emit('stage_end', original_file, stage, False, time.perf_counter() - start)
+            emit('task_end', original_file, False)
+            return original_file, timings, failure_entry(stage, source_file, e, getattr(e, 'attempts', 1))
 
-    if not do_registration:
-        log.info("no registration")
-        # return
-    else:
-        source_suffix = "_bet.nii.gz"
-        ret = process_registration(source_file, source_suffix=source_suffix,
-                                   target_suffix="_registered.nii.gz", write_to_file=write_to_file)
         if ret is None:
-            log.info(f"File: {source_file} does not match provided suffix {source_suffix}")
+            log.info(f"File: {source_file} does not match provided suffix _bet.nii.gz")
+            emit('stage_end', original_file, stage, None, time.perf_counter() - start)
         elif isinstance(ret, Path) and ret.is_file():
+            elapsed = time.perf_counter() - start
+            timings[stage] = elapsed - retry_seconds()
             source_file = ret
             log.info(f"created: {source_file}")
+            emit('stage_end', original_file, stage, True, elapsed)
         elif isinstance(ret, str):
             write_cmd(script_name, ret+"\n")
+            log.info(f"writing command to file")
+            emit('stage_end', original_file, stage, True, time.perf_counter() - start)
         else:
-            log.info(f"failed to create {source_file}. Skip to next task")
-            return
+            log.info(f"failed to create {ret}. Skip to next task")
+            emit('stage_end', original_file, stage, False, time.perf_counter() - start)
+            emit('task_end', original_file, False)
+            return original_file, timings, failure_entry(stage, source_file, f"{ret} was not created", 1)
+
+    if do_pack and source_file.suffix == ".mat":
+        # resampled here on the worker, the parent only reads it back from the cache
+        pack = get_pack(config)
+        try:
+            RegisteredVolumes(config).load(source_file, pack['RESOLUTION'], pack['INTERPOLATION'])
+        except Exception as e:
+            log.error(f"cannot resample {source_file} for packing : {e!r}")
+    emit('task_end', original_file, True)
+    return original_file, timings, None
+
+
+def planned_stages(selected, start_stage=None):
+    """
+    the selected stages a task runs, from start_stage on
+    """
+    stages = STAGES[STAGES.index(start_stage):] if start_stage else STAGES
+    return [stage for stage in stages if selected[stage]]
+
+
+def resume_task(source_file, selected):
+    """
+    the (source_file, start_stage, original_file) task of a discovered nii file. Without bet, a file whose _bet output
+    is there from an earlier run starts at the first selected stage after bet, with the _bet file as its input
+    """
+    bet_file = stage_output('bet', source_file)
+    if not selected['bet'] and bet_file.is_file():
+        stages = planned_stages(selected, 'qc')
+        if stages:
+            return bet_file, stages[0], source_file
+    return source_file, None, source_file
+
+
+def process_batch(tasks, do_bet=False, do_reorient=False, do_registration=False, script_name=None, do_qc=False,
+                  do_pack=False):
+    """
+    run the pipeline over a bin of (source_file, start_stage, original_file) tasks in one worker
+    """
+    return [process_pipeline(source_file, do_bet, do_reorient, do_registration, script_name, start_stage,
+                             original_file, do_qc, do_pack)
+            for source_file, start_stage, original_file in tasks]
+
+
+def failure_entry(stage, source_file, error, attempts):
+    return {'stage': stage, 'input': Path(source_file).as_posix(), 'error': str(error), 'attempts': attempts,
+            'time': datetime.now().isoformat()}
+
+
+def load_ledger(ledger_file):
+    """
+    the failures of earlier runs as {original file: failure entry}
+    """
+    if not os.path.isfile(ledger_file):
+        return {}
+    with open(ledger_file, 'r') as f:
+        return json.load(f)
+
+
+def save_ledger(ledger_file, ledger):
+    tmp_file = f"{ledger_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(ledger, f, indent=2)
+    os.replace(tmp_file, ledger_file)
+    log.info(f"{len(ledger)} failures recorded in {ledger_file}")
 
-    return
 
+def retry_tasks(ledger, selected):
+    """
+    the (source_file, start_stage, original_file) tasks resuming each failed file at the stage that failed
+    """
+    tasks = []
+    for original, entry in ledger.items():
+        stage = entry['stage'] if entry['stage'] in STAGES else None
+        if stage is not None and not selected[stage]:
+            log.warning(f"{original} failed at {stage}, which is not selected, its failure is kept")
+        tasks.append((Path(entry['input']), stage, Path(original)))
+    return tasks
 
-def main(do_bet=False, do_reorient=False, do_registration=False, do_script=False, n_workers=0):
+
+def record_result(ledger, original_file, timings, failure):
+    """
+    update the ledger with the result of one file. An earlier failure is only cleared once the stage it failed at
+    has run again, so a run without that stage, or one that only writes a script, keeps it
+    :return: True if the file failed
+    """
+    key = original_file.as_posix()
+    if failure is not None:
+        ledger[key] = failure
+        return True
+    entry = ledger.get(key)
+    if entry is not None and (entry['stage'] in timings or (entry['stage'] not in STAGES and timings)):
+        ledger.pop(key)
+    return False
+
+
+def init_pipeline_worker(config, env, cpu_sets, slot_counter, events=None):
+    set_config(config)
+    init_worker(env, cpu_sets, slot_counter)
+    init_events(events)
+
+
+def main(do_bet=False, do_reorient=False, do_registration=False, do_script=False, n_workers=0, do_schedule=False,
+         do_bin_pack=False, retry_failed=False, do_pack=False, do_qc=False):
+    # built and validated once here, the workers get this snapshot through the pool initializer
+    config = get_config()
+    resources = get_resources(config)
     if n_workers == 0:
-        n_workers = mp.cpu_count() - 1
-    nii_dir = get_nii_dir()
-    dir_structure = get_dir_structure().replace(' ', '_')
+        n_workers = worker_count(resources)
+    nii_dir = config.NII_DIR
+    dir_structure = config.DIR_STRUCTURE.replace(' ', '_')
     script_name = None
     if do_script:
         script_prefix = "script"
@@ -187,20 +454,143 @@ def main(do_bet=False, do_reorient=False, do_registration=False, do_script=False
         with open(script_name, "x") as f:
             log.debug(f"created script : {script_name}")
             pass
-    files = list(Path(nii_dir).glob(dir_structure + '/*.nii.gz'))
-    log.debug(f"original files :  {len(files)}")
-    files = [file for file in files if "ROI" not in file.as_posix() and "EQ" not in file.as_posix()]
-    log.debug(f"removing overlay files : {len(files)}")
-    futures = []
-    with ProcessPoolExecutor(max_workers=n_workers) as executor:
-        for source_file in files:
-            log.info(f'working on {source_file}')
-            # process_pipeline(source_file)
-            futures.append(executor.submit(process_pipeline, source_file, do_bet, do_reorient, do_registration,
-                                           script_name))
-
-    wait(futures)
-    return
+    selected = {'bet': do_bet, 'qc': do_qc and not do_script, 'reorient': do_reorient,
+                'registration': do_registration}
+    ledger_file = config.FAILURE_LEDGER
+    ledger = load_ledger(ledger_file)
+    if retry_failed:
+        tasks = retry_tasks(ledger, selected)
+        if do_script:
+            log.warning(f"only writing a script, the failures stay in {ledger_file} until the stages are run")
+        log.info(f"retrying {len(tasks)} failed files from {ledger_file}")
+    else:
+        # the outputs of earlier runs are excluded by the NII rules, a staged run picks up their _bet files here
+        files = discover(nii_dir, dir_structure + '/*.nii.gz', keep=rules_from_config(config, 'NII'),
+                         n_workers=config.DISCOVERY_WORKERS)
+        tasks = (resume_task(source_file, selected) for source_file in files)
+
+    stages = [stage for stage, do in (('bet', do_bet), ('qc', do_qc), ('reorient', do_reorient),
+                                      ('registration', do_registration)) if do]
+    history_file = config.COST_HISTORY
+    cost_model = CostModel.load(history_file)
+    features = {}
+    predicted = {}
+    if do_schedule or do_bin_pack:
+        # the whole walk is needed before anything can be ordered
+        tasks = list(tasks)
+        for _, _, original_file in tasks:
+            features[original_file] = input_features(original_file)
+            predicted[original_file] = cost_model.predict(features[original_file], stages)
+        tasks = longest_first(tasks, [predicted[task[2]] for task in tasks])
+        log.info(f"predicted total runtime : {sum(predicted.values()):.0f}s over {len(tasks)} files")
+
+    if do_bin_pack:
+        submissions = [(process_batch, batch, batch)
+                       for batch in bin_pack(tasks, [predicted[task[2]] for task in tasks], n_workers)]
+    else:
+        submissions = ((process_pipeline, task, [task]) for task in tasks)
+
+    if do_registration and get_registration(config)['MODE'] == 'coarse_to_fine':
+        # built once here rather than by the first worker to need them
+        coarse_templates(config)
+
+    store = None
+    volumes = None
+    if do_pack:
+        # volumes are appended here in the parent, so the store only ever has one writer per run. Matrix-only
+        # registrations are resampled by the workers, and read back here from the resample cache
+        store = open_store(config)
+        volumes = RegisteredVolumes(config) if get_registration(config)['OUTPUT'] == 'matrix' else None
+        pack = get_pack(config)
+        labels = load_labels(pack['LABELS'])
+
+    futures = {}
+    failures = 0
+
+    def collect(future):
+        nonlocal failures
+        try:
+            results = future.result()
+        except Exception as e:
+            log.error(f"task failed : {e!r}")
+            for source_file, start_stage, original_file in futures[future]:
+                metrics.task_lost(original_file)
+                ledger[original_file.as_posix()] = failure_entry(start_stage or 'pipeline', source_file, e, 1)
+                failures += 1
+            return
+        for original_file, timings, failure in (results if do_bin_pack else [results]):
+            failures += record_result(ledger, original_file, timings, failure)
+            if not timings:
+                continue
+            if original_file not in features:
+                features[original_file] = input_features(original_file)
+            if original_file in predicted:
+                log.info(f"{original_file.name} predicted {predicted[original_file]:.1f}s "
+                         f"actual {sum(timings.values()):.1f}s")
+            cost_model.append(history_file, original_file, features[original_file], timings)
+            if store is not None and 'registration' in timings and failure is None:
+                packed_file = registered_file(original_file)
+                try:
+                    # without a registered volume on disk the worker resampled it from the matrix into the cache
+                    img = volumes.load(original_file.with_name(original_file.name.replace(".nii.gz", ".mat")),
+                                       pack['RESOLUTION'], pack['INTERPOLATION']) if volumes is not None else None
+                    store.append(packed_file, volume_metadata(packed_file, nii_dir, labels), img)
+                except Exception as e:
+                    log.error(f"cannot pack {packed_file} : {e!r}")
+
+    admission = AdmissionController(n_workers, resources)
+    threads = int(resources['THREADS_PER_WORKER'])
+    events = mp.Queue()
+    initargs = (config, thread_env(threads), cpu_sets(n_workers, resources['PIN'], threads), mp.Value('i', 0),
+                events)
+    metrics_config = get_metrics_config(config)
+    metrics = Metrics(n_workers, metrics_config['WINDOW'])
+    running = set()
+    # discovery runs ahead of the admission loop, so the metrics count the whole backlog as queued
+    pending = queue.Queue()
+    feed_errors = []
+
+    def feed():
+        try:
+            for submission in submissions:
+                for _, start_stage, _ in submission[2]:
+                    metrics.discovered(planned_stages(selected, start_stage))
+                pending.put(submission)
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            pending.put(None)
+
+    try:
+        with MetricsMonitor(metrics, events, metrics_config), \
+                ProcessPoolExecutor(max_workers=n_workers, initializer=init_pipeline_worker,
+                                    initargs=initargs) as executor:
+            threading.Thread(target=feed, daemon=True).start()
+            for fn, task, task_list in iter(pending.get, None):
+                # hold back new work while the node is under load or memory pressure
+                while len(running) >= admission.allowed():
+                    done, running = wait(running, timeout=admission.interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future)
+                if fn is process_pipeline:
+                    log.debug(f'queueing {task[0]}')
+                    future = executor.submit(process_pipeline, task[0], do_bet, do_reorient, do_registration,
+                                             script_name, task[1], task[2], do_qc, do_pack)
+                else:
+                    future = executor.submit(process_batch, task, do_bet, do_reorient, do_registration, script_name,
+                                             do_qc, do_pack)
+                futures[future] = task_list
+                running.add(future)
+            log.debug(f"submitted tasks : {len(futures)}")
+
+            for future in as_completed(running):
+                collect(future)
+            if feed_errors:
+                raise feed_errors[0]
+    finally:
+        save_ledger(ledger_file, ledger)
+    log.info(f"finished {len(futures)} tasks with {failures} failures")
+    return failures
 
 
 if __name__ == '__main__':
@@ -210,10 +600,20 @@ if __name__ == '__main__':
     parser.add_argument('--registration', help='perform registration', action='store_true')
     parser.add_argument('--n_workers', help='number of processes', default=0, type=int)
     parser.add_argument('--script', help="generate conversion script", action='store_true')
+    parser.add_argument('--schedule', help='submit the longest predicted files first', action='store_true')
+    parser.add_argument('--bin_pack', help='pack files into one balanced batch per worker', action='store_true')
+    parser.add_argument('--retry-failed', help='only re-run the failed stages recorded in the failure ledger',
+                        action='store_true')
+    parser.add_argument('--qc', help='check skull-strips before registration, re-running or rejecting outliers',
+                        action='store_true')
+    parser.add_argument('--pack', help='append each registered volume to the packed training store',
+                        action='store_true')
 
     args = parser.parse_args()
     log.info(f"{args}")
 
-    main(do_bet=args.bet, do_reorient=args.reorient, do_registration=args.registration, do_script=args.script,
-         n_workers=args.n_workers)
-    sys.exit(1)
+    failures = main(do_bet=args.bet, do_reorient=args.reorient, do_registration=args.registration,
+                    do_script=args.script, n_workers=args.n_workers, do_schedule=args.schedule,
+                    do_bin_pack=args.bin_pack, retry_failed=args.retry_failed, do_pack=args.pack,
+                    do_qc=args.qc)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Quality control of BET skull-strips: statistics of the brain mask and stripped volume are compared against the
+norms of the cohort so that failed strips are re-run or rejected before they reach registration
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import json
+import fcntl
+import logging
+import argparse
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from datetime import datetime
+from collections import defaultdict
+from scipy import ndimage
+from utils import get_config, FLAIR_NAMES
+from cost_model import sequence_type
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+QC_FEATURES = ('brain_ml', 'extent_x', 'extent_y', 'extent_z', 'components', 'largest_fraction',
+               'p02', 'p50', 'p98')
+# the smallest meaningful difference in each feature, a floor on its spread: one component, about a voxel of extent,
+# a millilitre of brain. Intensities have no fixed scale and fall back to 1% of the median.
+QC_RESOLUTION = {'brain_ml': 1.0, 'extent_x': 1.0, 'extent_y': 1.0, 'extent_z': 1.0, 'components': 1.0,
+                 'largest_fraction': 0.01}
+DEFAULT_QC = {
+    'THRESHOLD': 3.5,
+    'MIN_COHORT': 20,
+    'MIN_BRAIN_ML': 300,
+    'BET_RETRY_FLAGS': "-R -f 0.3 -g 0 -m",
+    'FLAIR_BET_RETRY_FLAGS': "-R -f 0.5 -g 0 -m",
+}
+# scales the MAD to the standard deviation of a normal distribution
+MAD_SCALE = 1.4826
+_NORMS = None
+
+
+class QCError(RuntimeError):
+    def __init__(self, source_file, reasons, attempts):
+        super(QCError, self).__init__(f"{source_file} rejected by qc : {', '.join(reasons)}")
+        self.reasons = reasons
+        self.attempts = attempts
+
+
+def get_qc(config):
+    qc = dict(DEFAULT_QC)
+    qc.update(config.get('QC') or {})
+    return qc
+
+
+def retry_flags(source_file, config):
+    """
+    the BET flags a flagged strip is re-run with, FLAIR_BET_RETRY_FLAGS for FLAIR sequences as for Config.bet_flags
+    """
+    qc = get_qc(config)
+    if any(x in Path(source_file).as_posix() for x in FLAIR_NAMES):
+        return qc['FLAIR_BET_RETRY_FLAGS']
+    return qc['BET_RETRY_FLAGS']
+
+
+def mask_file(bet_file):
+    """
+    the mask that bet -m writes next to its output
+    """
+    bet_file = Path(bet_file)
+    return bet_file.parents[0] / bet_file.name.replace(".nii.gz", "_mask.nii.gz")
+
+
+def load_data(file):
+    # mmap only avoids a copy for uncompressed .nii, a .nii.gz is always decompressed into memory
+    return np.asanyarray(nib.load(file, mmap=True).dataobj)
+
+
+def qc_stats(bet_file):
+    """
+    brain volume, bounding box extent, connected components and intensity percentiles of a skull-strip.
+    falls back to the non-zero voxels of the stripped volume when bet was run without -m
+    """
+    bet_file = Path(bet_file)
+    img = nib.load(bet_file, mmap=True)
+    data = np.asanyarray(img.dataobj)
+    m_file = mask_file(bet_file)
+    mask = load_data(m_file) > 0 if m_file.is_file() else data != 0
+    voxel_ml = float(np.prod(img.header.get_zooms()[:3])) / 1000.0
+    stats = {'file': bet_file.as_posix(), 'sequence': sequence_type(bet_file)}
+
+    brain_voxels = int(np.count_nonzero(mask))
+    stats['brain_ml'] = brain_voxels * voxel_ml
+    if brain_voxels == 0:
+        stats.update({k: 0.0 for k in QC_FEATURES if k != 'brain_ml'})
+        return stats
+
+    zooms = img.header.get_zooms()[:3]
+    for axis, name in enumerate(('extent_x', 'extent_y', 'extent_z')):
+        present = np.flatnonzero(np.any(mask, axis=tuple(a for a in range(3) if a != axis)))
+        stats[name] = float((present[-1] - present[0] + 1) * zooms[axis])
+
+    labels, n_components = ndimage.label(mask)
+    sizes = np.bincount(labels.ravel())[1:]
+    stats['components'] = int(n_components)
+    stats['largest_fraction'] = float(sizes.max() / brain_voxels)
+
+    p02, p50, p98 = np.percentile(data[mask], [2, 50, 98])
+    stats.update({'p02': float(p02), 'p50': float(p50), 'p98': float(p98)})
+    return stats
+
+
+class QCNorms(object):
+    """
+    Robust per sequence norms (median and MAD) of the qc statistics of earlier strips. A file is flagged when any
+    statistic is more than THRESHOLD robust z-scores from the median of its sequence.
+    """
+    def __init__(self, records=(), threshold=DEFAULT_QC['THRESHOLD'], min_cohort=DEFAULT_QC['MIN_COHORT']):
+        self.threshold = float(threshold)
+        self.min_cohort = int(min_cohort)
+        by_sequence = defaultdict(list)
+        for record in records:
+            if record.get('passed', True):
+                by_sequence[record['sequence']].append([record[k] for k in QC_FEATURES])
+        self.norms = {}
+        for sequence, rows in by_sequence.items():
+            if len(rows) < self.min_cohort:
+                continue
+            values = np.array(rows, dtype=float)
+            median = np.median(values, axis=0)
+            mad = MAD_SCALE * np.median(np.abs(values - median), axis=0)
+            self.norms[sequence] = (median, mad, len(rows))
+
+    @classmethod
+    def load(cls, history_file, **kwargs):
+        records = []
+        history_file = Path(history_file)
+        if history_file.is_file():
+            with open(history_file, 'r') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        log.warning(f"skipping bad line in {history_file}")
+        return cls(records, **kwargs)
+
+    def zscores(self, stats):
+        if stats['sequence'] not in self.norms:
+            return None
+        median, mad, _ = self.norms[stats['sequence']]
+        x = np.array([stats[k] for k in QC_FEATURES], dtype=float)
+        # a feature with little or no spread in the cohort is scaled by its resolution instead
+        floor = np.array([QC_RESOLUTION.get(k, abs(m) * 0.01) for k, m in zip(QC_FEATURES, median)]) + 1e-6
+        spread = np.maximum(mad, floor)
+        return dict(zip(QC_FEATURES, (x - median) / spread))
+
+    def flag(self, stats, min_brain_ml=0):
+        """
+        :return: the reasons stats is an outlier, empty if it passes
+        """
+        reasons = []
+        if stats['brain_ml'] < min_brain_ml:
+            reasons.append(f"brain volume {stats['brain_ml']:.0f}ml")
+        z = self.zscores(stats)
+        if z is not None:
+            reasons.extend(f"{k} z={v:.1f}" for k, v in z.items() if abs(v) > self.threshold)
+        return reasons
+
+
+def get_norms(config=None):
+    """
+    the cohort norms, loaded once per process from the qc history
+    """
+    global _NORMS
+    if _NORMS is None:
+        config = config or get_config()
+        qc = get_qc(config)
+        _NORMS = QCNorms.load(config.QC_HISTORY, threshold=qc['THRESHOLD'], min_cohort=qc['MIN_COHORT'])
+        log.debug(f"qc norms for {sorted(_NORMS.norms)} from {config.QC_HISTORY}")
+    return _NORMS
+
+
+def append_jsonl(file, record):
+    with open(file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(record) + "\n")
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def check_strip(bet_file, config=None, attempt=1):
+    """
+    qc a skull-strip and record it in the qc history
+    :return: the reasons it was flagged, empty if it passed
+    """
+    config = config or get_config()
+    stats = qc_stats(bet_file)
+    reasons = get_norms(config).flag(stats, get_qc(config)['MIN_BRAIN_ML'])
+    append_jsonl(config.QC_HISTORY, dict(stats, passed=not reasons, attempt=attempt,
+                                         time=datetime.now().isoformat()))
+    if reasons:
+        log.warning(f"qc flagged {bet_file} : {', '.join(reasons)}")
+    return reasons
+
+
+def reject(bet_file, reasons, config=None):
+    config = config or get_config()
+    append_jsonl(config.QC_REJECTS, {'file': Path(bet_file).as_posix(), 'reasons': reasons,
+                                     'time': datetime.now().isoformat()})
+
+
+def main(files):
+    config = get_config()
+    norms = get_norms(config)
+    for file in files:
+        stats = qc_stats(file)
+        reasons = norms.flag(stats, get_qc(config)['MIN_BRAIN_ML'])
+        log.info(f"{file} : {'ok' if not reasons else ', '.join(reasons)}")
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check skull-strips against the cohort norms')
+    parser.add_argument('files', help='_bet.nii.gz files', nargs='+')
+    args = parser.parse_args()
+    main(args.files)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Coarse-to-fine registration: a low DOF FLIRT against a downsampled copy of REFERENCE_TEMPLATE initialises a
+full resolution pass with no search, in place of the single full search at 1mm. The downsampled template and the
+matrix from its FSL coordinates to those of the full template are built once per run.
+
+    python src/registration.py --sample 20
+compares the two modes on a sample of skull-stripped files: FLIRT time, the RMS deviation between the matrices
+(Jenkinson 1999) and the correlation between the registered images.
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import csv
+import json
+import fcntl
+import shlex
+import random
+import subprocess
+import logging
+import argparse
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from datetime import datetime
+from nipype.interfaces import fsl
+from utils import get_config
+from discovery import discover
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+DEFAULT_REGISTRATION = {
+    'MODE': 'single',
+    'COARSE_RESOLUTION': 4,
+    'COARSE_FLAGS': "-bins 64 -cost corratio -dof 6 -searchrx -30 30 -searchry -30 30 -searchrz -30 30 "
+                    "-interp trilinear",
+    'FINE_FLAGS': "-bins 256 -cost corratio -dof 12 -nosearch -interp spline",
+    'OUTPUT': 'volume',
+    'CACHE_DIR': None,
+    'CACHE_MB': 10240,
+}
+# radius in mm of the sphere the RMS deviation is averaged over
+RMS_RADIUS = 80.0
+
+
+def get_registration(config):
+    registration = dict(DEFAULT_REGISTRATION)
+    registration.update(config.get('REGISTRATION') or {})
+    return registration
+
+
+def read_matrix(mat_file):
+    return np.loadtxt(mat_file).reshape(4, 4)
+
+
+def write_matrix(mat_file, matrix):
+    np.savetxt(mat_file, matrix, fmt='%.10f')
+
+
+def vox2fsl(img):
+    """
+    voxel to FSL scaled mm coordinates, with the x flip FSL applies to images in neurological order
+    """
+    zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+    matrix = np.diag(np.append(zooms, 1.0))
+    if np.linalg.det(img.affine) > 0:
+        matrix[0, 0] = -zooms[0]
+        matrix[0, 3] = (img.shape[0] - 1) * zooms[0]
+    return matrix
+
+
+def fsl_to_fsl(source_img, target_img):
+    """
+    FSL coordinates of source_img to those of target_img through their common world space
+    """
+    return (vox2fsl(target_img) @ np.linalg.inv(target_img.affine) @ source_img.affine
+            @ np.linalg.inv(vox2fsl(source_img)))
+
+
+def flirt_matrix_command(source_file, reference, mat_file, flags, init_file=None):
+    """
+    a FLIRT command that only writes the matrix, which nipype's FLIRT cannot give as it always adds -out
+    """
+    init = f" -init {init_file}" if init_file else ""
+    return f"flirt -in {source_file} -ref {reference} -omat {mat_file}{init} {flags}"
+
+
+def provenance_file(mat_file):
+    mat_file = Path(mat_file)
+    return mat_file.parents[0] / mat_file.name.replace(".mat", "_registration.json")
+
+
+def write_provenance(source_file, mat_file, config=None):
+    """
+    record what a matrix maps between and how it was made, for resampling the volume later
+    """
+    config = config or get_config()
+    registration = get_registration(config)
+    reference = nib.load(config.REFERENCE_TEMPLATE)
+    flags = config.FLIRT_FLAGS if registration['MODE'] == 'single' else \
+        f"{registration['COARSE_FLAGS']} ; {registration['FINE_FLAGS']}"
+    provenance = {
+        'source': Path(source_file).as_posix(),
+        'source_mtime': os.stat(source_file).st_mtime if os.path.exists(source_file) else None,
+        'matrix': Path(mat_file).as_posix(),
+        'reference': Path(config.REFERENCE_TEMPLATE).as_posix(),
+        'reference_shape': list(reference.shape[:3]),
+        'reference_affine': reference.affine.tolist(),
+        'mode': registration['MODE'],
+        'flags': flags,
+        'created': datetime.now().isoformat(),
+    }
+    out_file = provenance_file(mat_file)
+    tmp_file = out_file.parents[0] / f"{out_file.name}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(provenance, f, indent=2)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def coarse_templates(config=None):
+    """
+    the downsampled template and the matrix from its FSL coordinates to those of REFERENCE_TEMPLATE, built the
+    first time they are needed. Concurrent callers wait for the first one to finish.
+    :return: (coarse template, correction matrix file)
+    """
+    config = config or get_config()
+    resolution = get_registration(config)['COARSE_RESOLUTION']
+    template = Path(config.REFERENCE_TEMPLATE)
+    template_dir = Path(config.REGISTRATION_DIR) / "templates"
+    template_dir.mkdir(parents=True, exist_ok=True)
+    stem = template.name.replace(".nii.gz", "").replace(".nii", "")
+    coarse = template_dir / f"{stem}_{resolution}mm.nii.gz"
+    correction = template_dir / f"{stem}_{resolution}mm_to_template.mat"
+
+    with open(template_dir / ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            stale = not coarse.is_file() or coarse.stat().st_mtime < template.stat().st_mtime
+            if stale:
+                resample = fsl.FLIRT()
+                resample.inputs.in_file = template
+                resample.inputs.reference = template
+                resample.inputs.apply_isoxfm = float(resolution)
+                resample.inputs.out_file = coarse
+                resample.inputs.out_matrix_file = template_dir / f"{stem}_{resolution}mm_resample.mat"
+                resample.inputs.output_type = 'NIFTI_GZ'
+                log.info(f"building coarse template : {resample.cmdline}")
+                subprocess.run(shlex.split(resample.cmdline), check=True, capture_output=True)
+            if stale or not correction.is_file():
+                write_matrix(correction, fsl_to_fsl(nib.load(coarse), nib.load(template)))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return coarse, correction
+
+
+def coarse_to_fine_commands(source_file, target_file, mat_file, config=None):
+    """
+    the FLIRT, convert_xfm and FLIRT commands of a coarse-to-fine registration
+    :param target_file: the registered volume, or None to only write the matrix
+    :return: (commands, intermediate files to remove afterwards)
+    """
+    config = config or get_config()
+    registration = get_registration(config)
+    coarse, correction = coarse_templates(config)
+    coarse_out = Path(source_file.parents[0] / source_file.name.replace(".nii.gz", "_coarse.nii.gz"))
+    coarse_mat = Path(mat_file.parents[0] / mat_file.name.replace(".mat", "_coarse.mat"))
+    init_mat = Path(mat_file.parents[0] / mat_file.name.replace(".mat", "_init.mat"))
+
+    coarse_pass = fsl.FLIRT()
+    coarse_pass.inputs.in_file = source_file
+    coarse_pass.inputs.reference = coarse
+    coarse_pass.inputs.args = registration['COARSE_FLAGS']
+    coarse_pass.inputs.out_file = coarse_out
+    coarse_pass.inputs.out_matrix_file = coarse_mat
+    coarse_pass.inputs.output_type = 'NIFTI_GZ'
+
+    # the coarse matrix is only written by the first command, which nipype's ConvertXFM would reject
+    concat = f"convert_xfm -omat {init_mat} -concat {correction} {coarse_mat}"
+
+    if target_file is None:
+        fine_cmdline = flirt_matrix_command(source_file, config.REFERENCE_TEMPLATE, mat_file, registration['FINE_FLAGS'],
+                                            init_mat)
+    else:
+        fine_pass = fsl.FLIRT()
+        fine_pass.inputs.in_file = source_file
+        fine_pass.inputs.reference = config.REFERENCE_TEMPLATE
+        fine_pass.inputs.in_matrix_file = init_mat
+        fine_pass.inputs.args = registration['FINE_FLAGS']
+        fine_pass.inputs.out_file = target_file
+        fine_pass.inputs.out_matrix_file = mat_file
+        fine_pass.inputs.output_type = 'NIFTI_GZ'
+        fine_cmdline = fine_pass.cmdline
+    return [coarse_pass.cmdline, concat, fine_cmdline], [coarse_out, coarse_mat, init_mat]
+
+
+def rms_deviation(matrix1, matrix2, center, radius=RMS_RADIUS):
+    """
+    RMS displacement between two affine transforms over a sphere of radius about center (Jenkinson 1999)
+    """
+    difference = matrix1 @ np.linalg.inv(matrix2) - np.eye(4)
+    A = difference[:3, :3]
+    t = difference[:3, 3] + A @ center
+    return float(np.sqrt(radius ** 2 / 5.0 * np.trace(A.T @ A) + t @ t))
+
+
+def image_correlation(file1, file2, mask=None):
+    a = np.asanyarray(nib.load(file1).dataobj, dtype=np.float64)
+    b = np.asanyarray(nib.load(file2).dataobj, dtype=np.float64)
+    mask = (a != 0) | (b != 0) if mask is None else mask
+    return float(np.corrcoef(a[mask], b[mask])[0, 1])
+
+
+def template_center(config):
+    """
+    centre of mass of the template in its FSL coordinates
+    """
+    img = nib.load(config.REFERENCE_TEMPLATE)
+    data = np.asanyarray(img.dataobj, dtype=np.float64)
+    voxel = np.append(np.array(np.nonzero(data > 0)).mean(axis=1), 1.0)
+    return (vox2fsl(img) @ voxel)[:3]
+
+
+def compare_modes(files, report_file, config=None):
+    """
+    register each file in both modes and write their FLIRT time and agreement to a csv
+    """
+    import time
+    from process_mri import run_command
+    config = config or get_config()
+    center = template_center(config)
+    template_mask = np.asanyarray(nib.load(config.REFERENCE_TEMPLATE).dataobj) > 0
+    rows = []
+    for source_file in files:
+        single_out = Path(source_file.parents[0] / source_file.name.replace(".nii.gz", "_single.nii.gz"))
+        single_mat = Path(source_file.parents[0] / source_file.name.replace(".nii.gz", "_single.mat"))
+        c2f_out = Path(source_file.parents[0] / source_file.name.replace(".nii.gz", "_c2f.nii.gz"))
+        c2f_mat = Path(source_file.parents[0] / source_file.name.replace(".nii.gz", "_c2f.mat"))
+
+        single = fsl.FLIRT()
+        single.inputs.in_file = source_file
+        single.inputs.reference = config.REFERENCE_TEMPLATE
+        single.inputs.args = config.FLIRT_FLAGS
+        single.inputs.out_file = single_out
+        single.inputs.out_matrix_file = single_mat
+        single.inputs.output_type = 'NIFTI_GZ'
+        start = time.perf_counter()
+        run_command(single.cmdline, 'registration', config)
+        single_seconds = time.perf_counter() - start
+
+        commands, intermediates = coarse_to_fine_commands(source_file, c2f_out, c2f_mat, config)
+        start = time.perf_counter()
+        for cmdline in commands:
+            run_command(cmdline, 'registration', config)
+        c2f_seconds = time.perf_counter() - start
+
+        row = {'file': source_file.as_posix(), 'single_seconds': round(single_seconds, 2),
+               'c2f_seconds': round(c2f_seconds, 2),
+               'rms_mm': round(rms_deviation(read_matrix(c2f_mat), read_matrix(single_mat), center), 3),
+               'correlation': round(image_correlation(c2f_out, single_out, template_mask), 4)}
+        log.info(f"{row}")
+        rows.append(row)
+        for file in intermediates + [single_out, single_mat, c2f_out, c2f_mat]:
+            if file.is_file():
+                file.unlink()
+
+    with open(report_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['file', 'single_seconds', 'c2f_seconds', 'rms_mm', 'correlation'])
+        writer.writeheader()
+        writer.writerows(rows)
+    if rows:
+        log.info(f"FLIRT time {sum(r['single_seconds'] for r in rows):.0f}s single, "
+                 f"{sum(r['c2f_seconds'] for r in rows):.0f}s coarse-to-fine, "
+                 f"median RMS deviation {np.median([r['rms_mm'] for r in rows]):.2f}mm, "
+                 f"median correlation {np.median([r['correlation'] for r in rows]):.3f}")
+    log.info(f"wrote {report_file}")
+    return rows
+
+
+def main(sample, report_file, seed=0):
+    config = get_config()
+    pattern = config.DIR_STRUCTURE.replace(' ', '_') + '/*_bet.nii.gz'
+    files = sorted(discover(config.NII_DIR, pattern, n_workers=config.DISCOVERY_WORKERS))
+    if sample and len(files) > sample:
+        files = sorted(random.Random(seed).sample(files, sample))
+    compare_modes(files, report_file, config)
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare single pass and coarse-to-fine registration')
+    parser.add_argument('--sample', help='number of skull-stripped files to compare', default=20, type=int)
+    parser.add_argument('--report', help='csv report', default=os.path.join(os.getcwd(), 'registration_report.csv'))
+    args = parser.parse_args()
+    main(args.sample, args.report)
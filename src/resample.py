@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Registered volumes on demand. With REGISTRATION OUTPUT matrix, process_registration stops at the FLIRT matrix and
+its provenance json, and the volume is only resampled here when something asks for it, at the resolution and
+interpolation asked for. Resampled volumes are kept in a disk cache bounded to CACHE_MB, least recently used first out.
+
+    volumes = RegisteredVolumes()
+    img = volumes.load("/tmp/data/_nii/p1/Head_Demyelination/s1/a_FLAIR.mat", resolution=2, interpolation='trilinear')
+
+    python src/resample.py --resolution 2 --interpolation trilinear
+resamples every registration that only has a matrix, to warm the cache.
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import argparse
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from contextlib import contextmanager
+from scipy.ndimage import affine_transform
+from utils import get_config
+from discovery import discover
+from registration import get_registration, read_matrix, vox2fsl, provenance_file
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+# FLIRT -interp names to spline orders
+INTERPOLATION_ORDERS = {'nearestneighbour': 0, 'trilinear': 1, 'spline': 3}
+LOCK_FILE = ".lock"
+
+
+def output_grid(reference_shape, reference_affine, resolution=None):
+    """
+    the shape and affine of the reference grid at an isotropic resolution in mm, keeping the centre of the first
+    voxel. None keeps the reference grid.
+    """
+    shape = np.array(reference_shape[:3], dtype=int)
+    affine = np.array(reference_affine, dtype=float)
+    if resolution is None:
+        return tuple(int(n) for n in shape), affine
+    zooms = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+    scale = float(resolution) / zooms
+    shape = np.maximum(np.round(shape / scale), 1).astype(int)
+    return tuple(int(n) for n in shape), affine @ np.diag(np.append(scale, 1.0))
+
+
+def voxel_map(matrix, source_img, reference_img, out_affine):
+    """
+    the affine from output voxels to source voxels for a FLIRT matrix from source to reference FSL coordinates
+    """
+    return (np.linalg.inv(vox2fsl(source_img)) @ np.linalg.inv(matrix) @ vox2fsl(reference_img)
+            @ np.linalg.inv(reference_img.affine) @ out_affine)
+
+
+def resample(source_img, matrix, reference_img, resolution=None, interpolation='spline'):
+    """
+    apply a FLIRT matrix to source_img on the reference grid at the given resolution
+    :return: Nifti1Image
+    """
+    if interpolation not in INTERPOLATION_ORDERS:
+        raise ValueError(f"unknown interpolation {interpolation}, use one of {sorted(INTERPOLATION_ORDERS)}")
+    shape, out_affine = output_grid(reference_img.shape, reference_img.affine, resolution)
+    mapping = voxel_map(matrix, source_img, reference_img, out_affine)
+    data = np.asanyarray(source_img.dataobj, dtype=np.float32)
+    resampled = affine_transform(data, mapping[:3, :3], offset=mapping[:3, 3], output_shape=shape,
+                                 order=INTERPOLATION_ORDERS[interpolation], mode='constant', cval=0.0)
+    img = nib.Nifti1Image(resampled, out_affine)
+    img.set_qform(out_affine, code=1)
+    img.set_sform(out_affine, code=1)
+    return img
+
+
+def load_provenance(file):
+    """
+    the provenance of a registration from its json, its .mat file or the file that was registered
+    """
+    file = Path(file)
+    if file.name.endswith("_registration.json"):
+        json_file = file
+    elif file.suffix == ".mat":
+        json_file = provenance_file(file)
+    else:
+        json_file = provenance_file(file.parents[0] / file.name.replace("_bet.nii.gz", ".mat"))
+    with open(json_file, 'r') as f:
+        return json.load(f)
+
+
+@contextmanager
+def locked(path):
+    with open(Path(path) / LOCK_FILE, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class RegisteredVolumes(object):
+    """
+    Resamples registrations on first access and caches the results as uncompressed nii files, which are
+    memory-mapped when read back. A cached volume is keyed by its matrix, source file, reference, resolution and
+    interpolation, so a registration that is re-run is resampled again. Once the cache is over max_bytes the least
+    recently read volumes are removed.
+    """
+    def __init__(self, config=None, cache_dir=None, max_bytes=None):
+        config = config or get_config()
+        registration = get_registration(config)
+        self.cache_dir = Path(cache_dir or registration['CACHE_DIR'] or f"{config.REGISTRATION_DIR}/resampled")
+        self.max_bytes = int(max_bytes if max_bytes is not None else float(registration['CACHE_MB']) * 1024 * 1024)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def cache_key(self, provenance, resolution, interpolation):
+        stamps = [os.stat(provenance[k]).st_mtime_ns for k in ('matrix', 'source', 'reference')]
+        key = json.dumps([provenance['matrix'], provenance['source'], provenance['reference'], stamps,
+                          resolution, interpolation])
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def load(self, file, resolution=None, interpolation='spline'):
+        """
+        the registered volume of a registration, resampled now unless it is in the cache
+        :param file: the provenance json, .mat file or registered _bet file
+        :param resolution: isotropic voxel size in mm, None for the grid of REFERENCE_TEMPLATE
+        :param interpolation: nearestneighbour, trilinear or spline
+        :return: Nifti1Image
+        """
+        provenance = load_provenance(file)
+        resolution = float(resolution) if resolution is not None else None
+        cache_file = self.cache_dir / f"{self.cache_key(provenance, resolution, interpolation)}.nii"
+        if cache_file.is_file():
+            os.utime(cache_file)
+            log.debug(f"resampled {provenance['source']} from cache {cache_file}")
+            return nib.load(cache_file, mmap=True)
+
+        img = resample(nib.load(provenance['source']), read_matrix(provenance['matrix']),
+                       nib.load(provenance['reference']), resolution, interpolation)
+        log.info(f"resampled {provenance['source']} at {resolution or 'reference'} resolution, {interpolation}")
+        tmp_file = self.cache_dir / f"{cache_file.stem}.{os.getpid()}.tmp.nii"
+        nib.save(img, tmp_file)
+        os.replace(tmp_file, cache_file)
+        self.evict(keep=cache_file)
+        return nib.load(cache_file, mmap=True)
+
+    def evict(self, keep=None):
+        """
+        remove the least recently read volumes until the cache is within max_bytes
+        """
+        with locked(self.cache_dir):
+            entries = []
+            for file in self.cache_dir.glob("*.nii"):
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file))
+            total = sum(size for _, size, _ in entries)
+            for _, size, file in sorted(entries, key=lambda e: e[0]):
+                if total <= self.max_bytes:
+                    break
+                if file == keep:
+                    continue
+                file.unlink(missing_ok=True)
+                total -= size
+                log.debug(f"evicted {file} from the resample cache")
+        return total
+
+
+def main(resolution=None, interpolation='spline'):
+    config = get_config()
+    volumes = RegisteredVolumes(config)
+    pattern = config.DIR_STRUCTURE.replace(' ', '_') + '/*_registration.json'
+    files = sorted(discover(config.NII_DIR, pattern, n_workers=config.DISCOVERY_WORKERS))
+    for file in files:
+        volumes.load(file, resolution, interpolation)
+    log.info(f"resampled {len(files)} registrations into {volumes.cache_dir}")
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='resample the registrations that only have a matrix')
+    parser.add_argument('--resolution', help='isotropic voxel size in mm, the template grid by default',
+                        default=None, type=float)
+    parser.add_argument('--interpolation', help='nearestneighbour, trilinear or spline', default='spline',
+                        choices=sorted(INTERPOLATION_ORDERS))
+    args = parser.parse_args()
+    main(args.resolution, args.interpolation)
@@ -13,6 +13,63 @@ logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:
 log = logging.getLogger(__name__)
 
 
+def rescale_dataset(dcm, file=None):
+    """
+    decompress and rescale a dataset in place, replacing its PixelData
+    :return: the rescaled pixel array, or None if the dataset has no rescale
+    """
+    if dcm.file_meta.TransferSyntaxUID in [JPEGLosslessSV1]:
+        log.debug(f"decompressing : [{file}]")
+        dcm.decompress()  # inline decompression, modifies header to
+
+    # Will skip if the Rescale Intercept not present
+    if 'RescaleIntercept' not in dcm:
+        log.debug(f"No Rescale Present : [{file}] ")
+        return None
+
+    log.debug(f"Rescaling : [{file}]")
+    # extract the darkest and brightest pixel intensities in the rescale domain
+    # darkest_pixexsl = window_center - 0.5*window_width
+    # brightest_pixel = window_center + 0.5*window_width
+    try:
+        c1, c2 = dcm.WindowCenter
+        w1, w2 = dcm.WindowWidth
+    except:
+        c1 = dcm.WindowCenter
+        w1 = dcm.WindowCenter
+    darkest = c1 - w1 / 2
+    brightest = c1 + w1 / 2
+
+    # calcuate the darkest and brightest pixel in the no-scale domain
+    # using pixel_intensity = slope * stored_value + Intercept
+    slope = dcm.RescaleSlope
+    intercept = dcm.RescaleIntercept
+    xd = (darkest - intercept) // slope
+    xb = (brightest - intercept) // slope
+
+    # calculate the new center and width
+    # using previous equation
+    new_c = (xd + xb) // 2
+    new_w = (xb - xd)
+
+    # update dicom file keys
+    del dcm.RescaleSlope
+    del dcm.RescaleIntercept
+    del dcm.RescaleType
+    dcm.WindowCenter = new_c
+    dcm.WindowWidth = new_w
+    img = dcm.pixel_array
+
+    # yields the same result as img, since no transformation
+    mod = util.apply_modality_lut(img, dcm)
+    # yields the windowed transformation with pixel intensities doubled
+    voi = util.apply_voi_lut(mod, dcm, index=0)
+    # halving the data to fit in the appropriate data range
+    new_data = (voi // 2).astype(np.ushort)
+    dcm.PixelData = new_data.tobytes()
+    return new_data
+
+
 def rescale_dicom(source_dir, rescale_dir=None, replace=False):
     if not replace:
         if rescale_dir is None:
@@ -25,55 +82,8 @@ def rescale_dicom(source_dir, rescale_dir=None, replace=False):
         # Reading the DICOM file
         dcm = dcmread(source_dir / file)
         log.info(f"file:[{file}]")
-        if dcm.file_meta.TransferSyntaxUID in [JPEGLosslessSV1]:
-            log.debug(f"decompressing : [{file}]")
-            dcm.decompress()  # inline decompression, modifies header to
-
-        # Will skip if the Rescale Intercept not present
-        if 'RescaleIntercept' not in dcm:
-            log.debug(f"No Rescale Present : [{file}] ")
-        else:
-            log.debug(f"Rescaling : [{file}]")
-            # extract the darkest and brightest pixel intensities in the rescale domain
-            # darkest_pixexsl = window_center - 0.5*window_width
-            # brightest_pixel = window_center + 0.5*window_width
-            try:
-                c1, c2 = dcm.WindowCenter
-                w1, w2 = dcm.WindowWidth
-            except:
-                c1 = dcm.WindowCenter
-                w1 = dcm.WindowCenter
-            darkest = c1 - w1 / 2
-            brightest = c1 + w1 / 2
-
-            # calcuate the darkest and brightest pixel in the no-scale domain
-            # using pixel_intensity = slope * stored_value + Intercept
-            slope = dcm.RescaleSlope
-            intercept = dcm.RescaleIntercept
-            xd = (darkest - intercept) // slope
-            xb = (brightest - intercept) // slope
-
-            # calculate the new center and width
-            # using previous equation
-            new_c = (xd + xb) // 2
-            new_w = (xb - xd)
-
-            # update dicom file keys
-            del dcm.RescaleSlope
-            del dcm.RescaleIntercept
-            del dcm.RescaleType
-            dcm.WindowCenter = new_c
-            dcm.WindowWidth = new_w
-            img = dcm.pixel_array
-
-            # yields the same result as img, since no transformation
-            mod = util.apply_modality_lut(img, dcm)
-            # yields the windowed transformation with pixel intensities doubled
-            voi = util.apply_voi_lut(mod, dcm, index=0)
-            # halving the data to fit in the appropriate data range
-            new_data = voi // 2
-            dcm.PixelData = new_data.astype(np.ushort).tobytes()
-            # saving the file
+        rescale_dataset(dcm, file)
+        # saving the file
         if replace:
             dcm.save_as(source_dir / file)
         else:
@@ -89,6 +99,17 @@ def rescale_dicom(source_dir, rescale_dir=None, replace=False):
     return rescale_dir
 
 
+def save_datasets(datasets, rescale_dir):
+    """
+    write datasets that were rescaled in memory to rescale_dir, for dcm2niix
+    """
+    for i, (dcm, _) in enumerate(datasets):
+        name = Path(str(dcm.filename)).name if isinstance(dcm.filename, (str, Path)) else f"IM{i:05d}"
+        dcm.save_as(Path(rescale_dir) / name)
+    log.info(f"saved {len(datasets)} rescaled files to [{rescale_dir}]")
+    return rescale_dir
+
+
 def clean_replace_dir(dirname):
     log.info("cleaning files")
     files = filter(Path.is_file, dirname.glob("**/*"))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Sizes the worker pool from the cgroup CPU and memory limits, sets the thread count of the tools each worker
+starts, optionally pins workers to cores or NUMA nodes and throttles task admission from /proc load and memory pressure
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import math
+import time
+import logging
+from pathlib import Path
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+NUMA_ROOT = Path("/sys/devices/system/node")
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'FSLSUB_PARALLEL')
+DEFAULT_RESOURCES = {
+    'THREADS_PER_WORKER': 1,
+    'MEMORY_PER_WORKER': 2048,
+    'PIN': 'none',
+    'ADMISSION': True,
+    'MAX_LOAD': 1.5,
+    'MIN_AVAILABLE_MEMORY': 1024,
+    'MAX_MEMORY_PRESSURE': 10.0,
+    'INTERVAL': 5,
+}
+
+
+def get_resources(config):
+    resources = dict(DEFAULT_RESOURCES)
+    resources.update(config.get('RESOURCES') or {})
+    return resources
+
+
+def read_first_line(file):
+    try:
+        with open(file, 'r') as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit():
+    """
+    the CPU quota of the cgroup as a number of CPUs, or None if there is no quota
+    """
+    line = read_first_line(CGROUP_ROOT / "cpu.max")
+    if line is not None:
+        quota, period = line.split()
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    quota = read_first_line(CGROUP_ROOT / "cpu" / "cpu.cfs_quota_us")
+    period = read_first_line(CGROUP_ROOT / "cpu" / "cpu.cfs_period_us")
+    if quota is None or period is None or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def cgroup_memory_limit():
+    """
+    the memory limit of the cgroup in bytes, or None if there is no limit
+    """
+    line = read_first_line(CGROUP_ROOT / "memory.max")
+    if line is None:
+        line = read_first_line(CGROUP_ROOT / "memory" / "memory.limit_in_bytes")
+    if line is None or line == 'max':
+        return None
+    limit = int(line)
+    # cgroup v1 reports an unlimited group as a huge page-aligned number
+    return None if limit >= 2 ** 60 else limit
+
+
+def meminfo():
+    """
+    /proc/meminfo in bytes
+    """
+    info = {}
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                info[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return info
+
+
+def memory_pressure():
+    """
+    the share of the last 10s some task spent stalled on memory (PSI), or None if unavailable
+    """
+    line = read_first_line("/proc/pressure/memory")
+    if not line:
+        return None
+    fields = dict(field.split('=') for field in line.split()[1:])
+    return float(fields['avg10'])
+
+
+def available_cpus():
+    cpus = len(os.sched_getaffinity(0))
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.floor(quota)))
+    return cpus
+
+
+def available_memory():
+    """
+    memory available to the pool in bytes, the tighter of the cgroup limit and MemAvailable
+    """
+    available = meminfo().get('MemAvailable')
+    limit = cgroup_memory_limit()
+    if limit is not None:
+        available = limit if available is None else min(limit, available)
+    return available
+
+
+def worker_count(resources):
+    """
+    the pool size that fits the CPU and memory limits given the threads and memory each worker needs
+    """
+    cpus = available_cpus()
+    n_workers = max(1, cpus // int(resources['THREADS_PER_WORKER']))
+    memory = available_memory()
+    if memory is not None and resources['MEMORY_PER_WORKER']:
+        n_workers = min(n_workers, max(1, memory // (int(resources['MEMORY_PER_WORKER']) * 1024 * 1024)))
+    log.info(f"using {n_workers} workers for {cpus} cpus and {memory} bytes of memory")
+    return int(n_workers)
+
+
+def thread_env(threads):
+    return {name: str(threads) for name in THREAD_VARIABLES}
+
+
+def parse_cpulist(cpulist):
+    """
+    expand a kernel cpulist such as "0-3,8-11"
+    """
+    cpus = []
+    for part in cpulist.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes():
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    for node in sorted(NUMA_ROOT.glob("node[0-9]*")):
+        cpus = [cpu for cpu in parse_cpulist(read_first_line(node / "cpulist") or "") if cpu in allowed]
+        if cpus:
+            nodes.append(cpus)
+    return nodes
+
+
+def cpu_sets(n_workers, pin, threads_per_worker=1):
+    """
+    the cpus each worker slot is pinned to: 'core' gives every worker its own threads_per_worker cpus,
+    'numa' spreads the workers over the NUMA nodes, anything else leaves them unpinned
+    """
+    if pin == 'numa':
+        nodes = numa_nodes()
+        if nodes:
+            return [nodes[i % len(nodes)] for i in range(n_workers)]
+    elif pin == 'core':
+        cpus = sorted(os.sched_getaffinity(0))
+        width = max(1, int(threads_per_worker))
+        sets = [cpus[i * width:(i + 1) * width] for i in range(len(cpus) // width)]
+        if sets:
+            return [sets[i % len(sets)] for i in range(n_workers)]
+    return []
+
+
+def init_worker(env, cpu_sets, slot_counter):
+    """
+    ProcessPoolExecutor initializer: the thread variables and cpu affinity are inherited by every tool
+    the worker starts
+    """
+    os.environ.update(env)
+    if cpu_sets:
+        with slot_counter.get_lock():
+            slot = slot_counter.value
+            slot_counter.value += 1
+        os.sched_setaffinity(0, cpu_sets[slot % len(cpu_sets)])
+        log.debug(f"worker {os.getpid()} pinned to cpus {cpu_sets[slot % len(cpu_sets)]}")
+
+
+class AdmissionController(object):
+    """
+    Limits the number of tasks in flight. The limit drops by one while the load per cpu, available memory or
+    memory pressure is past its threshold, and climbs back towards the pool size when the node has room.
+    """
+    def __init__(self, n_workers, resources):
+        self.n_workers = n_workers
+        self.limit = n_workers
+        self.enabled = bool(resources['ADMISSION'])
+        self.max_load = float(resources['MAX_LOAD']) * available_cpus()
+        self.min_memory = int(resources['MIN_AVAILABLE_MEMORY']) * 1024 * 1024
+        self.max_pressure = float(resources['MAX_MEMORY_PRESSURE'])
+        self.interval = float(resources['INTERVAL'])
+        self.checked = 0.0
+
+    def overloaded(self):
+        load = os.getloadavg()[0]
+        memory = available_memory()
+        pressure = memory_pressure()
+        reasons = []
+        if load > self.max_load:
+            reasons.append(f"load {load:.1f}")
+        if memory is not None and memory < self.min_memory:
+            reasons.append(f"available memory {memory // 2 ** 20}MB")
+        if pressure is not None and pressure > self.max_pressure:
+            reasons.append(f"memory pressure {pressure:.1f}")
+        return reasons
+
+    def allowed(self):
+        """
+        the number of tasks that may currently be in flight
+        """
+        now = time.monotonic()
+        if not self.enabled or now - self.checked < self.interval:
+            return self.limit
+        self.checked = now
+        reasons = self.overloaded()
+        if reasons and self.limit > 1:
+            self.limit -= 1
+            log.info(f"throttling to {self.limit} tasks in flight : {', '.join(reasons)}")
+        elif not reasons and self.limit < self.n_workers:
+            self.limit += 1
+            log.info(f"admitting up to {self.limit} tasks in flight")
+        return self.limit
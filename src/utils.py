@@ -16,11 +16,20 @@ __status__ = "Development"
 
 import os
 import yaml
+import shutil
+import tempfile
 import logging
 from nipype.interfaces.dcm2nii import Dcm2niix
-from munch import munchify
+from munch import freeze
 from pathlib import Path
-from rescale_dicom import rescale_dicom, clean_replace_dir
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+from rescale_dicom import rescale_dicom, save_datasets, clean_replace_dir
+from dicom_to_nifti import convert_series, compare_outputs
+from dedup import find_duplicates, write_manifest
+from discovery import discover, rules_from_config, DISCOVERY_WORKERS
 
 
 logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
@@ -30,6 +39,127 @@ log = logging.getLogger(__name__)
 
 
 CONFIG = None
+CONFIG_FILE = Path(os.path.dirname(os.path.abspath(__file__))) / ".." / "config.yml"
+
+REQUIRED_KEYS = ('SOURCE_DIR', 'DIR_STRUCTURE', 'DCM2NIIX_FLAGS', 'BET_FLAGS', 'FLAIR_BET_FLAGS',
+                 'FSLREORIENT2DSTD_FLAGS', 'FLIRT_FLAGS', 'REFERENCE_TEMPLATE')
+OPTIONAL_KEYS = {
+    'DCM2NIIX': None,
+    'BET': None,
+    'DEDUPLICATE': False,
+    'DISCOVERY': {},
+    'TOOL_LIMITS': {},
+    'RESOURCES': {},
+    'PACK': {},
+    'QC': {},
+    'CONVERSION': {},
+    'METRICS': {},
+    'REGISTRATION': {},
+    'ARCHIVES': {},
+    'WATCH': {},
+}
+# TIMEOUT in seconds and MEMORY in MB, 0 for no limit. RETRIES further attempts, BACKOFF seconds before the first
+DEFAULT_TOOL_LIMITS = {'TIMEOUT': 0, 'MEMORY': 0, 'RETRIES': 0, 'BACKOFF': 10}
+TOOL_STAGES = ('bet', 'reorient', 'registration')
+FLAIR_NAMES = ('FLAIR', 'flair', 'Flair')
+DERIVED_KEYS = ('NII_DIR', 'REPLACE_DIR', 'REGISTRATION_DIR', 'BRAINEXTRACTION_DIR', 'COST_HISTORY',
+                'FAILURE_LEDGER', 'DUPLICATES_MANIFEST', 'DISCOVERY_WORKERS', 'STAGE_LIMITS',
+                'PACK_DIR', 'QC_HISTORY', 'QC_REJECTS')
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class Config(object):
+    """
+    Validated, read-only and hashable snapshot of config.yml with the values derived from it.
+    It is built once in the parent and handed to the workers, which never read the file themselves.
+    """
+    __slots__ = REQUIRED_KEYS + tuple(OPTIONAL_KEYS) + DERIVED_KEYS
+
+    def __init__(self, values):
+        if not isinstance(values, dict):
+            raise ConfigError(f"config must be a mapping, not {type(values).__name__}")
+        missing = [key for key in REQUIRED_KEYS if key not in values]
+        if missing:
+            raise ConfigError(f"missing config keys {missing}")
+        unknown = sorted(set(values) - set(REQUIRED_KEYS) - set(OPTIONAL_KEYS))
+        if unknown:
+            log.warning(f"ignoring unknown config keys {unknown}")
+        for key in REQUIRED_KEYS:
+            if not isinstance(values[key], str):
+                raise ConfigError(f"{key} must be a string, not {values[key]!r}")
+        for key in ('SOURCE_DIR', 'DIR_STRUCTURE', 'REFERENCE_TEMPLATE'):
+            if not values[key]:
+                raise ConfigError(f"{key} must not be empty")
+        for key, default in OPTIONAL_KEYS.items():
+            value = values.get(key, default)
+            if value is None:
+                value = default
+            if isinstance(default, dict) and not isinstance(value, dict):
+                raise ConfigError(f"{key} must be a mapping, not {value!r}")
+            object.__setattr__(self, key, freeze(value))
+        for key in REQUIRED_KEYS:
+            object.__setattr__(self, key, values[key])
+
+        source = self.SOURCE_DIR
+        object.__setattr__(self, 'NII_DIR', f"/tmp/{source}_nii")
+        object.__setattr__(self, 'REPLACE_DIR', f"/tmp/{source}_replace")
+        object.__setattr__(self, 'REGISTRATION_DIR', f"/tmp/{source}_registration")
+        object.__setattr__(self, 'BRAINEXTRACTION_DIR', f"/tmp/{source}_brainextraction")
+        object.__setattr__(self, 'COST_HISTORY', f"/tmp/{source}_cost_history.jsonl")
+        object.__setattr__(self, 'FAILURE_LEDGER', f"/tmp/{source}_failures.json")
+        object.__setattr__(self, 'DUPLICATES_MANIFEST', f"{self.NII_DIR}/duplicates.yml")
+        object.__setattr__(self, 'DISCOVERY_WORKERS', int(self.DISCOVERY.get('WORKERS', DISCOVERY_WORKERS)))
+        object.__setattr__(self, 'STAGE_LIMITS', freeze({stage: self._stage_limits(stage) for stage in TOOL_STAGES}))
+        object.__setattr__(self, 'PACK_DIR', self.PACK.get('DIR') or f"/tmp/{source}_packed")
+        object.__setattr__(self, 'QC_HISTORY', f"/tmp/{source}_qc_history.jsonl")
+        object.__setattr__(self, 'QC_REJECTS', f"/tmp/{source}_qc_rejects.jsonl")
+
+    def _stage_limits(self, stage):
+        limits = dict(DEFAULT_TOOL_LIMITS)
+        limits.update({k: v for k, v in self.TOOL_LIMITS.items() if k in DEFAULT_TOOL_LIMITS})
+        overrides = self.TOOL_LIMITS.get(stage.upper()) or {}
+        unknown = set(overrides) - set(DEFAULT_TOOL_LIMITS)
+        if unknown:
+            raise ConfigError(f"unknown TOOL_LIMITS.{stage.upper()} keys {sorted(unknown)}")
+        limits.update(overrides)
+        for key, value in limits.items():
+            if not isinstance(value, (int, float)) or value < 0:
+                raise ConfigError(f"TOOL_LIMITS {key} for {stage} must be a number >= 0, not {value!r}")
+        return limits
+
+    def __setattr__(self, k, v):
+        raise AttributeError(f"config is read-only, cannot set {k}")
+
+    def __delattr__(self, k):
+        raise AttributeError(f"config is read-only, cannot delete {k}")
+
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
+
+    def __eq__(self, other):
+        return isinstance(other, Config) and self.__getstate__() == other.__getstate__()
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, key) for key in REQUIRED_KEYS + tuple(OPTIONAL_KEYS)))
+
+    def get(self, k, d=None):
+        return getattr(self, k, d) if k in self.__slots__ else d
+
+    def bet_flags(self, source_file):
+        """
+        the BET flags for a file, FLAIR_BET_FLAGS for FLAIR sequences
+        """
+        source = source_file.as_posix() if isinstance(source_file, Path) else str(source_file)
+        if any(x in source for x in FLAIR_NAMES):
+            return self.FLAIR_BET_FLAGS
+        return self.BET_FLAGS
 
 
 def get_source_dir():
@@ -42,23 +172,47 @@ def get_dir_structure():
 
 
 def get_nii_dir():
-    source = get_config().SOURCE_DIR
-    return f"/tmp/{source}_nii"
+    return get_config().NII_DIR
 
 
 def get_replace_dir():
-    source = get_config().SOURCE_DIR
-    return f"/tmp/{source}_replace"
+    return get_config().REPLACE_DIR
 
 
 def get_registration_dir():
-    source = get_config().SOURCE_DIR
-    return f"/tmp/{source}_registration"
+    return get_config().REGISTRATION_DIR
 
 
 def get_brainextraction_dir():
-    source = get_config().SOURCE_DIR
-    return f"/tmp/{source}_brainextraction"
+    return get_config().BRAINEXTRACTION_DIR
+
+
+def get_discovery_workers():
+    return get_config().DISCOVERY_WORKERS
+
+
+def get_cost_history():
+    return get_config().COST_HISTORY
+
+
+def get_failure_ledger():
+    return get_config().FAILURE_LEDGER
+
+
+def get_pack_dir():
+    return get_config().PACK_DIR
+
+
+def get_duplicates_manifest():
+    return get_config().DUPLICATES_MANIFEST
+
+
+def mirror_dir(s_dir, source_dir, target_dir):
+    """
+    maps a directory under source_dir to the same place under target_dir
+    """
+    t_dir = Path(s_dir.as_posix().replace(source_dir.as_posix(), target_dir.as_posix(), 1))
+    return Path(t_dir.as_posix().replace(' ', '_'))
 
 
 def initialise(clean_old=False):
@@ -66,11 +220,11 @@ def initialise(clean_old=False):
     prepare the nii files
     :return:
     """
-    source_dir = Path(get_source_dir())
-    dir_structure = get_config().DIR_STRUCTURE
-    nii_dir = Path(get_nii_dir())
-    replace_dir = Path(get_replace_dir())
-    DCM2NIIX_FLAGS = get_config().DCM2NIIX_FLAGS
+    config = get_config()
+    source_dir = Path(config.SOURCE_DIR)
+    dir_structure = config.DIR_STRUCTURE
+    nii_dir = Path(config.NII_DIR)
+    replace_dir = Path(config.REPLACE_DIR)
 
     nii_dir.mkdir(parents=True, exist_ok=True)
     replace_dir.mkdir(parents=True, exist_ok=True)
@@ -81,42 +235,100 @@ def initialise(clean_old=False):
         r = list(map(lambda x: x.unlink(), files))
         print(r)
 
-    dirs = list(source_dir.glob(dir_structure))
+    dirs = sorted(discover(source_dir, dir_structure, keep=rules_from_config(config, 'SOURCE'),
+                           want_dirs=True, n_workers=config.DISCOVERY_WORKERS))
+
+    # fingerprints of the series kept, so that copies re-sent inside archives are skipped too
+    seen = {}
+    if config.DEDUPLICATE:
+        dirs, aliases = find_duplicates(dirs, seen=seen)
+        if aliases:
+            write_manifest(config.DUPLICATES_MANIFEST, aliases, lambda x: mirror_dir(x, source_dir, nii_dir))
 
     for s_dir in dirs:
-        t_dir = Path(s_dir.as_posix().replace(source_dir.as_posix(), nii_dir.as_posix(), 1))
-        t_dir = Path(t_dir.as_posix().replace(' ', '_'))
-        t_dir.mkdir(parents=True, exist_ok=True)
+        convert_dir(s_dir, config)
+
+    if config.ARCHIVES.get('PATTERNS'):
+        from archive_source import find_archives, convert_archives
+        convert_archives(find_archives(source_dir, config), config, seen=seen)
+    return
 
-        r_dir = Path(s_dir.as_posix().replace(source_dir.as_posix(), replace_dir.as_posix(), 1))
-        r_dir = Path(r_dir.as_posix().replace(' ', '_'))
-        r_dir.mkdir(parents=True, exist_ok=True)
 
+def run_dcm2niix(s_dir, r_dir, t_dir, flags, datasets=None):
+    """
+    rescale a series into r_dir and convert it with dcm2niix
+    :param datasets: the series already read and rescaled in memory, written to r_dir as they are
+    """
+    if datasets is None:
         input_dir = rescale_dicom(s_dir, r_dir)
+    else:
+        input_dir = save_datasets(datasets, r_dir)
+
+    dcm_converter = Dcm2niix()
+    dcm_converter.inputs.source_dir = input_dir
+    dcm_converter.inputs.args = flags
+    dcm_converter.inputs.output_dir = t_dir
+    log.info(f"DCM2NIIX version : {dcm_converter.version}")
+    log.info(f"Converting [{s_dir}] => [{t_dir}]")
+    log.info(f"Interface cmd : {dcm_converter.cmdline}")
+    dcm_converter.run()
+    clean_replace_dir(input_dir)
+
+
+def convert_dir(s_dir, config=None, datasets=None):
+    """
+    convert one series directory, in memory when CONVERSION NATIVE is set and the series is simple enough,
+    otherwise with dcm2niix. With CONVERSION VALIDATE the dcm2niix output is also made and diffed.
+    :param datasets: the series read by read_datasets, for a series streamed from an archive that s_dir only names
+    """
+    config = config or get_config()
+    source_dir = Path(config.SOURCE_DIR)
+    t_dir = mirror_dir(s_dir, source_dir, Path(config.NII_DIR))
+    t_dir.mkdir(parents=True, exist_ok=True)
+    r_dir = mirror_dir(s_dir, source_dir, Path(config.REPLACE_DIR))
+    r_dir.mkdir(parents=True, exist_ok=True)
+
+    nii_file = None
+    if config.CONVERSION.get('NATIVE'):
+        nii_file = convert_series(s_dir, t_dir, config.DCM2NIIX_FLAGS, datasets)
+    if nii_file is None:
+        run_dcm2niix(s_dir, r_dir, t_dir, config.DCM2NIIX_FLAGS, datasets)
+    elif config.CONVERSION.get('VALIDATE'):
+        reference_dir = Path(tempfile.mkdtemp(dir=config.REPLACE_DIR))
+        try:
+            run_dcm2niix(s_dir, r_dir, reference_dir, config.DCM2NIIX_FLAGS, datasets)
+            differences = compare_outputs(nii_file, reference_dir)
+        finally:
+            shutil.rmtree(reference_dir)
+        if differences:
+            log.warning(f"{nii_file} differs from dcm2niix : {', '.join(differences)}")
+        else:
+            log.info(f"{nii_file} matches dcm2niix")
+    return t_dir
 
-        dcm_converter = Dcm2niix()
-        dcm_converter.inputs.source_dir = input_dir
-        dcm_converter.inputs.args = DCM2NIIX_FLAGS
-        dcm_converter.inputs.output_dir = t_dir
-        log.info(f"DCM2NIIX version : {dcm_converter.version}")
-        log.info(f"Converting [{s_dir}] => [{t_dir}]")
-        log.info(f"Interface cmd : {dcm_converter.cmdline}")
-        dcm_converter.run()
-        clean_replace_dir(input_dir)
-    return
+
+def load_config(config_file=CONFIG_FILE):
+    """
+    read and validate a config file
+    :return: Config
+    """
+    with open(config_file, 'r') as f:
+        log.info(f"reading config from {f.name}")
+        values = yaml.load(f, Loader=SafeLoader)
+    return Config(values)
+
+
+def set_config(config):
+    """
+    install an already built config, used by the workers so they never read the file
+    """
+    global CONFIG
+    CONFIG = config
+    return CONFIG
 
 
 def get_config():
     global CONFIG
     if CONFIG is None:
-        root = Path(os.path.dirname(os.path.abspath(__file__)))
-        try:
-            with open(root / "../config.yml", 'r') as f:
-                log.info(f"reading config from {f.name}")
-                c = yaml.safe_load(f)
-                CONFIG = munchify(c)
-        except:
-            pass
-    else:
-        log.info('config already loaded')
+        CONFIG = load_config()
     return CONFIG
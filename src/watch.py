@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Watch mode: a daemon that follows SOURCE_DIR and pushes each series through conversion and the selected
+process_mri stages as soon as it has finished arriving, instead of waiting for the next batch run.
+
+New files are seen through inotify, or by rescanning the series directories every POLL_INTERVAL seconds when
+inotify_simple is not installed or SOURCE_DIR is on a network filesystem. A series is complete once it has been
+quiet for QUIET_SECONDS, or as soon as it holds exactly the ImagesInAcquisition of its single acquisition.
+Complete series wait in a priority queue with an urgent lane, picked by the URGENT discovery rules or a URGENT_MARKER
+file in the series directory or above it, and the dispatcher keeps no more series in flight than the pool has workers
+so an urgent series only ever waits for the next free worker.
+
+    python src/watch.py --bet --reorient --registration
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import time
+import queue
+import signal
+import logging
+import argparse
+import itertools
+import threading
+import multiprocessing as mp
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pydicom import dcmread
+from utils import get_config, convert_dir, mirror_dir
+from discovery import discover, compile_pattern, compile_rules, rules_from_config
+from process_mri import process_pipeline, init_pipeline_worker, load_ledger, save_ledger, final_output
+from resources import get_resources, worker_count, thread_env, cpu_sets, AdmissionController
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d:%H:%M:%S',
+                    level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+DEFAULT_WATCH = {
+    'INOTIFY': True,
+    'POLL_INTERVAL': 30,
+    'QUIET_SECONDS': 120,
+    # a series that has all its instances still waits this long for the last file to be closed
+    'SETTLE_SECONDS': 5,
+    'URGENT': [],
+    'URGENT_MARKER': '.urgent',
+}
+URGENT, NORMAL = 0, 1
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'fuse.sshfs', 'lustre', 'gpfs')
+
+
+def get_watch(config):
+    watch = dict(DEFAULT_WATCH)
+    watch.update(config.get('WATCH') or {})
+    return watch
+
+
+def filesystem_type(path):
+    """
+    the type of the filesystem path is on, from the longest matching mount point in /proc/mounts
+    """
+    path = os.path.realpath(path)
+    best, fs_type = "", None
+    try:
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                _, mount_point, mount_type = line.split()[:3]
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) \
+                        and len(mount_point) > len(best):
+                    best, fs_type = mount_point, mount_type
+    except OSError:
+        pass
+    return fs_type
+
+
+def series_files(s_dir):
+    """
+    the files of a series directory, leaving out hidden files such as the urgent marker
+    """
+    try:
+        with os.scandir(s_dir) as it:
+            return [entry for entry in it if entry.is_file() and not entry.name.startswith('.')]
+    except OSError:
+        return []
+
+
+def expected_instances(s_dir):
+    """
+    ImagesInAcquisition of a series whose files are all from one acquisition, or None if it is not given, the files
+    disagree on it or there is more than one acquisition, as it then only counts part of the series
+    """
+    acquisitions, counts = set(), set()
+    for entry in series_files(s_dir):
+        try:
+            dcm = dcmread(entry.path, stop_before_pixels=True,
+                          specific_tags=['ImagesInAcquisition', 'AcquisitionNumber'])
+        except Exception:
+            continue
+        acquisitions.add(str(dcm.get('AcquisitionNumber', '')))
+        counts.add(str(dcm.get('ImagesInAcquisition', '')))
+    if len(acquisitions) != 1 or len(counts) != 1:
+        return None
+    value = counts.pop()
+    return int(value) if value else None
+
+
+class PollingWatcher(object):
+    """
+    Rescans the series directories every interval seconds and reports those whose file count, size or
+    newest modification time changed.
+    """
+    def __init__(self, source_dir, dir_structure, keep, interval, n_workers):
+        self.source_dir = source_dir
+        self.dir_structure = dir_structure
+        self.keep = keep
+        self.interval = float(interval)
+        self.n_workers = n_workers
+        # what is already there is left to the catch up
+        self.signatures = {s_dir: self.signature(s_dir) for s_dir in self.series_dirs()}
+
+    def series_dirs(self):
+        return discover(self.source_dir, self.dir_structure, keep=self.keep, want_dirs=True, n_workers=self.n_workers)
+
+    def signature(self, s_dir):
+        files = series_files(s_dir)
+        stats = [entry.stat() for entry in files]
+        return len(stats), sum(s.st_size for s in stats), max((s.st_mtime for s in stats), default=0.0)
+
+    def poll(self, stopped):
+        """
+        :return: {series dir: time of the change} since the last poll
+        """
+        if stopped.wait(self.interval):
+            return {}
+        now = time.time()
+        changed = {}
+        for s_dir in self.series_dirs():
+            signature = self.signature(s_dir)
+            if signature[0] and self.signatures.get(s_dir) != signature:
+                self.signatures[s_dir] = signature
+                changed[s_dir] = now
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Watches every directory under source_dir that a series directory could be in, adding watches as new
+    directories appear, and reports the series directories files were written to.
+    """
+    # seconds to wait for events before returning, so quiet series are still checked
+    READ_TIMEOUT = 1.0
+
+    def __init__(self, source_dir, dir_structure, keep):
+        self.source_dir = Path(source_dir)
+        self.match = compile_pattern(dir_structure)
+        self.could_match = compile_pattern(dir_structure, prefix=True)
+        self.keep = keep
+        self.inotify = INotify()
+        self.mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO
+        self.dirs = {}
+        self.add_tree(self.source_dir)
+        # the start of the last read, every file created before it has been seen
+        self.synced = time.time()
+
+    def rel(self, directory):
+        return Path(directory).relative_to(self.source_dir).as_posix()
+
+    def add_tree(self, directory):
+        """
+        watch directory and the directories below it that could hold a series
+        :return: the series directories already holding files, for a tree that was moved in whole
+        """
+        found = []
+        for root, dirs, files in os.walk(directory):
+            rel = self.rel(root)
+            if root != str(self.source_dir) and not self.could_match(rel):
+                dirs[:] = []
+                continue
+            self.dirs[self.inotify.add_watch(root, self.mask)] = Path(root)
+            if files and self.is_series(Path(root)):
+                found.append(Path(root))
+        return found
+
+    def is_series(self, directory):
+        if directory == self.source_dir:
+            return False
+        rel = self.rel(directory)
+        return self.match(rel) and self.keep(rel, directory)
+
+    def rescan(self, since):
+        """
+        watch the directories whose events were lost, and find the series with files created since a time
+        :return: the series directories
+        """
+        return [s_dir for s_dir in self.add_tree(self.source_dir)
+                if any(entry.stat().st_ctime >= since for entry in series_files(s_dir))]
+
+    def poll(self, stopped):
+        now = time.time()
+        changed = {}
+        overflowed = False
+        for event in self.inotify.read(timeout=int(self.READ_TIMEOUT * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                overflowed = True
+                continue
+            directory = self.dirs.get(event.wd)
+            if event.mask & flags.IGNORED:
+                self.dirs.pop(event.wd, None)
+                continue
+            if directory is None:
+                continue
+            if event.mask & flags.ISDIR:
+                for s_dir in self.add_tree(directory / event.name):
+                    changed[s_dir] = now
+            elif self.is_series(directory):
+                changed[directory] = now
+        if overflowed:
+            # the kernel queue overflowed and dropped events, so new directories and files may have been missed
+            series = self.rescan(self.synced)
+            log.warning(f"inotify queue overflowed, rescanned {self.source_dir} and found {len(series)} new series")
+            changed.update((s_dir, now) for s_dir in series)
+        self.synced = now
+        return changed
+
+    def close(self):
+        self.inotify.close()
+
+
+def make_watcher(config, watch):
+    source_dir = Path(config.SOURCE_DIR)
+    keep = rules_from_config(config, 'SOURCE')
+    fs_type = filesystem_type(source_dir)
+    if INotify is None:
+        reason = "inotify_simple is not installed"
+    elif not watch['INOTIFY']:
+        reason = "INOTIFY is off"
+    elif fs_type in NETWORK_FILESYSTEMS:
+        reason = f"{source_dir} is on {fs_type}"
+    else:
+        try:
+            watcher = InotifyWatcher(source_dir, config.DIR_STRUCTURE, keep)
+            log.info(f"watching {source_dir} with inotify on {len(watcher.dirs)} directories")
+            return watcher
+        except OSError as e:
+            reason = f"inotify failed : {e}"
+    log.info(f"polling {source_dir} every {watch['POLL_INTERVAL']}s, {reason}")
+    return PollingWatcher(source_dir, config.DIR_STRUCTURE, keep, watch['POLL_INTERVAL'], config.DISCOVERY_WORKERS)
+
+
+class SeriesTracker(object):
+    """
+    The series still arriving with the time of their last change. A series is complete when it has been quiet for
+    quiet_seconds, or has settled for settle_seconds holding exactly the ImagesInAcquisition of its one acquisition.
+    """
+    def __init__(self, quiet_seconds, settle_seconds):
+        self.quiet_seconds = float(quiet_seconds)
+        self.settle_seconds = float(settle_seconds)
+        self.active = {}
+        self.first_seen = {}
+        self.expected = {}
+
+    def touch(self, s_dir, stamp):
+        self.active[s_dir] = max(stamp, self.active.get(s_dir, 0.0))
+        self.first_seen.setdefault(s_dir, stamp)
+
+    def complete(self, now):
+        """
+        :return: [(series dir, time it was first seen)] of the series that finished arriving
+        """
+        done = []
+        for s_dir, last in list(self.active.items()):
+            quiet = now - last
+            if quiet < self.settle_seconds:
+                continue
+            if quiet < self.quiet_seconds:
+                # the headers are only read again once the file count changes
+                n_files = len(series_files(s_dir))
+                checked = self.expected.get(s_dir)
+                if checked is None or checked[0] != n_files:
+                    self.expected[s_dir] = checked = (n_files, expected_instances(s_dir))
+                if checked[1] is None or n_files != checked[1]:
+                    continue
+            del self.active[s_dir]
+            self.expected.pop(s_dir, None)
+            done.append((s_dir, self.first_seen.pop(s_dir)))
+        return done
+
+
+def urgent_rule(config, watch):
+    """
+    whether a series goes in the urgent lane: it matches an URGENT rule, or it or a directory above it
+    holds the URGENT_MARKER file
+    """
+    source_dir = Path(config.SOURCE_DIR)
+    rules = compile_rules(watch['URGENT']) if watch['URGENT'] else None
+    marker = watch['URGENT_MARKER']
+
+    def is_urgent(s_dir):
+        rel = s_dir.relative_to(source_dir).as_posix()
+        if rules is not None and rules(rel, s_dir):
+            return True
+        if marker:
+            for directory in [s_dir] + list(s_dir.parents):
+                if (directory / marker).exists():
+                    return True
+                if directory == source_dir:
+                    break
+        return False
+    return is_urgent
+
+
+def series_nii_files(t_dir, config):
+    """
+    the nii files converted from a series, leaving out the outputs of the pipeline
+    """
+    nii_dir = Path(config.NII_DIR)
+    keep = rules_from_config(config, 'NII')
+    with os.scandir(t_dir) as it:
+        return sorted(Path(entry.path) for entry in it
+                      if entry.name.endswith('.nii.gz') and keep(Path(entry.path).relative_to(nii_dir).as_posix(),
+                                                                 entry))
+
+
+def processed(s_dir, config, selected, ledger):
+    """
+    whether an earlier run converted a series and took every nii file of it through the selected stages,
+    without a failure left in the ledger
+    """
+    t_dir = mirror_dir(s_dir, Path(config.SOURCE_DIR), Path(config.NII_DIR))
+    if not t_dir.is_dir():
+        return False
+    nii_files = series_nii_files(t_dir, config)
+    return bool(nii_files) and all(nii_file.as_posix() not in ledger and
+                                   final_output(nii_file, selected, config).is_file() for nii_file in nii_files)
+
+
+def process_series(s_dir, do_bet=False, do_reorient=False, do_registration=False, do_qc=False):
+    """
+    convert a series and run the selected stages on each nii file it gives
+    :return: [(original_file, {stage: runtime in seconds}, failure)] as from process_pipeline
+    """
+    config = get_config()
+    t_dir = convert_dir(s_dir, config)
+    results = []
+    for nii_file in series_nii_files(t_dir, config):
+        results.append(process_pipeline(nii_file, do_bet, do_reorient, do_registration, do_qc=do_qc))
+    return results
+
+
+class Dispatcher(object):
+    """
+    Takes complete series from a priority queue, urgent lane first and oldest first within a lane, and keeps at
+    most as many in flight as the admission controller allows. A series that changes again while it is queued is
+    only run once, and one that changes while it runs is run again afterwards.
+    """
+    def __init__(self, executor, admission, stages, ledger, ledger_file):
+        self.executor = executor
+        self.admission = admission
+        self.stages = stages
+        self.ledger = ledger
+        self.ledger_file = ledger_file
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.queued = set()
+        self.running = {}
+        self.rerun = {}
+        self.processed = 0
+        self.failures = 0
+
+    def submit(self, s_dir, arrived, lane=NORMAL):
+        with self.lock:
+            if s_dir in self.running:
+                self.rerun[s_dir] = (arrived, lane)
+                return
+            if s_dir in self.queued:
+                return
+            self.queued.add(s_dir)
+        self.queue.put((lane, next(self.counter), s_dir, arrived))
+        log.info(f"queued {'urgent ' if lane == URGENT else ''}series [{s_dir}]")
+
+    def pending(self):
+        with self.lock:
+            return len(self.queued) + len(self.running)
+
+    def run(self, stopped):
+        in_flight = {}
+        while True:
+            for future in [future for future in in_flight if future.done()]:
+                self.collect(future, *in_flight.pop(future))
+            # once stopped nothing new is started, but the series in flight are seen through
+            limit = 0 if stopped.is_set() else self.admission.allowed()
+            if in_flight and len(in_flight) >= max(limit, 1):
+                wait(in_flight, timeout=self.admission.interval, return_when=FIRST_COMPLETED)
+                continue
+            if stopped.is_set():
+                return
+            try:
+                lane, _, s_dir, arrived = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self.lock:
+                self.queued.discard(s_dir)
+                self.running[s_dir] = arrived
+            log.info(f"processing {'urgent ' if lane == URGENT else ''}series [{s_dir}], "
+                     f"{time.time() - arrived:.0f}s after it arrived")
+            future = self.executor.submit(process_series, s_dir, *self.stages)
+            in_flight[future] = (s_dir, arrived)
+
+    def collect(self, future, s_dir, arrived):
+        try:
+            results = future.result()
+        except Exception as e:
+            # not in the ledger, which only holds nii files, but the next start catches up with it
+            log.error(f"series [{s_dir}] failed : {e!r}")
+            results = []
+            self.failures += 1
+        for original_file, _, failure in results:
+            if failure is None:
+                self.ledger.pop(original_file.as_posix(), None)
+            else:
+                self.ledger[original_file.as_posix()] = failure
+                self.failures += 1
+        save_ledger(self.ledger_file, self.ledger)
+        self.processed += 1
+        log.info(f"finished series [{s_dir}] with {len(results)} files, {time.time() - arrived:.0f}s after it arrived")
+        with self.lock:
+            self.running.pop(s_dir, None)
+            rerun = self.rerun.pop(s_dir, None)
+        if rerun is not None:
+            log.info(f"series [{s_dir}] changed while it was processed, queueing it again")
+            self.submit(s_dir, *rerun)
+
+
+def main(do_bet=False, do_reorient=False, do_registration=False, do_qc=False, n_workers=0, catch_up=True):
+    config = get_config()
+    watch = get_watch(config)
+    resources = get_resources(config)
+    if n_workers == 0:
+        n_workers = worker_count(resources)
+    Path(config.NII_DIR).mkdir(parents=True, exist_ok=True)
+    Path(config.REPLACE_DIR).mkdir(parents=True, exist_ok=True)
+
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        log.info(f"received signal {signum}, finishing the series in flight")
+        stopped.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    is_urgent = urgent_rule(config, watch)
+    tracker = SeriesTracker(watch['QUIET_SECONDS'], watch['SETTLE_SECONDS'])
+    watcher = make_watcher(config, watch)
+    ledger_file = config.FAILURE_LEDGER
+    if catch_up:
+        # series that arrived while the daemon was down, or were cut short when it stopped
+        selected = {'bet': do_bet, 'qc': do_qc, 'reorient': do_reorient, 'registration': do_registration}
+        ledger = load_ledger(ledger_file)
+        for s_dir in discover(Path(config.SOURCE_DIR), config.DIR_STRUCTURE, keep=rules_from_config(config, 'SOURCE'),
+                              want_dirs=True, n_workers=config.DISCOVERY_WORKERS):
+            files = series_files(s_dir)
+            if files and not processed(s_dir, config, selected, ledger):
+                tracker.touch(s_dir, max(entry.stat().st_mtime for entry in files))
+
+    admission = AdmissionController(n_workers, resources)
+    threads = int(resources['THREADS_PER_WORKER'])
+    initargs = (config, thread_env(threads), cpu_sets(n_workers, resources['PIN'], threads), mp.Value('i', 0))
+    stages = (do_bet, do_reorient, do_registration, do_qc)
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_pipeline_worker, initargs=initargs) as executor:
+        dispatcher = Dispatcher(executor, admission, stages, load_ledger(ledger_file), ledger_file)
+        dispatch_thread = threading.Thread(target=dispatcher.run, args=(stopped,), daemon=True)
+        dispatch_thread.start()
+        try:
+            while not stopped.is_set():
+                for s_dir, stamp in watcher.poll(stopped).items():
+                    tracker.touch(s_dir, stamp)
+                for s_dir, arrived in tracker.complete(time.time()):
+                    dispatcher.submit(s_dir, arrived, URGENT if is_urgent(s_dir) else NORMAL)
+        finally:
+            stopped.set()
+            watcher.close()
+            dispatch_thread.join()
+    log.info(f"processed {dispatcher.processed} series with {dispatcher.failures} failures, "
+             f"{dispatcher.queue.qsize()} left queued for the next start")
+    return dispatcher.failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert and process each series under SOURCE_DIR as it arrives')
+    parser.add_argument('--bet', help='perform brain extraction', action='store_true')
+    parser.add_argument('--reorient', help='perform reorientation', action='store_true')
+    parser.add_argument('--registration', help='perform registration', action='store_true')
+    parser.add_argument('--qc', help='check skull-strips before registration', action='store_true')
+    parser.add_argument('--n_workers', help='number of processes', default=0, type=int)
+    parser.add_argument('--no-catch-up', help='ignore series that arrived before the daemon started',
+                        action='store_true')
+    args = parser.parse_args()
+    log.info(f"{args}")
+    failures = main(do_bet=args.bet, do_reorient=args.reorient, do_registration=args.registration, do_qc=args.qc,
+                    n_workers=args.n_workers, catch_up=not args.no_catch_up)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Series picked from the member listing of an archive, and duplicate series re-sent inside zip exports.
+
+    python -m pytest tests
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import shutil
+import zipfile
+from pathlib import Path, PurePosixPath
+import yaml
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import utils  # noqa: E402
+from utils import Config, set_config  # noqa: E402
+from archive_source import select_series  # noqa: E402
+from test_dicom_to_nifti import write_series, ORIENTATIONS  # noqa: E402
+
+SERIES = "p1/Head Demyelination/AX_FLAIR"
+
+
+def new_config(source_dir, **values):
+    return Config(dict({
+        'SOURCE_DIR': source_dir.as_posix(), 'DIR_STRUCTURE': "*/Head Demyelination/*", 'DCM2NIIX_FLAGS': "",
+        'BET_FLAGS': "", 'FLAIR_BET_FLAGS': "", 'FSLREORIENT2DSTD_FLAGS': "", 'FLIRT_FLAGS': "",
+        'REFERENCE_TEMPLATE': "template.nii.gz",
+    }, **values))
+
+
+@pytest.fixture
+def config(tmp_path):
+    return new_config(tmp_path)
+
+
+def test_selects_series_by_dir_structure(tmp_path, config):
+    members = [(f"{SERIES}/IM{k}", 100) for k in range(3)] + [
+        ("p1/Head Demyelination/DICOMDIR", 10),
+        ("p1/Other/AX_T1/IM0", 100),
+        (f"{SERIES}/nested/IM0", 100),
+    ]
+    selected = select_series(tmp_path / "export.zip", members, config)
+    assert selected == {PurePosixPath(SERIES): [f"{SERIES}/IM{k}" for k in range(3)]}
+
+
+def test_archive_below_source_dir(tmp_path, config):
+    # the archive sits where the patient directory would be, so its members start at the sequence directory
+    members = [("Head Demyelination/AX_FLAIR/IM0", 100)]
+    selected = select_series(tmp_path / "p1" / "export.zip", members, config)
+    assert list(selected) == [PurePosixPath("Head Demyelination/AX_FLAIR")]
+
+
+def test_applies_source_rules(tmp_path):
+    config = new_config(tmp_path, DISCOVERY={'SOURCE': {'EXCLUDE': [{'max_size': 150}]}})
+    members = [(f"{SERIES}/IM0", 100), ("p2/Head Demyelination/AX_T1/IM0", 100),
+               ("p2/Head Demyelination/AX_T1/IM1", 100)]
+    selected = select_series(tmp_path / "export.zip", members, config)
+    assert list(selected) == [PurePosixPath("p2/Head Demyelination/AX_T1")]
+
+
+@pytest.mark.parametrize('name', ["../Head Demyelination/evil/IM1", "p1/../../Head Demyelination/evil/IM1",
+                                  "/p1/Head Demyelination/evil/IM1"])
+def test_skips_members_outside_archive(tmp_path, config, name):
+    selected = select_series(tmp_path / "export.zip", [(f"{SERIES}/IM0", 100), (name, 100)], config)
+    assert list(selected) == [PurePosixPath(SERIES)]
+
+
+def write_zip(archive, s_dir, member_dir):
+    archive.parent.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(archive, 'w') as zf:
+        for file in sorted(s_dir.iterdir()):
+            zf.write(file, f"{member_dir}/{file.name}")
+
+
+@pytest.mark.parametrize('deduplicate', [True, False])
+def test_resent_archives_are_skipped(tmp_path, deduplicate):
+    source_dir = tmp_path / "source"
+    s_dir = source_dir / "p1" / "Head Demyelination" / "AX_FLAIR"
+    write_series(s_dir, ORIENTATIONS['axial'])
+    write_zip(source_dir / "resent.zip", s_dir, "p1/Head Demyelination/AX_FLAIR_resent")
+    write_zip(source_dir / "export.zip", s_dir, "p2/Head Demyelination/AX_FLAIR")
+    config = set_config(new_config(source_dir, DEDUPLICATE=deduplicate, CONVERSION={'NATIVE': True},
+                                   ARCHIVES={'PATTERNS': ["*.zip"], 'WORKERS': 2}))
+    try:
+        utils.initialise()
+        nii_files = sorted(Path(config.NII_DIR).glob("*/*/*/*.nii"))
+        if not deduplicate:
+            assert len(nii_files) == 3
+            return
+        assert [file.parent for file in nii_files] == [utils.mirror_dir(s_dir, source_dir, Path(config.NII_DIR))]
+        with open(config.DUPLICATES_MANIFEST) as f:
+            manifest = yaml.safe_load(f)
+        assert sorted(manifest[nii_files[0].parent.as_posix()]['aliases']) == [
+            (source_dir / "p1" / "Head Demyelination" / "AX_FLAIR_resent").as_posix(),
+            (source_dir / "p2" / "Head Demyelination" / "AX_FLAIR").as_posix(),
+        ]
+    finally:
+        set_config(None)
+        for directory in (config.NII_DIR, config.REPLACE_DIR):
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The runtime model behind the process_mri submission order: the least squares fit and its fallbacks, and the packing
+of files into balanced bins.
+
+    python -m pytest tests
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from cost_model import CostModel, MIN_FIT_SAMPLES, bin_pack, longest_first, sequence_type  # noqa: E402
+
+
+def new_records(n, stage='bet', sequence='T1', seed=0):
+    # seconds = 2 + 1e-5 voxels + 1e-6 size, exactly
+    rng = np.random.default_rng(seed)
+    records = []
+    for voxels, size in zip(rng.integers(10 ** 5, 10 ** 7, n), rng.integers(10 ** 5, 10 ** 8, n)):
+        records.append({'stage': stage, 'sequence': sequence, 'voxels': int(voxels), 'size': int(size),
+                        'seconds': 2 + 1e-5 * voxels + 1e-6 * size})
+    return records
+
+
+def test_least_squares_fit():
+    model = CostModel(new_records(20))
+    assert np.allclose(model.fits[('bet', 'T1')], [2, 1e-5, 1e-6])
+    features = {'voxels': 10 ** 6, 'size': 10 ** 7, 'sequence': 'T1'}
+    assert model.predict(features, ['bet']) == pytest.approx(22)
+    # no history for a stage adds nothing
+    assert model.predict(features, ['bet', 'registration']) == pytest.approx(22)
+
+
+def test_rate_fallback():
+    records = new_records(MIN_FIT_SAMPLES - 1)
+    model = CostModel(records)
+    rate = sum(r['seconds'] for r in records) / sum(r['voxels'] for r in records)
+    assert np.allclose(model.fits[('bet', 'T1')], [0, rate, 0])
+    assert model.predict({'voxels': 1000, 'size': 10 ** 9, 'sequence': 'T1'}, ['bet']) == pytest.approx(1000 * rate)
+
+
+def test_sequence_fallback():
+    model = CostModel(new_records(10, sequence='T1') + new_records(10, sequence='T2', seed=1))
+    # a sequence with no history of its own uses the fit over every sequence of the stage
+    assert np.allclose(model.fits[('bet', None)], [2, 1e-5, 1e-6])
+    features = {'voxels': 10 ** 6, 'size': 10 ** 7, 'sequence': 'FLAIR'}
+    assert model.predict(features, ['bet']) == pytest.approx(22)
+
+
+def test_history_round_trip(tmp_path):
+    history_file = tmp_path / "history.jsonl"
+    model = CostModel.load(history_file)
+    features = {'voxels': 10 ** 6, 'size': 10 ** 7, 'sequence': 'T1'}
+    for record in new_records(10):
+        model.append(history_file, "p1/AX_T1.nii.gz", dict(features, voxels=record['voxels'], size=record['size']),
+                     {'bet': record['seconds']})
+    with open(history_file, 'a') as f:
+        f.write("{not json\n")
+    loaded = CostModel.load(history_file)
+    assert len(loaded.records[('bet', 'T1')]) == 10
+    assert loaded.predict(features, ['bet']) == pytest.approx(22)
+
+
+@pytest.mark.parametrize('name,sequence', [
+    ("AX_FLAIR.nii.gz", 'FLAIR'), ("SAG_T1_MPRAGE.nii.gz", 'T1'), ("AX_T2.nii.gz", 'T2'), ("LOCALISER.nii.gz", 'OTHER'),
+])
+def test_sequence_type(name, sequence):
+    assert sequence_type(name) == sequence
+
+
+def test_bin_pack():
+    files = [f"f{i}" for i in range(7)]
+    predictions = [8, 7, 6, 5, 4, 2, 1]
+    bins = bin_pack(files, predictions, 3)
+    loads = sorted(sum(predictions[files.index(f)] for f in b) for b in bins)
+    assert loads == [11, 11, 11]
+    assert sorted(f for b in bins for f in b) == files
+    assert longest_first(files[::-1], predictions[::-1]) == files
+
+
+def test_bin_pack_without_predictions():
+    files = [f"f{i}" for i in range(10)]
+    bins = bin_pack(files, [0.0] * 10, 4)
+    # with no history the files are still spread over every bin
+    assert sorted(len(b) for b in bins) == [2, 2, 3, 3]
+    # and empty bins are dropped
+    assert len(bin_pack(files[:2], [1.0, 1.0], 4)) == 2
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In-memory DICOM conversion of synthetic series against dcm2niix, its json sidecar and name conflicts, and the fall back
+to dcm2niix for series it should not convert.
+
+    python -m pytest tests
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import json
+import shutil
+import numpy as np
+import nibabel as nib
+import pytest
+from pydicom import dcmread
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid, MRImageStorage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from dicom_to_nifti import read_series, convert_series, compare_outputs, LPS_TO_RAS  # noqa: E402
+
+ORIENTATIONS = {
+    'axial': (1, 0, 0, 0, 1, 0),
+    'oblique': (1, 0, 0, 0, np.cos(0.3), np.sin(0.3)),
+    'sagittal': (0, 1, 0, 0, 0, -1),
+    'coronal': (1, 0, 0, 0, 0, -1),
+}
+FLAGS = "-z y -f %p_%s"
+N_SLICES, ROWS, COLUMNS = 8, 24, 20
+
+
+def new_dataset(sop_class, series, transfer_syntax=ExplicitVRLittleEndian):
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    ds.file_meta.MediaStorageSOPClassUID = sop_class
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID = generate_uid()
+    ds.SOPClassUID = sop_class
+    ds.SeriesInstanceUID = series
+    ds.StudyInstanceUID = generate_uid()
+    ds.Modality = 'MR'
+    ds.PatientID = 'p1'
+    ds.ProtocolName = 'AX FLAIR'
+    ds.SeriesNumber = 5
+    ds.StudyDate = '20200101'
+    ds.StudyTime = '101010'
+    ds.MagneticFieldStrength = '3'
+    ds.EchoTime = '93'
+    ds.RepetitionTime = '9000'
+    ds.FlipAngle = '150'
+    return ds
+
+
+def write_series(s_dir, orientation, rescale=False, seed=0):
+    """
+    slices of a known ramp written in a shuffled order, 3mm apart along the slice normal
+    :return: the LPS position of each slice by instance number
+    """
+    s_dir.mkdir(parents=True)
+    rng = np.random.default_rng(seed)
+    series = generate_uid()
+    row_cosine, column_cosine = np.array(orientation[:3], float), np.array(orientation[3:], float)
+    normal = np.cross(row_cosine, column_cosine)
+    positions = {}
+    for k in rng.permutation(N_SLICES):
+        ds = new_dataset(MRImageStorage, series)
+        ds.InstanceNumber = int(k) + 1
+        positions[k] = np.array([-50.0, -60.0, -20.0]) + k * 3.0 * normal
+        ds.ImagePositionPatient = [f"{v:.4f}" for v in positions[k]]
+        ds.ImageOrientationPatient = [f"{v:.6f}" for v in orientation]
+        ds.PixelSpacing = ['0.9', '0.8']
+        ds.SliceThickness = '3'
+        ds.Rows, ds.Columns = ROWS, COLUMNS
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        if rescale:
+            ds.RescaleIntercept = -1024
+            ds.RescaleSlope = 1
+            ds.RescaleType = 'HU'
+            ds.WindowCenter = [40, 400]
+            ds.WindowWidth = [80, 1500]
+        pixels = (np.arange(ROWS * COLUMNS).reshape(ROWS, COLUMNS) * 3 + k * 100).astype(np.uint16)
+        ds.PixelData = pixels.tobytes()
+        ds.save_as(s_dir / f"IM{k:04d}", enforce_file_format=True)
+    return positions
+
+
+def dcm2niix_reference(s_dir, tmp_path):
+    from utils import run_dcm2niix
+    r_dir, reference_dir = tmp_path / "rescaled", tmp_path / "reference"
+    r_dir.mkdir()
+    reference_dir.mkdir()
+    run_dcm2niix(s_dir, r_dir, reference_dir, FLAGS)
+    return reference_dir
+
+
+@pytest.mark.parametrize('name', sorted(ORIENTATIONS))
+def test_affine_places_slices(tmp_path, name):
+    s_dir = tmp_path / name
+    positions = write_series(s_dir, ORIENTATIONS[name])
+    nii_file = convert_series(s_dir, tmp_path, FLAGS)
+    img = nib.load(nii_file)
+    assert img.shape == (COLUMNS, ROWS, N_SLICES)
+    for k, position in positions.items():
+        assert np.allclose(img.affine @ [0, 0, k, 1], LPS_TO_RAS @ np.append(position, 1), atol=1e-3)
+    # voxel (column, row) of slice k holds pixel [row, column] of instance k + 1
+    data = np.asanyarray(img.dataobj)
+    assert data[5, 7, 3] == 7 * COLUMNS * 3 + 5 * 3 + 300
+
+
+@pytest.mark.skipif(shutil.which('dcm2niix') is None, reason="dcm2niix is not installed")
+@pytest.mark.parametrize('name,rescale', [(name, False) for name in sorted(ORIENTATIONS)] + [('axial', True)])
+def test_matches_dcm2niix(tmp_path, name, rescale):
+    s_dir = tmp_path / "source" / name
+    write_series(s_dir, ORIENTATIONS[name], rescale)
+    native_dir = tmp_path / "native"
+    native_dir.mkdir()
+    nii_file = convert_series(s_dir, native_dir, FLAGS)
+    assert nii_file is not None
+    reference_dir = dcm2niix_reference(s_dir, tmp_path)
+    assert compare_outputs(nii_file, reference_dir) == []
+    # every field of the sidecar is one dcm2niix writes too, with the same value
+    native = json.loads(nii_file.with_name(nii_file.name.replace(".nii.gz", ".json")).read_text())
+    [reference_file] = reference_dir.glob("*.json")
+    reference = json.loads(reference_file.read_text())
+    for key, value in native.items():
+        if key != 'ConversionSoftware':
+            assert np.allclose(value, reference[key], atol=1e-4) if not isinstance(value, str) \
+                else value == reference[key], key
+
+
+@pytest.mark.parametrize('write_behaviour,names', [('0', ["AX_FLAIR_5"]), ('1', ["AX_FLAIR_5"]),
+                                                   ('2', ["AX_FLAIR_5", "AX_FLAIR_5a"])])
+def test_name_conflicts(tmp_path, write_behaviour, names):
+    s_dir = tmp_path / "axial"
+    write_series(s_dir, ORIENTATIONS['axial'])
+    t_dir = tmp_path / "nii"
+    t_dir.mkdir()
+    first = convert_series(s_dir, t_dir, FLAGS)
+    stamp = first.stat().st_mtime_ns
+    os.utime(first, ns=(stamp - 10 ** 9, stamp - 10 ** 9))
+    second = convert_series(s_dir, t_dir, f"{FLAGS} -w {write_behaviour}")
+    assert sorted(file.name for file in t_dir.glob("*.nii.gz")) == [f"{name}.nii.gz" for name in names]
+    assert sorted(file.name for file in t_dir.glob("*.json")) == [f"{name}.json" for name in names]
+    assert second.name == f"{names[-1]}.nii.gz"
+    # only -w 1 writes over the existing file
+    assert (first.stat().st_mtime_ns == stamp - 10 ** 9) == (write_behaviour != '1')
+
+
+def test_skips_datasets_without_pixels(tmp_path):
+    s_dir = tmp_path / "axial"
+    write_series(s_dir, ORIENTATIONS['axial'])
+    series = read_series(s_dir)[0][0].SeriesInstanceUID
+    # a presentation state in the series directory has no pixel data
+    state = new_dataset('1.2.840.10008.5.1.4.1.1.11.1', series)
+    state.Modality = 'PR'
+    state.save_as(s_dir / "PR0001", enforce_file_format=True)
+
+    assert len(read_series(s_dir)) == N_SLICES
+    nii_file = convert_series(s_dir, tmp_path, FLAGS)
+    assert nib.load(nii_file).shape == (COLUMNS, ROWS, N_SLICES)
+
+
+def test_undecodable_series_goes_to_dcm2niix(tmp_path):
+    s_dir = tmp_path / "axial"
+    write_series(s_dir, ORIENTATIONS['axial'])
+    broken = s_dir / "IM0000"
+    ds = dcmread(broken)
+    ds.file_meta.TransferSyntaxUID = RLELossless
+    # an RLE header that claims more segments than the frame holds
+    ds.PixelData = encapsulate([np.array([16] + [64] * 15, dtype='<u4').tobytes()])
+    ds.save_as(broken, enforce_file_format=True)
+
+    datasets = read_series(s_dir)
+    assert len(datasets) == N_SLICES
+    assert sum(pixels is None for _, pixels in datasets) == 1
+    assert convert_series(s_dir, tmp_path, FLAGS, datasets) is None
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Discovery of series directories and nii files: the glob walk against pathlib, the include/exclude rules and the
+pattern predicate used for paths that are not on disk.
+
+    python -m pytest tests
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils import Config  # noqa: E402
+from discovery import discover, compile_pattern, compile_rule, compile_rules, rules_from_config  # noqa: E402
+
+FILES = {
+    "p1/Head Demyelination/AX_FLAIR/AX_FLAIR.nii.gz": 400,
+    "p1/Head Demyelination/AX_FLAIR/AX_FLAIR_bet.nii.gz": 200,
+    "p1/Head Demyelination/AX_FLAIR/AX_FLAIR_ROI.nii.gz": 10,
+    "p1/Head Demyelination/AX_T1/AX_T1.nii.gz": 300,
+    "p1/Head Demyelination/AX_T1/notes.txt": 5,
+    "p2/Head Demyelination/SAG_T2/SAG_T2.nii.gz": 300,
+    "p2/Other/AX_T1/AX_T1.nii.gz": 300,
+    "p3/a/b/Head Demyelination/AX_T1/AX_T1.nii.gz": 300,
+}
+
+
+@pytest.fixture
+def root(tmp_path):
+    for name, size in FILES.items():
+        file = tmp_path / name
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(b"\0" * size)
+    return tmp_path
+
+
+def relative(root, paths):
+    return sorted(path.relative_to(root).as_posix() for path in paths)
+
+
+@pytest.mark.parametrize('pattern,want_dirs', [
+    ("*/Head Demyelination/*/*.nii.gz", False),
+    ("*/Head Demyelination/*", True),
+    ("**/Head Demyelination/*/*.nii.gz", False),
+    ("p1/**/*_bet.nii.gz", False),
+    ("*/*", True),
+])
+def test_discover_matches_glob(root, pattern, want_dirs):
+    expected = [path for path in root.glob(pattern) if path.is_dir() == want_dirs]
+    assert relative(root, discover(root, pattern, want_dirs=want_dirs, n_workers=4)) == relative(root, expected)
+
+
+def test_rules(root):
+    keep = compile_rules(include=[{'name': "*.nii.gz"}],
+                         exclude=[{'regex': "(^|[/_ ])(ROI|EQ)([/_. ]|$)"},
+                                  {'regex': "_(bet|bet_mask|reorient|registered)\\.nii\\.gz$"},
+                                  {'path': "p2/*", 'max_size': 1000}])
+    found = discover(root, "**/*", keep=keep, n_workers=4)
+    assert relative(root, found) == ["p1/Head Demyelination/AX_FLAIR/AX_FLAIR.nii.gz",
+                                     "p1/Head Demyelination/AX_T1/AX_T1.nii.gz",
+                                     "p3/a/b/Head Demyelination/AX_T1/AX_T1.nii.gz"]
+
+
+def test_rules_from_config(root):
+    config = Config({
+        'SOURCE_DIR': root.as_posix(), 'DIR_STRUCTURE': "*/Head Demyelination/*", 'DCM2NIIX_FLAGS': "",
+        'BET_FLAGS': "", 'FLAIR_BET_FLAGS': "", 'FSLREORIENT2DSTD_FLAGS': "", 'FLIRT_FLAGS': "",
+        'REFERENCE_TEMPLATE': "template.nii.gz",
+        'DISCOVERY': {'SOURCE': {'INCLUDE': [{'path': "p1/*"}], 'EXCLUDE': [{'name': "AX_T1"}]}},
+    })
+    found = discover(root, config.DIR_STRUCTURE, keep=rules_from_config(config, 'SOURCE'), want_dirs=True)
+    assert relative(root, found) == ["p1/Head Demyelination/AX_FLAIR"]
+    # a section without rules keeps everything
+    assert len(list(discover(root, config.DIR_STRUCTURE, keep=rules_from_config(config, 'NII'),
+                             want_dirs=True))) == 3
+
+
+def test_unknown_rule_key():
+    with pytest.raises(ValueError):
+        compile_rule({'glob': "*.nii.gz"})
+
+
+@pytest.mark.parametrize('rel,matches,below', [
+    ("p1/Head Demyelination/AX_FLAIR", True, True),
+    ("p1/Head Demyelination", False, True),
+    ("p1", False, True),
+    ("p1/Other", False, False),
+    ("p1/Head Demyelination/AX_FLAIR/nested", False, False),
+    ("../Head Demyelination/evil", True, True),
+])
+def test_compile_pattern(rel, matches, below):
+    assert compile_pattern("*/Head Demyelination/*")(rel) == matches
+    # prefix mode also accepts the directories a match could be below, as discover scans them
+    assert compile_pattern("*/Head Demyelination/*", prefix=True)(rel) == below
+
+
+def test_compile_pattern_double_star():
+    match = compile_pattern("**/Head Demyelination/*")
+    assert match("Head Demyelination/AX_T1")
+    assert match("p3/a/b/Head Demyelination/AX_T1")
+    assert not match("p3/a/b/Head Demyelination")
+    assert compile_pattern("**/Head Demyelination/*", prefix=True)("p3/a/b")
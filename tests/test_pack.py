@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The packed store: its grid from the config, appends and recovery from an append that never committed.
+
+    python -m pytest tests
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import numpy as np
+import nibabel as nib
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils import Config, ConfigError  # noqa: E402
+from pack import PackedStore, VOLUMES_FILE, INDEX_FILE, open_store, get_pack  # noqa: E402
+
+TEMPLATE_SHAPE = (12, 14, 10)
+
+
+def new_config(tmp_path, **values):
+    template = tmp_path / "template.nii.gz"
+    if not template.is_file():
+        nib.save(nib.Nifti1Image(np.zeros(TEMPLATE_SHAPE, np.float32), np.eye(4)), template)
+    return Config(dict({
+        'SOURCE_DIR': tmp_path.as_posix(), 'DIR_STRUCTURE': "*/*", 'DCM2NIIX_FLAGS': "", 'BET_FLAGS': "",
+        'FLAIR_BET_FLAGS': "", 'FSLREORIENT2DSTD_FLAGS': "", 'FLIRT_FLAGS': "",
+        'REFERENCE_TEMPLATE': template.as_posix(),
+    }, **values))
+
+
+@pytest.mark.parametrize('output,shape', [('volume', TEMPLATE_SHAPE), ('matrix', (6, 7, 5))])
+def test_store_grid(tmp_path, output, shape):
+    config = new_config(tmp_path, PACK={'DIR': (tmp_path / "packed").as_posix(), 'RESOLUTION': 2},
+                        REGISTRATION={'OUTPUT': output})
+    # _registered.nii.gz volumes stay on the template grid, only resampled matrices use RESOLUTION
+    assert get_pack(config)['RESOLUTION'] == (2 if output == 'matrix' else None)
+    assert open_store(config).shape == shape
+
+
+def test_store_grid_mismatch(tmp_path):
+    pack = {'DIR': (tmp_path / "packed").as_posix()}
+    assert open_store(new_config(tmp_path, PACK=pack)).shape == TEMPLATE_SHAPE
+    with pytest.raises(ConfigError):
+        open_store(new_config(tmp_path, PACK=dict(pack, RESOLUTION=2), REGISTRATION={'OUTPUT': 'matrix'}))
+
+
+def new_volume(value, shape=TEMPLATE_SHAPE):
+    return nib.Nifti1Image(np.full(shape, value, np.float32), np.eye(4))
+
+
+def metadata(file):
+    return {'file': file, 'patient': file.split("/")[0], 'sequence': 'T1', 'labels': {'edss': 2}}
+
+
+def test_append(tmp_path):
+    store = PackedStore.create(tmp_path / "packed", TEMPLATE_SHAPE)
+    nii_file = tmp_path / "p0.nii.gz"
+    nib.save(new_volume(0), nii_file)
+    assert store.append(nii_file, metadata(nii_file.as_posix())) == 0
+    assert store.append(nii_file, metadata(nii_file.as_posix())) is None
+    assert store.append("p1/t1.nii.gz", metadata("p1/t1.nii.gz"), new_volume(1)) == 1
+    assert store.append("p2/t1.nii.gz", metadata("p2/t1.nii.gz"), new_volume(2, (12, 14, 9))) is None
+
+    store = PackedStore.open(tmp_path / "packed")
+    assert len(store) == 2
+    assert np.all(store[1] == 1) and np.all(store[0] == 0)
+    assert store.select(patient='p1') == [1]
+    assert store.select(edss=2) == [0, 1]
+    # create on an existing store opens it
+    assert len(PackedStore.create(tmp_path / "packed", TEMPLATE_SHAPE)) == 2
+
+
+def test_interrupted_append(tmp_path):
+    store = PackedStore.create(tmp_path / "packed", TEMPLATE_SHAPE)
+    store.append("p0/t1.nii.gz", metadata("p0/t1.nii.gz"), new_volume(0))
+    # a writer killed after writing its volume and index line but before counting them in the header
+    with open(tmp_path / "packed" / VOLUMES_FILE, 'ab') as f:
+        f.write(np.full(TEMPLATE_SHAPE, 9, np.float32).tobytes()[:1000])
+    with open(tmp_path / "packed" / INDEX_FILE, 'a') as f:
+        f.write('{"file": "p9/t1.nii.gz", "patie')
+
+    store = PackedStore.open(tmp_path / "packed")
+    assert len(store) == 1
+    assert store.append("p1/t1.nii.gz", metadata("p1/t1.nii.gz"), new_volume(1)) == 1
+    store = PackedStore.open(tmp_path / "packed")
+    assert [entry['file'] for entry in store.index] == ["p0/t1.nii.gz", "p1/t1.nii.gz"]
+    assert np.all(store[1] == 1)
+    assert os.path.getsize(tmp_path / "packed" / VOLUMES_FILE) == 2 * store.volume_bytes
+
+
+def test_interleaved_writers(tmp_path):
+    first = PackedStore.create(tmp_path / "packed", TEMPLATE_SHAPE)
+    second = PackedStore.open(tmp_path / "packed")
+    assert first.append("p0/t1.nii.gz", metadata("p0/t1.nii.gz"), new_volume(0)) == 0
+    # second picks up the volume first appended before adding its own, and skips one it already has
+    assert second.append("p0/t1.nii.gz", metadata("p0/t1.nii.gz"), new_volume(0)) is None
+    assert second.append("p1/t1.nii.gz", metadata("p1/t1.nii.gz"), new_volume(1)) == 1
+    assert first.append("p2/t1.nii.gz", metadata("p2/t1.nii.gz"), new_volume(2)) == 2
+    store = PackedStore.open(tmp_path / "packed")
+    assert [float(store[i].mean()) for i in range(len(store))] == [0, 1, 2]
+    assert store.select(patient='p2') == [2]
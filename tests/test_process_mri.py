@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tasks of a staged run, written as a script so no FSL tool is run, and the failure ledger of --retry-failed.
+
+    python -m pytest tests
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import numpy as np
+import nibabel as nib
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import process_mri  # noqa: E402
+from utils import Config, set_config  # noqa: E402
+from process_mri import resume_task, process_pipeline  # noqa: E402
+from process_mri import failure_entry, load_ledger, save_ledger, retry_tasks, record_result  # noqa: E402
+
+SELECTED = {'bet': False, 'qc': False, 'reorient': False, 'registration': True}
+
+
+@pytest.fixture
+def config(tmp_path):
+    template = tmp_path / "template.nii.gz"
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, 4), np.float32), np.eye(4)), template)
+    config = set_config(Config({
+        'SOURCE_DIR': tmp_path.as_posix(), 'DIR_STRUCTURE': "*/*", 'DCM2NIIX_FLAGS': "", 'BET_FLAGS': "-f 0.4",
+        'FLAIR_BET_FLAGS': "-f 0.62", 'FSLREORIENT2DSTD_FLAGS': "", 'FLIRT_FLAGS': "-dof 12",
+        'REFERENCE_TEMPLATE': template.as_posix(),
+    }))
+    yield config
+    set_config(None)
+
+
+def write_nii(file):
+    file.parent.mkdir(parents=True, exist_ok=True)
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 4), np.float32), np.eye(4)), file)
+    return file
+
+
+def test_resume_task_starts_after_bet(tmp_path):
+    nii_file = write_nii(tmp_path / "p1" / "AX_FLAIR" / "AX_FLAIR.nii.gz")
+    assert resume_task(nii_file, SELECTED) == (nii_file, None, nii_file)
+
+    bet_file = write_nii(tmp_path / "p1" / "AX_FLAIR" / "AX_FLAIR_bet.nii.gz")
+    assert resume_task(nii_file, SELECTED) == (bet_file, 'registration', nii_file)
+    assert resume_task(nii_file, dict(SELECTED, qc=True)) == (bet_file, 'qc', nii_file)
+    # a run that strips again starts from the raw file
+    assert resume_task(nii_file, dict(SELECTED, bet=True)) == (nii_file, None, nii_file)
+
+
+def test_registration_only_after_bet_run(tmp_path, config, monkeypatch):
+    nii_file = write_nii(tmp_path / "p1" / "AX_FLAIR" / "AX_FLAIR.nii.gz")
+    bet_file = write_nii(tmp_path / "p1" / "AX_FLAIR" / "AX_FLAIR_bet.nii.gz")
+    script = tmp_path / "script.sh"
+    script.touch()
+    monkeypatch.setattr(process_mri, 'SKIP_CMD', False)
+
+    source_file, start_stage, original_file = resume_task(nii_file, SELECTED)
+    result = process_pipeline(source_file, do_registration=True, script_name=script.as_posix(),
+                              start_stage=start_stage, original_file=original_file)
+    assert result == (nii_file, {}, None)
+    commands = script.read_text()
+    assert bet_file.name in commands and "AX_FLAIR_registered.nii.gz" in commands
+
+
+def test_ledger_round_trip(tmp_path):
+    ledger_file = (tmp_path / "failures.json").as_posix()
+    assert load_ledger(ledger_file) == {}
+    nii_file = tmp_path / "AX_FLAIR.nii.gz"
+    ledger = {nii_file.as_posix(): failure_entry('registration', tmp_path / "AX_FLAIR_bet.nii.gz", "timed out", 3)}
+    save_ledger(ledger_file, ledger)
+    assert load_ledger(ledger_file) == ledger
+
+    # a failed file resumes at the stage that failed, from that stage's input
+    assert retry_tasks(load_ledger(ledger_file), SELECTED) == [
+        (tmp_path / "AX_FLAIR_bet.nii.gz", 'registration', nii_file)]
+    lost = {nii_file.as_posix(): failure_entry('pipeline', nii_file, "worker died", 1)}
+    assert retry_tasks(lost, SELECTED) == [(nii_file, None, nii_file)]
+
+
+def test_failure_kept_until_stage_runs(tmp_path):
+    nii_file = tmp_path / "AX_FLAIR.nii.gz"
+    entry = failure_entry('registration', tmp_path / "AX_FLAIR_bet.nii.gz", "timed out", 3)
+    ledger = {nii_file.as_posix(): entry}
+
+    # retried without --registration, or as a script, nothing is run
+    assert not record_result(ledger, nii_file, {}, None)
+    assert not record_result(ledger, nii_file, {'bet': 10.0}, None)
+    assert ledger == {nii_file.as_posix(): entry}
+
+    failure = failure_entry('registration', tmp_path / "AX_FLAIR_bet.nii.gz", "timed out again", 3)
+    assert record_result(ledger, nii_file, {}, failure)
+    assert ledger[nii_file.as_posix()] is failure
+
+    assert not record_result(ledger, nii_file, {'registration': 60.0}, None)
+    assert ledger == {}
+
+
+def test_retry_without_failed_stage(tmp_path, config):
+    nii_file = write_nii(tmp_path / "AX_FLAIR.nii.gz")
+    bet_file = write_nii(tmp_path / "AX_FLAIR_bet.nii.gz")
+    ledger = {nii_file.as_posix(): failure_entry('registration', bet_file, "timed out", 3)}
+    [(source_file, start_stage, original_file)] = retry_tasks(ledger, dict(SELECTED, registration=False))
+    original_file, timings, failure = process_pipeline(source_file, do_bet=True, start_stage=start_stage,
+                                                       original_file=original_file)
+    assert (timings, failure) == ({}, None)
+    record_result(ledger, original_file, timings, failure)
+    assert list(ledger) == [nii_file.as_posix()]
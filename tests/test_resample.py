@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Resampling with a FLIRT matrix against known shifts, for images in radiological and neurological order, which FSL
+coordinates flip in x.
+
+    python -m pytest tests
+"""
+__author__ = "Aonghus Lawlor"
+__copyright__ = "Copyright 2021, Aonghus Lawlor"
+__credits__ = ["Aonghus Lawlor", "Brendan Kelly"]
+__license__ = "GPLv3.0"
+__version__ = "1.0"
+__maintainer__ = "Aonghus Lawlor"
+__email__ = "aonghus.lawlor@ucd.ie"
+__status__ = "Development"
+
+import os
+import sys
+import numpy as np
+import nibabel as nib
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from resample import resample, output_grid  # noqa: E402
+from registration import fsl_to_fsl  # noqa: E402
+
+SHAPE = (16, 12, 10)
+ZOOM = 2.0
+
+
+def new_image(x_sign, shift=0.0, data=None):
+    """
+    a volume of 2mm voxels whose value is its x index, moved shift mm along world x.
+    x_sign -1 is radiological order (negative determinant), +1 neurological (positive determinant)
+    """
+    affine = np.diag([x_sign * ZOOM, ZOOM, ZOOM, 1.0])
+    affine[:3, 3] = [shift - x_sign * 15.0, -11.0, -9.0]
+    if data is None:
+        data = np.broadcast_to(np.arange(SHAPE[0], dtype=np.float32)[:, None, None], SHAPE).copy()
+    return nib.Nifti1Image(data, affine)
+
+
+@pytest.mark.parametrize('x_sign', [-1, 1])
+def test_identity(x_sign):
+    img = new_image(x_sign)
+    resampled = resample(img, np.eye(4), img, interpolation='nearestneighbour')
+    assert np.array_equal(resampled.affine, img.affine)
+    assert np.array_equal(resampled.get_fdata(), img.get_fdata())
+
+
+@pytest.mark.parametrize('x_sign', [-1, 1])
+def test_fsl_shift(x_sign):
+    img = new_image(x_sign)
+    # the matrix moves the source 2mm (one voxel) along FSL x, which runs against voxel x in neurological order
+    matrix = np.eye(4)
+    matrix[0, 3] = ZOOM
+    resampled = resample(img, matrix, img, interpolation='nearestneighbour').get_fdata()
+    expected = np.arange(SHAPE[0]) - (1 if x_sign < 0 else -1)
+    inside = (expected >= 0) & (expected < SHAPE[0])
+    assert np.array_equal(resampled[inside, 5, 5], expected[inside])
+    assert np.all(resampled[~inside] == 0)
+
+
+@pytest.mark.parametrize('interpolation', ['nearestneighbour', 'trilinear', 'spline'])
+@pytest.mark.parametrize('x_sign', [-1, 1])
+def test_world_shift(x_sign, interpolation):
+    reference = new_image(x_sign)
+    # the same volume moved 4mm along world x, registered back with the exact matrix between them
+    source = new_image(x_sign, shift=4.0)
+    resampled = resample(source, fsl_to_fsl(source, reference), reference, interpolation=interpolation).get_fdata()
+    # a voxel of reference sees the source voxel 4mm = 2 voxels back along world x
+    expected = np.arange(SHAPE[0]) - 2 * x_sign
+    inside = (expected >= 0) & (expected < SHAPE[0])
+    assert np.allclose(resampled[inside, 5, 5], expected[inside], atol=1e-4)
+
+
+@pytest.mark.parametrize('x_sign', [-1, 1])
+def test_resolution(x_sign):
+    reference = new_image(x_sign)
+    shape, affine = output_grid(reference.shape, reference.affine, 4)
+    assert shape == (8, 6, 5)
+    resampled = resample(reference, np.eye(4), reference, resolution=4, interpolation='trilinear')
+    assert resampled.shape == shape and np.array_equal(resampled.affine, affine)
+    # every other voxel, keeping the centre of the first
+    assert np.allclose(resampled.get_fdata()[:, 2, 2], np.arange(0, SHAPE[0], 2))
+
+
+def test_unknown_interpolation():
+    img = new_image(1)
+    with pytest.raises(ValueError):
+        resample(img, np.eye(4), img, interpolation='cubic')